@@ -22,6 +22,7 @@
 from contextlib import contextmanager
 from datetime import datetime, timedelta
 import signal
+import subprocess
 import sys
 
 import faulthandler
@@ -58,15 +59,40 @@ class TaskdCommand(base.Command):
     summary = 'Task server'
     parser = base.Command.standard_parser(verbose=True)
     parser.add_option('--only', dest='only', type='string', default=None,
-                      help='only handle tasks of the given name(s) (can be comma-separated list)')
+                      help='only handle tasks of the given name(s) (can be comma-separated list, '
+                           'and names ending in * match any task with that prefix)')
+    parser.add_option('--exclude', dest='exclude', type='string', default=None,
+                      help='do not handle tasks of the given name(s) (same format as --only)')
+    parser.add_option('--pool', dest='pools', action='append', default=[],
+                      help='run a supervisor that manages pools of worker processes instead of a single worker.  '
+                           'Format is name:workers[:task names], e.g. repo:2:allura.tasks.repo_tasks.* '
+                           '(task names as in --only).  A pool without task names handles everything '
+                           'the other pools do not.  Can be repeated.')
+    parser.add_option('--stats-interval', dest='stats_interval', type='int', default=60,
+                      help='how often (in seconds) the supervisor logs per-pool queue depth and throughput')
+    parser.add_option('--batch-size', dest='batch_size', type='int', default=1,
+                      help='claim up to this many ready tasks with the same function and context at once, '
+                           'and run them back to back')
     parser.add_option('--nocapture', dest='nocapture', action="store_true", default=False,
                       help='Do not capture stdout and redirect it to logging.  Useful for development with pdb.set_trace()')
 
     def command(self):
-        setproctitle('taskd')
+        if self.options.pools:
+            # not "taskd" so taskd_cleanup doesn't mistake it for a worker
+            setproctitle('taskd-supervisor')
+        else:
+            setproctitle('taskd')
         self.basic_setup()
         self.keep_running = True
         self.restart_when_done = False
+        if self.options.pools:
+            base.log.info('Starting taskd supervisor, pid %s' % os.getpid())
+            signal.signal(signal.SIGHUP, self.restart_pools)
+            signal.signal(signal.SIGTERM, self.graceful_stop)
+            signal.siginterrupt(signal.SIGHUP, False)
+            signal.siginterrupt(signal.SIGTERM, False)
+            self.supervisor()
+            return
         base.log.info('Starting taskd, pid %s' % os.getpid())
         signal.signal(signal.SIGHUP, self.graceful_restart)
         signal.signal(signal.SIGTERM, self.graceful_stop)
@@ -97,6 +123,15 @@ def log_current_task(self, signum, frame):
             os.getpid(), getattr(self, 'task', None))
         status_log.info(entry)
         base.log.info(entry)
+        self.log_claim_stats()
+
+    def log_claim_stats(self):
+        claims = getattr(self, 'claims', 0)
+        if claims:
+            entry = 'taskd pid %s claimed %s tasks in %s round trips (%.2f per claim, max %s)' % (
+                os.getpid(), self.claimed, claims, float(self.claimed) / claims, self.max_claimed)
+            status_log.info(entry)
+            base.log.info(entry)
 
     def worker(self):
         from allura import model as M
@@ -107,6 +142,11 @@ def worker(self):
         only = self.options.only
         if only:
             only = only.split(',')
+        exclude = self.options.exclude
+        if exclude:
+            exclude = exclude.split(',')
+        batch_size = max(1, self.options.batch_size)
+        self.claims = self.claimed = self.max_claimed = 0
 
         def start_response(status, headers, exc_info=None):
             if status != '200 OK':
@@ -117,6 +157,13 @@ def start_response(status, headers, exc_info=None):
         def waitfunc_noq():
             time.sleep(poll_interval)
 
+        notifier = M.MonQNotifier.get()
+
+        def waitfunc_notify():
+            # poll_interval still bounds the wait, so delayed tasks and
+            # missed notifications get picked up
+            notifier.wait(poll_interval, only=only, exclude=exclude)
+
         def check_running(func):
             def waitfunc_checks_running():
                 if self.keep_running:
@@ -125,16 +172,35 @@ def waitfunc_checks_running():
                     raise StopIteration
             return waitfunc_checks_running
 
-        waitfunc = waitfunc_noq
+        if notifier.start():
+            waitfunc = waitfunc_notify
+        else:
+            waitfunc = waitfunc_noq
         waitfunc = check_running(waitfunc)
+        tasks = []
         while self.keep_running:
             try:
                 while self.keep_running:
-                    self.task = M.MonQTask.get(
+                    tasks = M.MonQTask.get_batch(
+                        batch_size,
                         process=name,
                         waitfunc=waitfunc,
-                        only=only)
-                    if self.task:
+                        only=only,
+                        exclude=exclude)
+                    if tasks:
+                        self.claims += 1
+                        self.claimed += len(tasks)
+                        self.max_claimed = max(self.max_claimed, len(tasks))
+                    while tasks:
+                        if not self.keep_running:
+                            M.MonQTask.release(tasks)
+                            break
+                        self.task = tasks.pop(0)
+                        if not self.task.mark_started():
+                            base.log.info('taskd skipping %r, no longer claimed by %s',
+                                          self.task, name)
+                            self.task = None
+                            continue
                         with(proctitle("taskd:{0}:{1}".format(
                                 self.task.task_name, self.task._id))):
                             # Build the (fake) request
@@ -149,18 +215,169 @@ def waitfunc_checks_running():
                             list(wsgi_app(r.environ, start_response))
                             self.task = None
             except Exception as e:
+                if tasks:
+                    # don't leave the rest of the batch stuck in 'busy'
+                    try:
+                        M.MonQTask.release(tasks)
+                    except Exception:
+                        base.log.exception('taskd could not release unstarted tasks')
+                    tasks = []
                 if self.keep_running:
                     base.log.exception(
                         'taskd error %s; pausing for 10s before taking more tasks' % e)
                     time.sleep(10)
                 else:
                     base.log.exception('taskd error %s' % e)
+        self.log_claim_stats()
         base.log.info('taskd pid %s stopping gracefully.' % os.getpid())
 
         if self.restart_when_done:
             base.log.info('taskd pid %s restarting itself' % os.getpid())
             os.execv(sys.argv[0], sys.argv)
 
+    def restart_pools(self, signum, frame):
+        base.log.info(
+            'taskd supervisor pid %s recieved signal %s, restarting workers gracefully' %
+            (os.getpid(), signum))
+        self.restart_workers = True
+
+    def worker_args(self, pool):
+        '''Command line for one worker process of ``pool``'''
+        try:
+            args = sys.argv[:sys.argv.index(self.command_name) + 1]
+        except ValueError:
+            args = [sys.argv[0], 'taskd']
+        args.append(self.args[0])
+        if pool.only:
+            args.extend(['--only', ','.join(pool.only)])
+        if pool.exclude:
+            args.extend(['--exclude', ','.join(pool.exclude)])
+        if self.options.batch_size > 1:
+            args.extend(['--batch-size', str(self.options.batch_size)])
+        if self.options.nocapture:
+            args.append('--nocapture')
+        return args
+
+    def supervisor(self):
+        '''Keep each configured pool filled with worker processes.
+
+        Crashed workers are replaced (with a delay if they crash right
+        away), SIGHUP is passed on to the workers so they restart
+        gracefully, and SIGTERM stops them all gracefully before exiting.
+        Queue depth and throughput per pool are logged every
+        ``--stats-interval`` seconds.
+        '''
+        pools = [WorkerPool.from_spec(spec) for spec in self.options.pools]
+        named = [name for pool in pools for name in pool.only or []]
+        for pool in pools:
+            if not pool.only:
+                pool.exclude = named
+        self.restart_workers = False
+        stats_since = datetime.utcnow()
+        while self.keep_running:
+            for pool in pools:
+                pool.reap()
+                if self.keep_running:
+                    pool.fill(self.worker_args(pool))
+            if self.restart_workers:
+                self.restart_workers = False
+                for pool in pools:
+                    pool.signal(signal.SIGHUP)
+            now = datetime.utcnow()
+            if now - stats_since >= timedelta(seconds=self.options.stats_interval):
+                for pool in pools:
+                    pool.log_stats(stats_since, now)
+                stats_since = now
+            time.sleep(1)
+        base.log.info('taskd supervisor pid %s stopping workers gracefully.' % os.getpid())
+        for pool in pools:
+            pool.signal(signal.SIGTERM)
+        for pool in pools:
+            pool.wait()
+        base.log.info('taskd supervisor pid %s stopped.' % os.getpid())
+
+
+class WorkerPool(object):
+
+    '''A set of taskd worker processes sharing a task name filter, managed by
+    the taskd supervisor.  ``size`` is the pool's concurrency limit.'''
+
+    # workers that exit sooner than this after starting are considered to be
+    # crash-looping, and aren't replaced until this much time has passed
+    respawn_delay = 10
+
+    def __init__(self, name, size, only=None, exclude=None):
+        self.name = name
+        self.size = size
+        self.only = only
+        self.exclude = exclude
+        self.procs = {}  # pid -> (Popen, start time)
+        self.pids_seen = set()  # since the last stats report
+        self.next_spawn = 0
+
+    @classmethod
+    def from_spec(cls, spec):
+        '''Parse a ``name:workers[:task names]`` --pool option'''
+        parts = spec.split(':', 2)
+        if len(parts) < 2 or not parts[1].isdigit():
+            raise ValueError('Invalid --pool %r, expected name:workers[:task names]' % spec)
+        only = parts[2].split(',') if len(parts) > 2 and parts[2] else None
+        return cls(parts[0], int(parts[1]), only=only)
+
+    def process_name(self, pid):
+        # same as the worker's MonQTask.process
+        return '%s pid %s' % (os.uname()[1], pid)
+
+    def fill(self, args):
+        if len(self.procs) >= self.size or time.time() < self.next_spawn:
+            return
+        while len(self.procs) < self.size:
+            proc = subprocess.Popen(args)
+            self.procs[proc.pid] = (proc, time.time())
+            self.pids_seen.add(proc.pid)
+            base.log.info('taskd pool %s started worker pid %s' % (self.name, proc.pid))
+
+    def reap(self):
+        for pid, (proc, started) in self.procs.items():
+            if proc.poll() is None:
+                continue
+            del self.procs[pid]
+            base.log.warning('taskd pool %s worker pid %s exited with %s' %
+                             (self.name, pid, proc.returncode))
+            if time.time() - started < self.respawn_delay:
+                self.next_spawn = time.time() + self.respawn_delay
+
+    def signal(self, signum):
+        for proc, started in self.procs.values():
+            try:
+                proc.send_signal(signum)
+            except OSError:
+                pass  # already gone
+
+    def wait(self):
+        for proc, started in self.procs.values():
+            proc.wait()
+        self.procs = {}
+
+    def log_stats(self, since, now):
+        from allura import model as M
+        query = dict(state='ready', time_queue={'$lte': now})
+        task_name = M.MonQTask.task_name_filter(self.only, self.exclude)
+        if task_name:
+            query['task_name'] = task_name
+        depth = M.MonQTask.query.find(query).count()
+        done = M.MonQTask.query.find(dict(
+            state={'$in': ['complete', 'error']},
+            time_stop={'$gte': since},
+            process={'$in': [self.process_name(pid) for pid in self.pids_seen]},
+        )).count()
+        seconds = max((now - since).total_seconds(), 1)
+        entry = 'taskd pool %s: %s/%s workers, %s tasks ready, %s done in %ds (%.2f/s)' % (
+            self.name, len(self.procs), self.size, depth, done, seconds, done / seconds)
+        status_log.info(entry)
+        base.log.info(entry)
+        self.pids_seen = set(self.procs)
+
 
 class TaskCommand(base.Command):
     summary = 'Task command'
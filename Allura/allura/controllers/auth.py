@@ -321,7 +321,7 @@ def refresh_repo(self, *repo_path):
                       rest[0], neighborhood=project.neighborhood)
         if c.app is None or not getattr(c.app, 'repo'):
             return 'Cannot find repo at %s' % repo_path
-        allura.tasks.repo_tasks.refresh.post()
+        allura.tasks.repo_tasks.refresh.post(dedupe_key=str(c.app.config._id))
         return '%r refresh queued.\n' % c.app.repo
 
     def _auth_repos(self, user):
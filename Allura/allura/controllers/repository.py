@@ -107,7 +107,7 @@ def forks(self, **kw):
 
     @expose()
     def refresh(self, **kw):
-        allura.tasks.repo_tasks.refresh.post()
+        allura.tasks.repo_tasks.refresh.post(dedupe_key=str(c.app.config._id))
         if request.referer:
             flash('Repository is being refreshed')
             redirect(request.referer)
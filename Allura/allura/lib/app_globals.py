@@ -68,17 +68,71 @@
 log = logging.getLogger(__name__)
 
 
+class RenderedMarkdownCache(utils.LRUCache):
+
+    '''
+    Process-wide LRU of rendered markdown, shared by all threads, keyed by
+    (renderer flavor, md5 of the source, bugfix rev).  Evicts least recently
+    used html to keep the total under markdown_cache.max_bytes (0, the
+    default, disables it).
+    '''
+
+    config_key = 'markdown_cache.max_bytes'
+    timer_name = 'markdown_cache'
+
+    def dump(self, html):
+        return html.encode('utf-8')
+
+    def load(self, data):
+        return data.decode('utf-8')
+
+    def sizeof(self, data):
+        return len(data)
+
+
 class ForgeMarkdown(markdown.Markdown):
 
+    # increment this if we need all caches to invalidated (e.g. xss in markdown rendering fixed)
+    cache_bugfix_rev = 2
+
+    def __init__(self, *args, **kwargs):
+        # what, besides the source, the html depends on; renderers that set it
+        # share their html through the RenderedMarkdownCache
+        self.cache_flavor = kwargs.pop('cache_flavor', None)
+        markdown.Markdown.__init__(self, *args, **kwargs)
+
+    def over_render_limit(self, source):
+        return len(source) > asint(config.get('markdown_render_max_length', 40000))
+
+    def cache_key(self, source):
+        '''Key of the rendered ``source`` in the RenderedMarkdownCache, or None
+        if it mustn't be cached'''
+        if self.cache_flavor is None:
+            return None
+        for ext in self.registeredExtensions:
+            if not getattr(ext, 'cacheable', lambda source: True)(source):
+                return None
+        md5 = hashlib.md5(h.really_unicode(source).encode('utf-8')).hexdigest()
+        return (self.cache_flavor, md5, self.cache_bugfix_rev)
+
     def convert(self, source, render_limit=True):
-        if render_limit and len(source) > asint(config.get('markdown_render_max_length', 40000)):
+        if render_limit and self.over_render_limit(source):
             # if text is too big, markdown can take a long time to process it,
             # so we return it as a plain text
             log.info('Text is too big. Skipping markdown processing')
             escaped = cgi.escape(h.really_unicode(source))
             return h.html.literal(u'<pre>%s</pre>' % escaped)
+        cache = RenderedMarkdownCache.instance()
+        key = cache and self.cache_key(source)
+        if key:
+            html = cache.get(key)
+            if html is not None:
+                return h.html.literal(html)
         try:
-            return markdown.Markdown.convert(self, source)
+            html = markdown.Markdown.convert(self, source)
+            if key:
+                cache.set(key, html)
+            return html
         except Exception:
             log.info('Invalid markdown: %s  Upwards trace is %s', source,
                      ''.join(traceback.format_stack()), exc_info=True)
@@ -104,13 +158,10 @@ def cached_convert(self, artifact, field_name):
                 field_name, artifact.__class__.__name__)
             return self.convert(source_text)
 
-        bugfix_rev = 2  # increment this if we need all caches to invalidated (e.g. xss in markdown rendering fixed)
-        md5 = None
         # If a cached version exists and it is valid, return it.
-        if cache.md5 is not None:
-            md5 = hashlib.md5(source_text.encode('utf-8')).hexdigest()
-            if cache.md5 == md5 and getattr(cache, 'fix7528', False) == bugfix_rev:
-                return h.html.literal(cache.html)
+        html = self.cached_html(artifact, field_name)
+        if html is not None:
+            return html
 
         # Convert the markdown and time the result.
         start = time.time()
@@ -127,16 +178,29 @@ def cached_convert(self, artifact, field_name):
 
         if threshold is not None and render_time > threshold:
             # Save the cache
-            if md5 is None:
-                md5 = hashlib.md5(source_text.encode('utf-8')).hexdigest()
+            md5 = hashlib.md5(source_text.encode('utf-8')).hexdigest()
             cache.md5, cache.html, cache.render_time = md5, html, render_time
-            cache.fix7528 = bugfix_rev  # flag to indicate good caches created after [#7528] and other critical bugs were fixed.
+            cache.fix7528 = self.cache_bugfix_rev  # flag to indicate good caches created after [#7528] and other critical bugs were fixed.
 
             # Prevent cache creation from updating the mod_date timestamp.
             _session = artifact_orm_session._get()
             _session.skip_mod_date = True
         return html
 
+    def cached_html(self, artifact, field_name):
+        """Return the cached html of ``artifact.field_name`` if there is a
+        valid cache for its current source, else None.
+
+        """
+        cache = getattr(artifact, field_name + '_cache', None)
+        if not cache or cache.md5 is None:
+            return None
+        source_text = getattr(artifact, field_name)
+        md5 = hashlib.md5(source_text.encode('utf-8')).hexdigest()
+        if cache.md5 == md5 and getattr(cache, 'fix7528', False) == self.cache_bugfix_rev:
+            return h.html.literal(cache.html)
+        return None
+
 
 class NeighborhoodCache(object):
     """Cached Neighborhood objects by url_prefix.
@@ -442,7 +506,8 @@ def forge_markdown(self, **kwargs):
             extensions=['codehilite',
                         ForgeExtension(
                             **kwargs), 'tables', 'toc', 'nl2br'],
-            output_format='html4')
+            output_format='html4',
+            cache_flavor=('forge',) + tuple(sorted(kwargs.items())))
 
     @property
     def markdown(self):
@@ -463,8 +528,11 @@ def markdown_commit(self):
 
         """
         app = getattr(c, 'app', None)
+        # refs are looked up in (and link to) the app
+        app_config_id = app.config._id if app else None
         return ForgeMarkdown(extensions=[CommitMessageExtension(app), 'nl2br'],
-                             output_format='html4')
+                             output_format='html4',
+                             cache_flavor=('commit', app_config_id))
 
     @property
     def production_mode(self):
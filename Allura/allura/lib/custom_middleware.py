@@ -30,6 +30,9 @@
 import pysolr
 
 from allura.lib import helpers as h
+import allura.lib.app_globals
+import allura.lib.security
+import allura.lib.solr
 import allura.model.repository
 
 log = logging.getLogger(__name__)
@@ -317,12 +320,16 @@ def timers(self):
             Timer('socket_write', socket._fileobject, 'write', 'writelines',
                   'flush', debug_each_call=False),
             Timer('solr', pysolr.Solr, 'add', 'delete', 'search', 'commit'),
+            Timer('solr', allura.lib.solr.Solr, 'add', 'delete', 'search', 'commit'),
             Timer('template', genshi.template.Template, '_prepare', '_parse',
                   'generate'),
             Timer('urlopen', urllib2, 'urlopen'),
             Timer('base_repo_tool.{method_name}',
                   allura.model.repository.RepositoryImplementation, 'last_commit_ids'),
         ] + [Timer('sidebar', ep.load(), 'sidebar_menu') for ep in tool_entry_points]
+        timers += [Timer(cache.timer_name + '.{method_name}', cache,
+                         'hit', 'miss', 'evict', debug_each_call=False)
+                   for cache in self.lru_caches]
 
         try:
             import ldap
@@ -337,9 +344,25 @@ def timers(self):
 
         return timers
 
+    @property
+    def lru_caches(self):
+        '''The :class:`~allura.lib.utils.LRUCache` classes to time and report'''
+        return [allura.lib.app_globals.RenderedMarkdownCache,
+                allura.model.repository.SharedModelCache,
+                allura.lib.security.RoleGraphCache]
+
     def before_logging(self, stat_record):
         if hasattr(c, "app") and hasattr(c.app, "config"):
             stat_record.add('request_category', c.app.config.tool_name.lower())
+        for cache in self.lru_caches:
+            cache = cache.instance()
+            if cache is not None:
+                # process-wide totals; per-request counts are in the timers
+                stat_record.add(cache.timer_name.replace('.', '_'),
+                                dict(cache.stats, size=cache.size))
+        solr_push = allura.lib.solr.pop_push_times()
+        if solr_push:
+            stat_record.add('solr_push', solr_push)
         return stat_record
 
     def entry_point_timers(self):
@@ -50,16 +50,25 @@ def myotherfunc():
         # No email notifications will be sent for c.project during this task
         pass
 
+    ``.post()`` also accepts ``delay``, ``dedupe_key`` and ``dedupe`` keyword
+    args, which are passed through to :meth:`MonQTask.post`.  For example, to
+    collapse repeated refreshes of the same thing into one pending task::
+
+        myfunc.post(dedupe_key=str(c.app.config._id))
+
     """
     def task_(func):
         def post(*args, **kwargs):
             delay = kwargs.pop('delay', 0)
+            dedupe_key = kwargs.pop('dedupe_key', None)
+            dedupe = kwargs.pop('dedupe', 'replace')
             project = getattr(c, 'project', None)
             cm = (h.notifications_disabled if project and
                   kw.get('notifications_disabled') else h.null_contextmanager)
             with cm(project):
                 from allura import model as M
-                return M.MonQTask.post(func, args, kwargs, delay=delay)
+                return M.MonQTask.post(func, args, kwargs, delay=delay,
+                                       dedupe_key=dedupe_key, dedupe=dedupe)
         # if decorating a class, have to make it a staticmethod
         # or it gets a spurious cls argument
         func.post = staticmethod(post) if inspect.isclass(func) else post
@@ -16,8 +16,12 @@
 #       under the License.
 
 import re
+import time
 import logging
 import smtplib
+import threading
+from Queue import Queue
+from multiprocessing.pool import ThreadPool
 import email.feedparser
 from email.MIMEMultipart import MIMEMultipart
 from email.MIMEText import MIMEText
@@ -216,8 +220,31 @@ def isvalid(addr):
 
 class SMTPClient(object):
 
+    '''
+    Sends mail over a persistent SMTP connection, which is replaced after
+    smtp_max_messages messages (0, the default, for no limit) and whenever a
+    transaction fails.  A failed transaction is retried smtp_retries times
+    (default 1) on a new connection, right away the first time and then
+    waiting smtp_retry_delay seconds, doubling each time.
+
+    Mail to more than smtp_max_recipients recipients (0, the default, for no
+    limit) is sent in several transactions, which go out concurrently over up
+    to smtp_pool_size (default 1) more connections, kept for the life of the
+    process.
+
+    Process-wide delivery totals are kept in :attr:`stats`.
+    '''
+
+    stats = dict(messages=0, recipients=0, bytes=0, seconds=0.0,
+                 connects=0, errors=0)
+    _stats_lock = threading.Lock()
+
     def __init__(self):
         self._client = None
+        self._messages = 0  # sent over _client since it was connected
+        self._helpers = None  # Queue of SMTPClients for the pool's threads
+        self._pool = None
+        self._pool_lock = threading.Lock()
 
     def sendmail(
             self, addrs, fromaddr, reply_to, subject, message_id, in_reply_to, message,
@@ -253,17 +280,87 @@ def sendmail(
             log.warning('No valid addrs in %s, so not sending mail',
                         map(unicode, addrs))
             return
+        self.send(smtp_addrs, content)
+
+    def send(self, smtp_addrs, content):
+        '''Send the already formatted message ``content`` to ``smtp_addrs``'''
+        max_recipients = asint(tg.config.get('smtp_max_recipients', 0))
+        batch = max_recipients or len(smtp_addrs)
+        batches = [smtp_addrs[i:i + batch]
+                   for i in range(0, len(smtp_addrs), batch)]
+        pool_size = asint(tg.config.get('smtp_pool_size', 1))
+        if len(batches) > 1 and pool_size > 1:
+            errors = self._get_pool(pool_size).map(
+                lambda rcpts: self._send_helper(rcpts, content), batches)
+            errors = [e for e in errors if e is not None]
+            if errors:
+                raise errors[0]
+        else:
+            for rcpts in batches:
+                self._send(rcpts, content)
+
+    def _send_helper(self, rcpts, content):
+        '''Send from a pool thread, over a helper's connection; returns the
+        error that stopped it, if any'''
+        helper = self._helpers.get()
         try:
-            self._client.sendmail(
-                config.return_path,
-                smtp_addrs,
-                content)
-        except:
-            self._connect()
-            self._client.sendmail(
-                config.return_path,
-                smtp_addrs,
-                content)
+            helper._send(rcpts, content)
+        except Exception as e:
+            return e
+        finally:
+            self._helpers.put(helper)
+
+    def _send(self, rcpts, content):
+        max_messages = asint(tg.config.get('smtp_max_messages', 0))
+        retries = asint(tg.config.get('smtp_retries', 1))
+        delay = float(tg.config.get('smtp_retry_delay', 1))
+        for attempt in range(retries + 1):
+            start = time.time()
+            try:
+                if self._client is None:
+                    self._connect()
+                elif max_messages and self._messages >= max_messages:
+                    self._close()
+                    self._connect()
+                self._client.sendmail(config.return_path, rcpts, content)
+            except Exception as e:
+                self._record(errors=1)
+                self._close()
+                if attempt == retries:
+                    raise
+                if attempt:
+                    time.sleep(delay)
+                    delay *= 2
+                log.warning('Sending mail to %s recipients failed (%s), retrying',
+                            len(rcpts), e)
+            else:
+                self._messages += 1
+                self._record(messages=1, recipients=len(rcpts), bytes=len(content),
+                             seconds=time.time() - start)
+                return
+
+    def _get_pool(self, size):
+        with self._pool_lock:
+            if self._pool is None:
+                self._helpers = Queue()
+                for i in range(size):
+                    self._helpers.put(SMTPClient())
+                self._pool = ThreadPool(size)
+            return self._pool
+
+    @classmethod
+    def _record(cls, **counts):
+        with cls._stats_lock:
+            for k, v in counts.iteritems():
+                cls.stats[k] += v
+
+    def _close(self):
+        if self._client is not None:
+            try:
+                self._client.quit()
+            except Exception:
+                pass  # it's being dropped anyway
+        self._client = None
 
     def _connect(self):
         if asbool(tg.config.get('smtp_ssl', False)):
@@ -284,3 +381,5 @@ def _connect(self):
         if asbool(tg.config.get('smtp_tls', False)):
             smtp_client.starttls()
         self._client = smtp_client
+        self._messages = 0
+        self._record(connects=1)
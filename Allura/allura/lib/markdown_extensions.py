@@ -41,7 +41,43 @@
 MACRO_PATTERN = r'\[\[([^\]\[]+)\]\]'
 
 
-class CommitMessageExtension(markdown.Extension):
+class ShortlinkLookupMixin(object):
+
+    '''Per-render lookups of shortlinks and their refs, for
+    :class:`ForgeLinkPattern`.  Call :meth:`reset_shortlinks` from the
+    extension's ``reset``.'''
+
+    def reset_shortlinks(self):
+        self._shortlinks = {}
+        self._refs = {}
+
+    def prefetch_shortlinks(self, links):
+        '''Look up many links, and the artifacts they point to, at once for
+        :meth:`lookup_shortlink` and :meth:`shortlink_ref`'''
+        links = [link for link in links if link not in self._shortlinks]
+        if not links:
+            return
+        shortlinks = M.Shortlink.from_links(*links)
+        self._shortlinks.update(shortlinks)
+        ref_ids = set(sl.ref_id for sl in shortlinks.values() if sl)
+        ref_ids -= set(self._refs)
+        if ref_ids:
+            refs = M.ArtifactReference.query.find(dict(_id={'$in': list(ref_ids)})).all()
+            self._refs.update(dict.fromkeys(ref_ids))
+            self._refs.update((ref._id, ref) for ref in M.ArtifactReference.load_artifacts(refs))
+
+    def lookup_shortlink(self, link):
+        if link not in self._shortlinks:
+            self._shortlinks[link] = M.Shortlink.lookup(link)
+        return self._shortlinks[link]
+
+    def shortlink_ref(self, shortlink):
+        if shortlink.ref_id not in self._refs:
+            self._refs[shortlink.ref_id] = shortlink.ref
+        return self._refs[shortlink.ref_id]
+
+
+class CommitMessageExtension(ShortlinkLookupMixin, markdown.Extension):
 
     """Markdown extension for processing commit messages.
 
@@ -69,6 +105,7 @@ def __init__(self, app):
         markdown.Extension.__init__(self)
         self.app = app
         self._use_wiki = False
+        self.reset_shortlinks()
 
     def extendMarkdown(self, md, md_globals):
         md.registerExtension(self)
@@ -93,6 +130,13 @@ def extendMarkdown(self, md, md_globals):
 
     def reset(self):
         self.forge_link_tree_processor.reset()
+        self.reset_shortlinks()
+
+    def cacheable(self, source):
+        '''Whether the html of ``source`` depends only on it and the app, and
+        not on which artifacts exist ([links], tickets and revisions)'''
+        return '[' not in source and not any(
+            p.pattern.search(source) for p in (TracRef1, TracRef2))
 
 
 class Pattern(object):
@@ -235,13 +279,14 @@ def run(self, lines):
         return new_lines
 
 
-class ForgeExtension(markdown.Extension):
+class ForgeExtension(ShortlinkLookupMixin, markdown.Extension):
 
     def __init__(self, wiki=False, email=False, macro_context=None):
         markdown.Extension.__init__(self)
         self._use_wiki = wiki
         self._is_email = email
         self._macro_context = macro_context
+        self.reset_shortlinks()
 
     def extendMarkdown(self, md, md_globals):
         md.registerExtension(self)
@@ -251,6 +296,7 @@ def extendMarkdown(self, md, md_globals):
         md.preprocessors['fenced-code'] = FencedCodeProcessor()
         md.preprocessors.add('plain_text_block', PlainTextPreprocessor(md), "_begin")
         md.preprocessors.add('macro_include', ForgeMacroIncludePreprocessor(md), '_end')
+        md.preprocessors.add('shortlink_prefetch', ShortlinkPrefetchPreprocessor(md, ext=self), '_end')
         # this has to be before the 'escape' processor, otherwise weird
         # placeholders are inserted for escaped chars within urls, and then the
         # autolink can't match the whole url
@@ -272,6 +318,12 @@ def extendMarkdown(self, md, md_globals):
 
     def reset(self):
         self.forge_link_tree_processor.reset()
+        self.reset_shortlinks()
+
+    def cacheable(self, source):
+        '''Whether the html of ``source`` depends only on it: [links] and
+        [[macros]] depend on the context and on other artifacts'''
+        return '[' not in source
 
 
 class ForgeLinkPattern(markdown.inlinepatterns.LinkPattern):
@@ -323,10 +375,11 @@ def _expand_alink(self, link, is_link_with_brackets):
         if is_link_with_brackets:
             classes = 'alink'
         href = link
-        shortlink = M.Shortlink.lookup(link)
-        if shortlink and shortlink.ref and not getattr(shortlink.ref.artifact, 'deleted', False):
+        shortlink = self.ext.lookup_shortlink(link)
+        ref = shortlink and self.ext.shortlink_ref(shortlink)
+        if ref and not getattr(ref.artifact, 'deleted', False):
             href = shortlink.url
-            if getattr(shortlink.ref.artifact, 'is_closed', False):
+            if getattr(ref.artifact, 'is_closed', False):
                 classes += ' strikethrough'
             self.ext.forge_link_tree_processor.alinks.append(shortlink)
         elif is_link_with_brackets:
@@ -334,10 +387,10 @@ def _expand_alink(self, link, is_link_with_brackets):
             classes += ' notfound'
         attach_link = link.split('/attachment/')
         if len(attach_link) == 2 and self.ext._use_wiki:
-            shortlink = M.Shortlink.lookup(attach_link[0])
+            shortlink = self.ext.lookup_shortlink(attach_link[0])
             if shortlink:
                 attach_status = ' notfound'
-                for attach in shortlink.ref.artifact.attachments:
+                for attach in self.ext.shortlink_ref(shortlink).artifact.attachments:
                     if attach.filename == attach_link[1]:
                         attach_status = ''
                 classes += attach_status
@@ -375,6 +428,30 @@ def _escape(self, txt):
         return txt
 
 
+class ShortlinkPrefetchPreprocessor(markdown.preprocessors.Preprocessor):
+
+    '''Looks up everything in the text that may be a shortlink with a single
+    query, instead of one query per link as :class:`ForgeLinkPattern` finds
+    them.  Links this misses are still looked up one at a time.'''
+
+    # [link] or [text](link)
+    link_re = re.compile(r'\[([^\]\[]+)\](?:\(\s*<?([^\s)>]+))?')
+
+    def __init__(self, md, ext):
+        markdown.preprocessors.Preprocessor.__init__(self, md)
+        self.ext = ext
+
+    def run(self, lines):
+        links = set()
+        for m in self.link_re.finditer('\n'.join(lines)):
+            for link in m.groups():
+                if link and link != 'TOC':
+                    links.add(link)
+                    links.add(link.split('/attachment/')[0])
+        self.ext.prefetch_shortlinks(links)
+        return lines
+
+
 class FencedCodeProcessor(markdown.preprocessors.Preprocessor):
     pattern = '~~~~'
 
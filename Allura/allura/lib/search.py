@@ -17,6 +17,7 @@
 
 import re
 import socket
+import threading
 from logging import getLogger
 from urllib import urlencode
 from itertools import imap
@@ -85,7 +86,12 @@ def should_update_index(self, old_doc, new_doc):
         """
         return old_doc != new_doc
 
-    def solarize(self):
+    def solarize(self, shortlinks=None):
+        """Return the :meth:`index` doc with its text converted to plain text.
+
+        If ``shortlinks`` is a list, the shortlinks found in the text are
+        appended to it, from the same markdown render as the plain text.
+        """
         doc = self.index()
         if doc is None:
             return None
@@ -96,10 +102,31 @@ def solarize(self):
 
         # Convert text to plain text (It usually contains markdown markup).
         # To do so, we convert markdown into html, and then strip all html tags.
-        text = g.markdown.convert(text)
-        doc['text'] = jinja2.Markup.escape(text).striptags()
+        # The cached html can't be used for shortlinks, since links are
+        # resolved at render time.
+        html = None
+        if shortlinks is None:
+            html = self._index_cached_html(text)
+        if html is None:
+            md = index_markdown()
+            md.reset()
+            html = md.convert(text)
+            if shortlinks is not None:
+                if md.over_render_limit(text):
+                    # too big, so it was escaped rather than rendered
+                    shortlinks.extend(find_shortlinks(text))
+                else:
+                    shortlinks.extend(md_shortlinks(md))
+        doc['text'] = jinja2.Markup.escape(html).striptags()
         return doc
 
+    def _index_cached_html(self, text):
+        '''Cached html of the markdown field that ``text`` came from, if any'''
+        for field_name in ('text', 'description'):
+            if getattr(self, field_name + '_cache', None) and getattr(self, field_name) == text:
+                return index_markdown().cached_html(self, field_name)
+        return None
+
     @classmethod
     def translate_query(cls, q, fields):
         """Return a translated Solr query (``q``), where generic field
@@ -145,9 +172,14 @@ def search(q, short_timeout=False, ignore_errors=True, **kw):
                               (match.group(1) if match else e))
 
 
-def search_artifact(atype, q, history=False, rows=10, short_timeout=False, filter=None, **kw):
+def search_artifact(atype, q, history=False, rows=10, short_timeout=False, filter=None,
+                    facet_queries=None, **kw):
     """Performs SOLR search.
 
+    ``facet_queries`` are translated like ``q`` and counted within the same
+    filters; their counts are in ``facets['facet_queries']``, keyed by their
+    position as a string.
+
     Raises SearchError if SOLR returns an error.
     """
     # first, grab an artifact and get the fields that it indexes
@@ -157,6 +189,10 @@ def search_artifact(atype, q, history=False, rows=10, short_timeout=False, filte
     fields = a.index()
     # Now, we'll translate all the fld:
     q = atype.translate_query(q, fields)
+    if facet_queries:
+        kw['facet'] = 'true'
+        kw['facet.query'] = ['{!key=%d}%s' % (i, atype.translate_query(fq, fields))
+                             for i, fq in enumerate(facet_queries)]
     fq = [
         'type_s:%s' % fields['type_s'],
         'project_id_s:%s' % c.project._id,
@@ -328,5 +364,21 @@ def find_shortlinks(text):
         extensions=['codehilite', ForgeExtension(), 'tables'],
         output_format='html4')
     md.convert(text)
+    return md_shortlinks(md)
+
+
+def md_shortlinks(md):
+    '''Shortlinks found by the last conversion of a ForgeExtension markdown'''
     link_index = md.treeprocessors['links'].alinks
     return [link for link in link_index if link is not None]
+
+
+_index_markdown = threading.local()
+
+
+def index_markdown():
+    '''Markdown instance for rendering text to index, reused by each thread'''
+    md = getattr(_index_markdown, 'md', None)
+    if md is None:
+        md = _index_markdown.md = g.markdown
+    return md
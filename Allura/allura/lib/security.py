@@ -27,11 +27,56 @@
 from itertools import chain
 from ming.utils import LazyProperty
 
-from allura.lib.utils import TruthyCallable
+from allura.lib.utils import TruthyCallable, LRUCache
 
 log = logging.getLogger(__name__)
 
 
+class RoleGraphCache(LRUCache):
+
+    '''
+    Process-wide cache of the roles of projects, and of the roles users have
+    (and reach) in projects, shared by the :class:`Credentials` of all
+    requests.
+
+    Entries are tagged with the role version of their project, which
+    :func:`bump_role_versions` increments whenever one of the project's
+    :class:`ProjectRoles <allura.model.auth.ProjectRole>` changes, and are
+    only used while it is current (older ones are left to be evicted).  Holds
+    up to role_cache.max_entries (0, the default, disables it).
+    '''
+
+    config_key = 'role_cache.max_entries'
+    timer_name = 'role_cache'
+
+    def get(self, key, version):
+        return LRUCache.get(self, (key, version))
+
+    def set(self, key, version, roles):
+        '''Cache roles, a tuple of role docs which must not be modified'''
+        LRUCache.set(self, (key, version), roles)
+
+
+def role_version_collection():
+    from allura import model as M
+    return M.session.main_doc_session.db['project_role_version']
+
+
+def role_versions(project_ids):
+    ''':returns: dict of project_id -> role version, see :class:`RoleGraphCache`'''
+    versions = dict((pid, 0) for pid in project_ids)
+    for doc in role_version_collection().find({'_id': {'$in': list(project_ids)}}):
+        versions[doc['_id']] = doc['version']
+    return versions
+
+
+def bump_role_versions(project_ids):
+    '''Invalidate the cached roles of projects, after changing their roles'''
+    for pid in set(project_ids):
+        role_version_collection().update(
+            {'_id': pid}, {'$inc': {'version': 1}}, upsert=True)
+
+
 class Credentials(object):
 
     '''
@@ -59,6 +104,15 @@ def clear(self):
         'clear cache'
         self.users = {}
         self.projects = {}
+        self.clear_acls()
+
+    def clear_acls(self):
+        '''clear compiled ACLs and memoized ACL checks
+
+        They are keyed by the ACEs themselves, so changing an ACL doesn't make
+        them stale; call this to free them (e.g. after changing many ACLs)'''
+        self.acls = {}
+        self.acl_checks = {}
 
     def clear_user(self, user_id, project_id=None):
         if project_id == '*':
@@ -70,6 +124,27 @@ def clear_user(self, user_id, project_id=None):
             self.projects.pop(pid, None)
             self.users.pop((uid, pid), None)
 
+    def compiled_acl(self, acl):
+        ''':returns: a :class:`CompiledACL` for acl, compiled once per request'''
+        fingerprint = CompiledACL.fingerprint(acl)
+        compiled = self.acls.get(fingerprint)
+        if compiled is None:
+            compiled = self.acls[fingerprint] = CompiledACL(fingerprint)
+        return compiled
+
+    def acl_check(self, compiled_acl, role_ids, permission):
+        '''
+        Memoized :meth:`CompiledACL.check`
+
+        :returns: True if access is allowed, else the roles that may chain to
+                  the parent security context
+        '''
+        key = (compiled_acl.key, tuple(role_ids), permission)
+        result = self.acl_checks.get(key)
+        if result is None:
+            result = self.acl_checks[key] = compiled_acl.check(role_ids, permission)
+        return result
+
     def load_user_roles(self, user_id, *project_ids):
         '''Load the credentials with all user roles for a set of projects'''
         # Don't reload roles
@@ -77,6 +152,21 @@ def load_user_roles(self, user_id, *project_ids):
             pid for pid in project_ids if self.users.get((user_id, pid)) is None]
         if not project_ids:
             return
+        shared = RoleGraphCache.instance()
+        versions = {}
+        if shared:
+            # read before the roles, so that roles are never cached with a
+            # version newer than they are
+            versions = role_versions(project_ids)
+            for pid in project_ids:
+                roles = shared.get(('user', user_id, pid), versions[pid])
+                if roles is not None:
+                    self.users[user_id, pid] = RoleCache(
+                        self, roles, shared_key=(user_id, pid), version=versions[pid])
+            project_ids = [
+                pid for pid in project_ids if self.users.get((user_id, pid)) is None]
+            if not project_ids:
+                return
         if user_id is None:
             q = self.project_role.find({
                 'user_id': None,
@@ -96,7 +186,11 @@ def load_user_roles(self, user_id, *project_ids):
         for role in q:
             roles_by_project[role['project_id']].append(role)
         for pid, roles in roles_by_project.iteritems():
-            self.users[user_id, pid] = RoleCache(self, roles)
+            if shared:
+                roles = tuple(roles)
+                shared.set(('user', user_id, pid), versions[pid], roles)
+            self.users[user_id, pid] = RoleCache(
+                self, roles, shared_key=(user_id, pid), version=versions.get(pid))
 
     def load_project_roles(self, *project_ids):
         '''Load the credentials with all user roles for a set of projects'''
@@ -105,12 +199,26 @@ def load_project_roles(self, *project_ids):
             pid for pid in project_ids if self.projects.get(pid) is None]
         if not project_ids:
             return
+        shared = RoleGraphCache.instance()
+        if shared:
+            versions = role_versions(project_ids)
+            for pid in project_ids:
+                roles = shared.get(('project', pid), versions[pid])
+                if roles is not None:
+                    self.projects[pid] = RoleCache(self, roles)
+            project_ids = [
+                pid for pid in project_ids if self.projects.get(pid) is None]
+            if not project_ids:
+                return
         q = self.project_role.find({
             'project_id': {'$in': project_ids}})
         roles_by_project = dict((pid, []) for pid in project_ids)
         for role in q:
             roles_by_project[role['project_id']].append(role)
         for pid, roles in roles_by_project.iteritems():
+            if shared:
+                roles = tuple(roles)
+                shared.set(('project', pid), versions[pid], roles)
             self.projects[pid] = RoleCache(self, roles)
 
     def project_roles(self, project_id):
@@ -160,13 +268,18 @@ class RoleCache(object):
     An iterable collection of :class:`ProjectRoles <allura.model.auth.ProjectRole>` that is cached after first use
     '''
 
-    def __init__(self, cred, q):
+    def __init__(self, cred, q, shared_key=None, version=None):
         '''
         :param `Credentials` cred: :class:`Credentials`
         :param iterable q: An iterable (e.g a query) of :class:`ProjectRoles <allura.model.auth.ProjectRole>`
+        :param tuple shared_key: (user_id, project_id) if these are a user's roles in a project, to share their
+                                 reaching roles through the :class:`RoleGraphCache`
+        :param int version: the project's role version when q was loaded
         '''
         self.cred = cred
         self.q = q
+        self.shared_key = shared_key
+        self.version = version
 
     def find(self, **kw):
         tests = kw.items()
@@ -241,6 +354,12 @@ def userids_that_reach(self):
 
     @LazyProperty
     def reaching_roles(self):
+        shared = self.shared_key and RoleGraphCache.instance()
+        if shared:
+            roles = shared.get(('reaching',) + self.shared_key, self.version)
+            if roles is not None:
+                return RoleCache(self.cred, roles)
+
         def _iter():
             to_visit = self.index.items()
             project_ids = set([r['project_id'] for _id, r in to_visit])
@@ -257,7 +376,11 @@ def _iter():
                 for i in role['roles']:
                     if i in pr_index:
                         to_visit.append((i, pr_index[i]))
-        return RoleCache(self.cred, _iter())
+        if not shared:
+            return RoleCache(self.cred, _iter())
+        roles = tuple(_iter())
+        shared.set(('reaching',) + self.shared_key, self.version, roles)
+        return RoleCache(self.cred, roles)
 
     @LazyProperty
     def reaching_ids(self):
@@ -268,6 +391,63 @@ def reaching_ids_set(self):
         return set(self.reaching_ids)
 
 
+class CompiledACL(object):
+    '''
+    An ACL indexed by (role_id, permission), so that finding the ACE which
+    decides a role's access doesn't walk the ACL
+    '''
+
+    def __init__(self, fingerprint):
+        ''':param tuple fingerprint: from :meth:`fingerprint`'''
+        from allura.model.types import ACE
+        self.key = fingerprint
+        # (role_id, permission) -> (position, access) of its first ACE
+        self.first = {}
+        self.denied = set()
+        for i, (access, role_id, permission) in enumerate(fingerprint):
+            self.first.setdefault((role_id, permission), (i, access))
+            if access == ACE.DENY:
+                self.denied.add((role_id, permission))
+
+    @staticmethod
+    def fingerprint(acl):
+        return tuple((ace.access, ace.role_id, ace.permission) for ace in acl)
+
+    def access(self, role_id, permission):
+        '''
+        :returns: ALLOW or DENY, from the first ACE matching (as
+                  :meth:`ACE.match <allura.model.types.ACE.match>`) role_id and
+                  permission, or None if no ACE matches
+        '''
+        from allura.model.types import EVERYONE, ALL_PERMISSIONS
+        matches = [self.first.get(k) for k in (
+            (role_id, permission), (role_id, ALL_PERMISSIONS),
+            (EVERYONE, permission), (EVERYONE, ALL_PERMISSIONS))]
+        matches = [m for m in matches if m]
+        if matches:
+            return min(matches)[1]
+
+    def denies(self, role_ids, permission):
+        '''Whether the ACL explicitly denies permission to one of role_ids'''
+        return any((rid, permission) in self.denied for rid in role_ids)
+
+    def check(self, role_ids, permission):
+        '''
+        :returns: True if the first ACE matching one of role_ids allows
+                  permission, else a tuple of the roles no ACE matches
+        '''
+        from allura.model.types import ACE
+        chainable_roles = []
+        for rid in role_ids:
+            access = self.access(rid, permission)
+            if access == ACE.ALLOW:
+                return True
+            elif access is None:
+                # access neither allowed or denied, may chain to parent context
+                chainable_roles.append(rid)
+        return tuple(chainable_roles)
+
+
 def has_access(obj, permission, user=None, project=None):
     '''Return whether the given user has the permission name on the given object.
 
@@ -282,6 +462,10 @@ def has_access(obj, permission, user=None, project=None):
       then the function returns True and access is permitted. If the ACE DENYs
       access, then that role is removed from further consideration.
 
+    - ACLs are evaluated through their :class:`CompiledACL`, and the result
+      for a given ACL, set of roles and permission is memoized on the
+      request's :class:`Credentials`.
+
     - If the obj is not a Neighborhood and the given user has the 'admin'
       permission on the current neighborhood, then the function returns True and
       access is allowed.
@@ -332,28 +516,18 @@ def predicate(obj=obj, user=user, project=project, roles=None):
                 user_id=user._id, project_id=project._id).reaching_ids
 
         # TODO: move deny logic into loop below; see ticket [#6715]
+        cred = Credentials.get()
+        acl = cred.compiled_acl(obj.acl)
         if user != M.User.anonymous():
-            user_roles = Credentials.get().user_roles(user_id=user._id,
-                                                      project_id=project.root_project._id)
-            for r in user_roles:
-                deny_user = M.ACE.deny(r['_id'], permission)
-                if M.ACL.contains(deny_user, obj.acl):
-                    return False
-
-        chainable_roles = []
-        for rid in roles:
-            for ace in obj.acl:
-                if M.ACE.match(ace, rid, permission):
-                    if ace.access == M.ACE.ALLOW:
-                        # access is allowed
-                        # log.info('%s: True', txt)
-                        return True
-                    else:
-                        # access is denied for this role
-                        break
-            else:
-                # access neither allowed or denied, may chain to parent context
-                chainable_roles.append(rid)
+            user_roles = cred.user_roles(user_id=user._id,
+                                         project_id=project.root_project._id)
+            if acl.denies([r['_id'] for r in user_roles], permission):
+                return False
+
+        chainable_roles = cred.acl_check(acl, roles, permission)
+        if chainable_roles is True:
+            # access is allowed
+            return True
         parent = obj.parent_security_context()
         if parent and chainable_roles:
             result = has_access(parent, permission, user=user, project=project)(
@@ -369,6 +543,42 @@ def predicate(obj=obj, user=user, project=project, roles=None):
     return TruthyCallable(predicate)
 
 
+def filter_accessible(objs, permission, user=None, project=None):
+    '''
+    Return the objs for which ``has_access(obj, permission, user, project)()``
+    is True, in order.
+
+    Objects of the same class, with the same ACL and the same parent security
+    context (e.g. tickets without their own ACL in one tracker), in the same
+    project, get the same answer, so it is only worked out once for each such
+    group.
+    '''
+    from allura import model as M
+    if user is None:
+        user = c.user
+    results = {}
+    accessible = []
+    for obj in objs:
+        if isinstance(obj, (M.Neighborhood, M.Project)):
+            if has_access(obj, permission, user=user, project=project)():
+                accessible.append(obj)
+            continue
+        obj_project = project
+        if obj_project is None:
+            obj_project = getattr(obj, 'project', None) or c.project
+            obj_project = obj_project.root_project
+        parent = obj.parent_security_context()
+        key = (obj.__class__, CompiledACL.fingerprint(obj.acl),
+               parent and (parent.__class__, parent._id), obj_project._id)
+        result = results.get(key)
+        if result is None:
+            result = results[key] = bool(
+                has_access(obj, permission, user=user, project=obj_project)())
+        if result:
+            accessible.append(obj)
+    return accessible
+
+
 def all_allowed(obj, user_or_role=None, project=None):
     '''
     List all the permission names that a given user or named role
@@ -15,12 +15,23 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import os
+import re
 import shlex
+import socket
+import logging
+import threading
+import time
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 
 from tg import config
-from paste.deploy.converters import asbool
+from paste.deploy.converters import asbool, asint
 import pysolr
 
+
+log = logging.getLogger(__name__)
+
 escape_rules = {'+': r'\+',
                '-': r'\-',
                '&': r'\&',
@@ -60,6 +71,10 @@ def make_solr_from_config(push_servers, query_server=None, **kwargs):
         commit=asbool(config.get('solr.commit', True)),
         commitWithin=config.get('solr.commitWithin'),
         timeout=int(config.get('solr.long_timeout', 60)),
+        push_threads=asint(config.get('solr.push_threads', 4)),
+        batch_size=asint(config.get('solr.batch_size', 1000)),
+        retries=asint(config.get('solr.retries', 2)),
+        retry_delay=float(config.get('solr.retry_delay', 1)),
     )
     solr_kwargs.update(kwargs)
     return Solr(push_servers, query_server, **solr_kwargs)
@@ -75,10 +90,20 @@ class Solr(object):
     Also, accepts default values for `commit` and `commitWithin`
     and passes those values through to each `add` and `delete` call,
     unless explicitly overridden.
+
+    Updates are pushed to the servers concurrently, by up to `push_threads`
+    threads shared by all instances with that setting.  `add` sends at most `batch_size` docs
+    per request (0 for no limit), and each request to a server is retried
+    `retries` times, waiting `retry_delay` seconds (doubling each time).
     """
 
+    _pools = {}  # ThreadPools by size, shared by the process
+    _pools_pid = None
+    _pool_lock = threading.Lock()
+
     def __init__(self, push_servers, query_server=None,
-                 commit=True, commitWithin=None, **kw):
+                 commit=True, commitWithin=None,
+                 push_threads=1, batch_size=0, retries=0, retry_delay=1, **kw):
         self.push_pool = [pysolr.Solr(s, **kw) for s in push_servers]
         if query_server:
             self.query_server = pysolr.Solr(query_server, **kw)
@@ -86,39 +111,119 @@ def __init__(self, push_servers, query_server=None,
             self.query_server = self.push_pool[0]
         self._commit = commit
         self.commitWithin = commitWithin
+        self.push_threads = push_threads
+        self.batch_size = batch_size
+        self.retries = retries
+        self.retry_delay = retry_delay
 
-    def add(self, *args, **kw):
+    def add(self, docs, *args, **kw):
         if 'commit' not in kw:
             kw['commit'] = self._commit
         if self.commitWithin and 'commitWithin' not in kw:
             kw['commitWithin'] = self.commitWithin
-        responses = []
-        for solr in self.push_pool:
-            responses.append(solr.add(*args, **kw))
-        return responses
+        if not self.batch_size or not isinstance(docs, list) or len(docs) <= self.batch_size:
+            return self._push('add', [((docs,) + args, kw)])
+        requests = []
+        for i in range(0, len(docs), self.batch_size):
+            batch_kw = dict(kw)
+            if i + self.batch_size < len(docs):
+                batch_kw['commit'] = False  # only commit with the last batch
+            requests.append(((docs[i:i + self.batch_size],) + args, batch_kw))
+        return self._push('add', requests)
 
     def delete(self, *args, **kw):
         if 'commit' not in kw:
             kw['commit'] = self._commit
-        responses = []
-        for solr in self.push_pool:
-            responses.append(solr.delete(*args, **kw))
-        return responses
+        return self._push('delete', [(args, kw)])
 
     def commit(self, *args, **kw):
-        responses = []
-        for solr in self.push_pool:
-            responses.append(solr.commit(*args, **kw))
-        return responses
+        return self._push('commit', [(args, kw)])
 
     def search(self, *args, **kw):
         return self.query_server.search(*args, **kw)
 
+    def _push(self, method, requests):
+        '''Send ``requests`` (a list of (args, kwargs) for ``method``) to
+        each push server in order, concurrently across servers.  Returns all
+        the responses, server by server; raises the first server's error
+        once every server is done.'''
+        if self.push_threads > 1 and len(self.push_pool) > 1:
+            pool = self._get_pool(self.push_threads)
+            results = pool.map(
+                lambda solr: self._push_server(solr, method, requests),
+                self.push_pool)
+        else:
+            results = [self._push_server(solr, method, requests)
+                       for solr in self.push_pool]
+        for solr, (result, elapsed) in zip(self.push_pool, results):
+            _record_push_time(solr.url, elapsed)
+        responses = []
+        for result, elapsed in results:
+            if isinstance(result, Exception):
+                raise result
+            responses.extend(result)
+        return responses
+
+    def _push_server(self, solr, method, requests):
+        '''Returns (responses or the error that stopped them, elapsed time)'''
+        start = time.time()
+        responses = []
+        try:
+            for args, kw in requests:
+                responses.append(self._retry(solr, method, args, kw))
+        except Exception as e:
+            responses = e
+        return responses, time.time() - start
+
+    def _retry(self, solr, method, args, kw):
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            try:
+                return getattr(solr, method)(*args, **kw)
+            except (pysolr.SolrError, socket.error) as e:
+                if attempt == self.retries:
+                    raise
+                log.warning('Solr %s to %s failed, retrying in %ss: %s',
+                            method, solr.url, delay, e)
+                time.sleep(delay)
+                delay *= 2
+
+    @classmethod
+    def _get_pool(cls, size):
+        with cls._pool_lock:
+            if cls._pools_pid != os.getpid():
+                # a forked child doesn't get the parent's threads, so the
+                # parent's pools would never run anything
+                cls._pools = {}
+                cls._pools_pid = os.getpid()
+            if size not in cls._pools:
+                cls._pools[size] = ThreadPool(size)
+            return cls._pools[size]
+
+
+_push_times = threading.local()
+
+
+def _record_push_time(url, elapsed):
+    if not hasattr(_push_times, 'times'):
+        _push_times.times = defaultdict(float)
+    _push_times.times[url] += elapsed
+
+
+def pop_push_times():
+    '''Time spent pushing updates to each solr server by this thread since
+    the last call, in ms by server url'''
+    times = getattr(_push_times, 'times', {})
+    _push_times.times = defaultdict(float)
+    return dict((url, int(t * 1000)) for url, t in times.iteritems())
+
 
 class MockSOLR(object):
 
     class MockHits(list):
 
+        facet_queries = None
+
         @property
         def hits(self):
             return len(self)
@@ -129,7 +234,10 @@ def docs(self):
 
         @property
         def facets(self):
-            return {'facet_fields': {}}
+            facets = {'facet_fields': {}}
+            if self.facet_queries is not None:
+                facets['facet_queries'] = self.facet_queries
+            return facets
 
     def __init__(self):
         self.db = {}
@@ -174,6 +282,11 @@ def search(self, q, fq=None, **kw):
                         break
             else:
                 result.append(obj)
+        if kw.get('facet.query'):
+            result.facet_queries = {}
+            for facet_query in kw['facet.query']:
+                key, facet_q = re.match(r'(?:\{!key=([^}]*)\})?(.*)', facet_query).groups()
+                result.facet_queries[key or facet_q] = len(self.search(facet_q, fq=fq))
         return result
 
     def delete(self, *args, **kwargs):
@@ -18,6 +18,7 @@
 
 import time
 import string
+import threading
 import hashlib
 import binascii
 import logging.handlers
@@ -443,6 +444,96 @@ def __keytransform__(self, key):
         return key.lower()
 
 
+class LRUCache(object):
+
+    '''
+    Process-wide cache shared by all threads, which drops its least recently
+    used entries to keep their total size under max_size.  Subclasses set
+    ``config_key``, the setting for max_size (0, the default, disables the
+    cache), and may override :meth:`dump`, :meth:`load` and :meth:`sizeof`
+    to store values in another form than given, and measure them (each entry
+    counts 1 by default).  Values too big to ever fit aren't cached.
+
+    Hits, misses and evictions are counted in ``stats``, and each subclass is
+    timed under ``timer_name`` by AlluraTimerMiddleware.
+    '''
+
+    config_key = None
+    timer_name = None
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.stats = dict(hits=0, misses=0, evictions=0)
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        '''The process' cache, or None if it's disabled'''
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls(asint(tg.config.get(cls.config_key, 0)))
+        if cls._instance.max_size <= 0:
+            return None
+        return cls._instance
+
+    def dump(self, value):
+        return value
+
+    def load(self, data):
+        return data
+
+    def sizeof(self, data):
+        return 1
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.pop(key, None)
+            if data is None:
+                self.miss(key)
+                return None
+            self._entries[key] = data
+            self.hit(key)
+        return self.load(data)
+
+    def set(self, key, value):
+        data = self.dump(value)
+        size = self.sizeof(data)
+        if size > self.max_size:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= self.sizeof(old)
+            self._entries[key] = data
+            self.size += size
+            while self.size > self.max_size:
+                old_key, old = self._entries.popitem(last=False)
+                self.size -= self.sizeof(old)
+                self.evict(old_key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    # counters, called with the lock held; separate methods so they can be
+    # timed (counted) by AlluraTimerMiddleware
+
+    def hit(self, key):
+        self.stats['hits'] += 1
+
+    def miss(self, key):
+        self.stats['misses'] += 1
+
+    def evict(self, key):
+        self.stats['evictions'] += 1
+
+
 def postmortem_hook(etype, value, tb):  # pragma no cover
     import sys
     import pdb
@@ -17,7 +17,6 @@
 
 import re
 import logging
-from itertools import groupby
 from cPickle import dumps, loads
 from collections import defaultdict
 from urllib import unquote
@@ -29,13 +28,13 @@
 from ming import collection, Field, Index
 from ming import schema as S
 from ming.utils import LazyProperty
-from ming.orm import session, mapper
+from ming.orm import session, mapper, state
 from ming.orm import ForeignIdProperty, RelationProperty
 
 from allura.lib import helpers as h
 
-from .session import main_doc_session, main_orm_session
-from .project import Project
+from .session import main_doc_session, main_orm_session, RefreshBatch
+from .project import Project, AppConfig
 
 log = logging.getLogger(__name__)
 
@@ -91,6 +90,65 @@ def from_artifact(cls, artifact):
             session(obj).expunge(obj)
             return cls.query.get(_id=artifact.index_id())
 
+    @classmethod
+    def from_artifacts(cls, artifacts):
+        '''Bulk :meth:`from_artifact`: one query for the existing refs, then
+        one bulk write for the missing ones.  Returns the refs in order.'''
+        if not artifacts:
+            return []
+        ids = [a.index_id() for a in artifacts]
+        found = dict((ref._id, ref) for ref in cls.query.find(dict(_id={'$in': ids})))
+        batch = RefreshBatch(len(artifacts))
+        missing = []
+        for a, _id in zip(artifacts, ids):
+            if _id in found:
+                continue
+            doc = dict(
+                artifact_reference=dict(
+                    cls=bson.Binary(dumps(a.__class__)),
+                    project_id=a.app_config.project_id,
+                    app_config_id=a.app_config._id,
+                    artifact_id=a._id),
+                references=[])
+            batch.upsert(ArtifactReferenceDoc, _id, doc)
+            found[_id] = None
+            missing.append(dict(doc, _id=_id))
+        batch.flush()
+        sess = session(cls)
+        for doc in missing:
+            obj = mapper(cls).create(doc, {})
+            state(obj).status = state(obj).clean
+            sess.save(obj)
+            found[doc['_id']] = obj
+        return [found[_id] for _id in ids]
+
+    @classmethod
+    def load_artifacts(cls, refs):
+        '''Look up the artifacts of many refs with one query (and one context
+        switch) per artifact class and project, instead of one per ref.  Sets
+        each ref's :attr:`artifact`; refs in a group that fails to load are
+        left to be looked up one at a time.'''
+        groups = defaultdict(list)
+        for ref in refs:
+            aref = ref.artifact_reference
+            groups[(str(aref.cls), aref.project_id)].append(ref)
+        for (pickled_cls, project_id), group in groups.iteritems():
+            ids = [ref.artifact_reference.artifact_id for ref in group]
+            try:
+                artifact_cls = loads(pickled_cls)
+                with h.push_context(project_id):
+                    artifacts = dict(
+                        (a._id, a)
+                        for a in artifact_cls.query.find(dict(_id={'$in': ids})))
+            except:
+                log.exception('Error loading %d artifacts for project %s',
+                              len(group), project_id)
+                continue
+            for ref in group:
+                ref.__dict__['artifact'] = artifacts.get(
+                    ref.artifact_reference.artifact_id)
+        return refs
+
     @LazyProperty
     def artifact(self):
         '''Look up the artifact referenced'''
@@ -148,6 +206,40 @@ def from_artifact(cls, a):
             return None
         return result
 
+    @classmethod
+    def from_artifacts(cls, artifacts):
+        '''Bulk :meth:`from_artifact`: one query for the existing shortlinks,
+        then one bulk write of the new ones and those whose link or url
+        changed.  Like :meth:`from_artifact`, artifacts without a shorthand
+        id lose their shortlink.'''
+        if not artifacts:
+            return
+        by_ref_id = dict((a.index_id(), a) for a in artifacts)
+        existing = {}
+        for doc in ShortlinkDoc.m.find(dict(ref_id={'$in': by_ref_id.keys()})):
+            existing.setdefault(doc['ref_id'], doc)
+        batch = RefreshBatch(len(by_ref_id))
+        removed = []
+        for ref_id, a in by_ref_id.iteritems():
+            doc = existing.get(ref_id)
+            link, url = a.shorthand_id(), a.url()
+            if link is None:
+                if doc is not None:
+                    removed.append(doc['_id'])
+            elif doc is None:
+                batch.upsert(ShortlinkDoc, bson.ObjectId(), dict(
+                    ref_id=ref_id,
+                    project_id=a.app_config.project_id,
+                    app_config_id=a.app_config._id,
+                    link=link,
+                    url=url))
+            elif (doc.get('link'), doc.get('url')) != (link, url):
+                batch.update(ShortlinkDoc, dict(_id=doc['_id']),
+                             {'$set': dict(link=link, url=url)})
+        batch.flush()
+        if removed:
+            ShortlinkDoc.m.remove(dict(_id={'$in': removed}))
+
     @classmethod
     def from_links(cls, *links):
         '''Convert a sequence of shortlinks to the matching Shortlink objects'''
@@ -168,22 +260,37 @@ def from_links(cls, *links):
                 link={'$in': links_by_artifact.keys()},
                 project_id={'$in': list(project_ids)}
             ), validate=False)
-            matches_by_artifact = dict(
-                (link, list(matches))
-                for link, matches in groupby(q, key=lambda s: unquote(s.link)))
+            matches_by_artifact = defaultdict(list)
+            for m in q:
+                matches_by_artifact[unquote(m.link)].append(m)
+            # load the projects and tools of all the matches at once
+            shortlinks = sum(matches_by_artifact.values(), [])
+            projects = dict((p._id, p) for p in Project.query.find(dict(
+                _id={'$in': list(set(m.project_id for m in shortlinks))})))
+            app_configs = dict((ac._id, ac) for ac in AppConfig.query.find(dict(
+                _id={'$in': list(set(m.app_config_id for m in shortlinks))})))
+            installed = {}
+
+            def is_installed(project, ac):
+                if ac._id not in installed:
+                    installed[ac._id] = (
+                        ac.project_id == project._id and
+                        project.app_instance(ac) is not None)
+                return installed[ac._id]
+
             for link, d in parsed_links.iteritems():
-                matches = matches_by_artifact.get(unquote(d['artifact']), [])
-                matches = (
-                    m for m in matches
-                    if m.project.shortname == d['project'] and
-                    m.project.neighborhood_id == d['nbhd'] and
-                    m.app_config is not None and
-                    m.project.app_instance(m.app_config.options.mount_point))
-                if d['app']:
-                    matches = (
-                        m for m in matches
-                        if m.app_config.options.mount_point == d['app'])
-                result[link] = cls._get_correct_match(link, list(matches))
+                matches = []
+                for m in matches_by_artifact.get(unquote(d['artifact']), []):
+                    project = projects.get(m.project_id)
+                    ac = app_configs.get(m.app_config_id)
+                    if (project is not None and
+                            project.shortname == d['project'] and
+                            project.neighborhood_id == d['nbhd'] and
+                            ac is not None and
+                            is_installed(project, ac) and
+                            (not d['app'] or ac.options.mount_point == d['app'])):
+                        matches.append(m)
+                result[link] = cls._get_correct_match(link, matches)
             return result
         else:
             return {}
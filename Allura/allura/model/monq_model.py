@@ -15,6 +15,7 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import re
 import sys
 import time
 import traceback
@@ -24,19 +25,23 @@
 import pymongo
 from pylons import tmpl_context as c, app_globals as g
 from tg import config
-from paste.deploy.converters import asbool
+from paste.deploy.converters import asbool, asint
 
 import ming
 from ming.utils import LazyProperty
 from ming import schema as S
+from ming import mim
 from ming.orm import session, FieldProperty
 from ming.orm.declarative import MappedClass
 
 from allura.lib.helpers import log_output, null_contextmanager
-from .session import task_orm_session
+from .session import task_orm_session, task_doc_session
 
 log = logging.getLogger(__name__)
 
+# returned by MonQTask._union for a list that would grow too big
+_too_big = object()
+
 
 class MonQTask(MappedClass):
 
@@ -50,6 +55,7 @@ class MonQTask(MappedClass):
         - result_type - either 'keep' or 'forget', what to do with the task when
           it's done
         - time_queue - time the task was queued
+        - time_claimed - time a taskd process claimed the task
         - time_start - time taskd began working on the task
         - time_stop - time taskd stopped working on the task
         - task_name - full dotted name of the task function to run
@@ -58,9 +64,14 @@ class MonQTask(MappedClass):
         - args - ``*args`` to be sent to the task function
         - kwargs - ``**kwargs`` to be sent to the task function
         - result - if the task is complete, the return value. If in error, the traceback.
+        - dedupe_key - if set, later posts of the same task with the same key
+          (and project/app context) are merged into this one while it's ready
     '''
     states = ('ready', 'busy', 'error', 'complete', 'skipped')
     result_types = ('keep', 'forget')
+    dedupe_modes = ('replace', 'union')
+    # don't grow a unioned list arg past this many items; post a new task instead
+    dedupe_union_max = 1000
 
     class __mongometa__:
         session = task_orm_session
@@ -77,6 +88,10 @@ class __mongometa__:
                 # used by repo tarball status check, etc
                 'state', 'task_name', 'time_queue'
             ],
+            [
+                # used by MonQTask.post() with a dedupe_key
+                'state', 'task_name', 'dedupe_key'
+            ],
         ]
 
     _id = FieldProperty(S.ObjectId)
@@ -84,6 +99,7 @@ class __mongometa__:
     priority = FieldProperty(int)
     result_type = FieldProperty(S.OneOf(*result_types))
     time_queue = FieldProperty(datetime, if_missing=datetime.utcnow)
+    time_claimed = FieldProperty(datetime, if_missing=None)
     time_start = FieldProperty(datetime, if_missing=None)
     time_stop = FieldProperty(datetime, if_missing=None)
 
@@ -97,6 +113,7 @@ class __mongometa__:
     args = FieldProperty([])
     kwargs = FieldProperty({None: None})
     result = FieldProperty(None, if_missing=None)
+    dedupe_key = FieldProperty(str, if_missing=None)
 
     def __repr__(self):
         from allura import model as M
@@ -135,8 +152,20 @@ def post(cls,
              kwargs=None,
              result_type='forget',
              priority=10,
-             delay=0):
-        '''Create a new task object based on the current context.'''
+             delay=0,
+             dedupe_key=None,
+             dedupe='replace'):
+        '''Create a new task object based on the current context.
+
+        If ``dedupe_key`` is given and a task for the same function, project
+        and app with the same key is still 'ready', that task is updated
+        instead of creating a new one.  With ``dedupe='replace'`` its args,
+        kwargs and user are replaced with the new ones; with
+        ``dedupe='union'`` list args and kwargs are unioned into the existing
+        ones, up to ``dedupe_union_max`` items (other args are replaced; an
+        arg that's a list must be a list in every post).  Only use this for
+        idempotent tasks.
+        '''
         if args is None:
             args = ()
         if kwargs is None:
@@ -157,6 +186,10 @@ def post(cls,
             context['app_config_id'] = c.app.config._id
         if getattr(c, 'user', None):
             context['user_id'] = c.user._id
+        if dedupe_key is not None:
+            obj = cls._merge_ready(task_name, dedupe_key, dedupe, context, args, kwargs)
+            if obj is not None:
+                return obj
         obj = cls(
             state='ready',
             priority=priority,
@@ -167,33 +200,155 @@ def post(cls,
             process=None,
             result=None,
             context=context,
+            dedupe_key=dedupe_key,
             time_queue=datetime.utcnow() + timedelta(seconds=delay))
         session(obj).flush(obj)
+        if not delay:
+            MonQNotifier.get().notify(task_name)
         return obj
 
     @classmethod
-    def get(cls, process='worker', state='ready', waitfunc=None, only=None):
+    def _merge_ready(cls, task_name, dedupe_key, dedupe, context, args, kwargs):
+        '''Merge a post into an existing ready task with the same dedupe key.
+        Returns the updated task, or None if there isn't one.'''
+        if dedupe not in cls.dedupe_modes:
+            raise ValueError('Unknown dedupe mode %r' % dedupe)
+        query = {
+            'state': 'ready',
+            'task_name': task_name,
+            'dedupe_key': dedupe_key,
+            'context.project_id': context['project_id'],
+            'context.app_config_id': context['app_config_id'],
+        }
+        update = {
+            '$set': {
+                'context.user_id': context['user_id'],
+                'context.notifications_disabled': context['notifications_disabled'],
+            },
+        }
+        if dedupe == 'replace':
+            update['$set'].update(args=list(args), kwargs=kwargs)
+            return cls._find_and_modify(query, update)
+        if isinstance(task_doc_session.db, mim.Database):
+            return cls._merge_union_mim(query, update, args, kwargs)
+        # $addToSet each list arg, as long as it has room for all the new items
+        query['args'] = {'$size': len(args)}
+        values = [('args.%d' % i, v) for i, v in enumerate(args)]
+        values += [('kwargs.%s' % k, v) for k, v in kwargs.iteritems()]
+        for key, v in values:
+            if not isinstance(v, (list, tuple)):
+                update['$set'][key] = v
+                continue
+            room = cls.dedupe_union_max - len(v)
+            if room < 0:
+                return None
+            query['%s.%d' % (key, room)] = {'$exists': False}
+            update.setdefault('$addToSet', {})[key] = {'$each': list(v)}
+        return cls._find_and_modify(query, update)
+
+    @classmethod
+    def _merge_union_mim(cls, query, update, args, kwargs):
+        '''mim has neither $size nor $addToSet on an array element: union the
+        args in python, then only write them if the task's args haven't
+        changed since we read them (retrying if they have)'''
+        for attempt in range(3):
+            task = cls.query.find(query, refresh=True).first()
+            if task is None or len(task.args) != len(args):
+                return None
+            new_args = [cls._union(old, new) for old, new in zip(task.args, args)]
+            new_kwargs = dict(task.kwargs)
+            for k, v in kwargs.iteritems():
+                new_kwargs[k] = cls._union(task.kwargs.get(k), v)
+            if _too_big in new_args or _too_big in new_kwargs.values():
+                return None  # start a new task
+            guard = dict(query, _id=task._id)
+            guard.update(('args.%d' % i, v) for i, v in enumerate(task.args))
+            guard.update(('kwargs.%s' % k, v) for k, v in task.kwargs.iteritems())
+            update['$set'].update(args=new_args, kwargs=new_kwargs)
+            task = cls._find_and_modify(guard, update)
+            if task is not None:
+                return task
+        return None
+
+    @classmethod
+    def _union(cls, old, new):
+        '''Union of two list values (_too_big if it would have more than
+        dedupe_union_max items); for anything else the new value'''
+        if not isinstance(new, (list, tuple)):
+            return new
+        merged = list(old) if isinstance(old, (list, tuple)) else []
+        try:
+            seen = set(merged)
+            merged += [v for v in new if v not in seen and not seen.add(v)]
+        except TypeError:  # unhashable items
+            merged += [v for v in new if v not in merged]
+        if len(merged) > cls.dedupe_union_max:
+            return _too_big
+        return merged
+
+    @classmethod
+    def _find_and_modify(cls, query, update):
+        try:
+            return cls.query.find_and_modify(query=query, update=update, new=True)
+        except pymongo.errors.OperationFailure, exc:
+            if 'No matching object found' not in exc.args[0]:
+                raise
+            return None
+
+    @staticmethod
+    def _task_name_patterns(names):
+        '''Task names may end in ``*`` to match any task name with that prefix'''
+        return [re.compile('^' + re.escape(n[:-1])) if n.endswith('*') else n
+                for n in names or []]
+
+    @classmethod
+    def task_name_filter(cls, only=None, exclude=None):
+        '''Mongo condition on task_name for the given lists of task names
+        (or ``prefix.*`` patterns) to include and exclude, or None.'''
+        cond = {}
+        if only:
+            cond['$in'] = cls._task_name_patterns(only)
+        if exclude:
+            cond['$nin'] = cls._task_name_patterns(exclude)
+        return cond or None
+
+    @classmethod
+    def task_name_matches(cls, task_name, only=None, exclude=None):
+        '''Python equivalent of :meth:`task_name_filter`'''
+        def match(patterns):
+            return any(p.match(task_name) if hasattr(p, 'match') else p == task_name
+                       for p in cls._task_name_patterns(patterns))
+        if only and not match(only):
+            return False
+        return not (exclude and match(exclude))
+
+    @classmethod
+    def get(cls, process='worker', state='ready', waitfunc=None, only=None, exclude=None):
         '''Get the highest-priority, oldest, ready task and lock it to the
         current process.  If no task is available and waitfunc is supplied, call
         the waitfunc before trying to get the task again.  If waitfunc is None
         and no tasks are available, return None.  If waitfunc raises a
-        StopIteration, stop waiting for a task
+        StopIteration, stop waiting for a task.  ``only`` and ``exclude``
+        restrict which task names are considered (see :meth:`task_name_filter`).
         '''
         sort = [
             ('priority', ming.DESCENDING),
             ('time_queue', ming.ASCENDING)]
+        task_name = cls.task_name_filter(only, exclude)
         while True:
             try:
                 query = dict(state=state)
                 query['time_queue'] = {'$lte': datetime.utcnow()}
-                if only:
-                    query['task_name'] = {'$in': only}
+                if task_name:
+                    query['task_name'] = task_name
                 obj = cls.query.find_and_modify(
                     query=query,
                     update={
                         '$set': dict(
                             state='busy',
-                            process=process)
+                            process=process,
+                            time_claimed=datetime.utcnow(),
+                            time_start=None)
                     },
                     new=True,
                     sort=sort)
@@ -209,12 +364,80 @@ def get(cls, process='worker', state='ready', waitfunc=None, only=None):
             except StopIteration:
                 return None
 
+    @classmethod
+    def get_batch(cls, limit, process='worker', state='ready', waitfunc=None, only=None, exclude=None):
+        '''Like :meth:`get`, but also claim up to ``limit - 1`` more ready
+        tasks with the same function and context as the first one, so they
+        can be run back to back.  Returns a (possibly empty) list of tasks,
+        each of which keeps its own state, result and traceback.
+        '''
+        first = cls.get(process=process, state=state, waitfunc=waitfunc, only=only, exclude=exclude)
+        if first is None:
+            return []
+        tasks = [first]
+        if limit <= 1:
+            return tasks
+        query = {
+            'state': state,
+            'task_name': first.task_name,
+            'time_queue': {'$lte': datetime.utcnow()},
+        }
+        for k, v in first.context.iteritems():
+            query['context.' + k] = v
+        sort = [
+            ('priority', ming.DESCENDING),
+            ('time_queue', ming.ASCENDING)]
+        ids = [t._id for t in cls.query.find(query).sort(sort).limit(limit - 1)]
+        if not ids:
+            return tasks
+        # re-check state so tasks another worker claimed in the meantime are skipped
+        cls.query.update(
+            {'_id': {'$in': ids}, 'state': state},
+            {'$set': dict(state='busy', process=process,
+                          time_claimed=datetime.utcnow(), time_start=None)},
+            multi=True)
+        # (ODMCursor.sort() drops refresh, so keep the order of ids instead)
+        claimed = cls.query.find(
+            {'_id': {'$in': ids}, 'state': 'busy', 'process': process},
+            refresh=True).all()
+        claimed.sort(key=lambda t: ids.index(t._id))
+        tasks.extend(claimed)
+        return tasks
+
+    @classmethod
+    def release(cls, tasks):
+        '''Return claimed-but-unstarted tasks to the 'ready' state.'''
+        ids = [t._id for t in tasks]
+        if ids:
+            cls.query.update(
+                {'_id': {'$in': ids}, 'state': 'busy', 'time_start': None},
+                {'$set': dict(state='ready', process=None, time_claimed=None)},
+                multi=True)
+
+    def mark_started(self):
+        '''Record that this claimed task is starting, unless it's no longer
+        busy with this process (e.g. :meth:`timeout_tasks` made it ready again
+        while it waited its turn in a batch, and another worker took it).
+        Returns False if the task must not be run.'''
+        now = datetime.utcnow()
+        started = self._find_and_modify(
+            {'_id': self._id, 'state': 'busy', 'process': self.process, 'time_start': None},
+            {'$set': {'time_start': now}})
+        if started is None:
+            return False
+        self.time_start = now
+        return True
+
     @classmethod
     def timeout_tasks(cls, older_than):
         '''Mark all busy tasks older than a certain datetime as 'ready' again.
-        Used to retry 'stuck' tasks.'''
+        Used to retry 'stuck' tasks, including those claimed by a process
+        that died before starting them.'''
         spec = dict(state='busy')
-        spec['time_start'] = {'$lt': older_than}
+        spec['$or'] = [
+            {'time_start': {'$lt': older_than, '$ne': None}},
+            {'time_start': None, 'time_claimed': {'$lt': older_than}},
+        ]
         cls.query.update(spec, {'$set': dict(state='ready')}, multi=True)
 
     @classmethod
@@ -291,3 +514,134 @@ def list(cls, state='ready'):
         '''Print all tasks of a certain status to sys.stdout.  Used for debugging.'''
         for t in cls.query.find(dict(state=state)):
             sys.stdout.write('%r\n' % t)
+
+
+class MonQNotifier(object):
+
+    '''Wakes up idle taskd workers as soon as a new task is posted.
+
+    :meth:`MonQTask.post` inserts a small document into a capped collection
+    in the task database, and idle workers block on a tailable cursor over
+    that collection instead of sleeping for ``monq.poll_interval``.  If the
+    collection can't be created or tailed (e.g. ``monq.notify = false``, or
+    a mim database), :attr:`available` is False and workers should fall back
+    to polling.
+    '''
+    collection_name = 'monq_notify'
+    _instance = None
+
+    def __init__(self):
+        self.available = asbool(config.get('monq.notify', True))
+        self.size = asint(config.get('monq.notify_size', 1024 * 1024))
+        self._collection = None
+        self._cursor = None
+        self._last_id = None
+
+    @classmethod
+    def get(cls):
+        '''Return the process-wide notifier'''
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    @property
+    def collection(self):
+        '''The capped collection, created on first use.  Returns None (and
+        disables the notifier) if it can't be set up.'''
+        if not self.available:
+            return None
+        if self._collection is None:
+            try:
+                db = task_doc_session.db
+                if self.collection_name not in db.collection_names():
+                    coll = db.create_collection(
+                        self.collection_name, capped=True, size=self.size)
+                    # tailable cursors die immediately on an empty collection
+                    coll.insert(dict(task_name=None, ts=datetime.utcnow()))
+                else:
+                    coll = db[self.collection_name]
+                if not coll.options().get('capped'):
+                    raise ValueError('%s is not a capped collection' %
+                                     self.collection_name)
+                self._collection = coll
+            except Exception:
+                log.warning('MonQ task notifications unavailable, '
+                            'falling back to polling', exc_info=True)
+                self.available = False
+        return self._collection
+
+    def notify(self, task_name):
+        '''Announce that a task named ``task_name`` is ready'''
+        coll = self.collection
+        if coll is None:
+            return
+        try:
+            coll.insert(dict(task_name=task_name, ts=datetime.utcnow()))
+        except pymongo.errors.PyMongoError:
+            log.warning('Could not post MonQ task notification', exc_info=True)
+
+    def start(self):
+        '''Remember the newest notification, so that :meth:`wait` only
+        wakes up for tasks posted after this point.  Call before the first
+        :meth:`MonQTask.get` so no notification is missed in between.'''
+        coll = self.collection
+        if coll is None:
+            return False
+        last = coll.find(sort=[('$natural', pymongo.DESCENDING)], limit=1)
+        for doc in last:
+            self._last_id = doc['_id']
+        return True
+
+    def _tail(self):
+        '''A tailable cursor over all the notifications, in insertion order.
+        ObjectIds come from the clients' clocks, so there's no filtering on
+        them: :meth:`wait` skips up to the last one it saw instead.'''
+        return self.collection.find(
+            sort=[('$natural', pymongo.ASCENDING)], tailable=True, await_data=True)
+
+    def wait(self, timeout, only=None, exclude=None):
+        '''Block until a task (optionally restricted by ``only`` and
+        ``exclude``, as in :meth:`MonQTask.get`) is posted, or ``timeout``
+        seconds have passed.  Returns True if woken up by a notification.'''
+        if self.collection is None:
+            time.sleep(timeout)
+            return False
+        deadline = time.time() + timeout
+        try:
+            return self._wait(deadline, only, exclude)
+        except Exception:
+            # tailing failed, so poll for the rest of the timeout instead
+            log.warning('Error waiting for MonQ task notification',
+                        exc_info=True)
+            self._cursor = None
+            time.sleep(max(0, deadline - time.time()))
+            return False
+
+    def _wait(self, deadline, only, exclude):
+        while time.time() < deadline:
+            skipping = False
+            if self._cursor is None or not self._cursor.alive:
+                self._cursor = self._tail()
+                skipping = self._last_id is not None
+            woken = False
+            skipped = None
+            for doc in self._cursor:
+                if skipping:
+                    skipping = doc['_id'] != self._last_id
+                    skipped = doc['_id']
+                    continue
+                self._last_id = doc['_id']
+                if doc.get('task_name') and MonQTask.task_name_matches(
+                        doc['task_name'], only, exclude):
+                    woken = True
+            if skipping and skipped is not None:
+                # the last one seen was pushed out of the capped collection,
+                # so any of these may be new; let the worker look
+                self._last_id = skipped
+                return True
+            if woken:
+                return True
+            if not self._cursor.alive:
+                # don't spin if the server keeps killing the cursor
+                time.sleep(min(1, max(0, deadline - time.time())))
+        return False
@@ -34,16 +34,18 @@
 
 '''
 
+import os
+import zlib
 import logging
 from bson import ObjectId
 from datetime import datetime, timedelta
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 from pylons import tmpl_context as c, app_globals as g
 from tg import config
 import pymongo
 import jinja2
-from paste.deploy.converters import asbool
+from paste.deploy.converters import asbool, asint
 
 from ming import schema as S
 from ming.orm import FieldProperty, ForeignIdProperty, RelationProperty, session
@@ -51,16 +53,19 @@
 
 from allura.lib import helpers as h
 from allura.lib import security
-from allura.lib.utils import take_while_true
 import allura.tasks.mail_tasks
 
 from .session import main_orm_session
 from .auth import User, AlluraUserProperty
+from .index import ArtifactReference
 
 
 log = logging.getLogger(__name__)
 
 MAILBOX_QUIESCENT = None  # Re-enable with [#1384]: timedelta(minutes=10)
+# mailboxes are split among fire_ready shards by ranges of this many hashes
+# of their user_id
+MAILBOX_SHARD_SPACE = 1024
 
 
 class Notification(MappedClass):
@@ -281,7 +286,13 @@ def send_simple(self, toaddr):
             references=self.references,
             text=(self.text or '') + self.footer(toaddr))
 
-    def send_direct(self, user_id):
+    def send_direct(self, user_id, recipients=None):
+        '''Send this notification to ``user_id``, if they can read its artifact.
+
+        :param recipients: if given, a dict of notification _id to user ids
+            the user is added to instead of sending right away; see
+            :meth:`send_direct_batch`
+        '''
         user = User.query.get(_id=ObjectId(user_id), disabled=False, pending=False)
         artifact = self.ref.artifact
         log.debug('Sending direct notification %s to user %s',
@@ -302,8 +313,29 @@ def send_direct(self, user_id):
                       ', '.join([str(a) for a in artifact.acl]),
                       ', '.join([str(a) for a in artifact.parent_security_context().acl]))
             return
+        if recipients is not None:
+            recipients.setdefault(self._id, []).append(str(user_id))
+            return
+        self._post_direct([str(user_id)])
+
+    @classmethod
+    def send_direct_batch(cls, recipients, notifications):
+        '''Send each notification to all the users collected for it by
+        :meth:`send_direct`, in one sendmail task.
+
+        :param recipients: dict of notification _id to user ids
+        :param notifications: the notifications by _id
+        '''
+        for nid, user_ids in recipients.iteritems():
+            try:
+                notifications[nid]._post_direct(user_ids)
+            except:
+                log.exception('Error sending notification: %s to users [%s]',
+                              nid, ', '.join(user_ids))
+
+    def _post_direct(self, destinations):
         allura.tasks.mail_tasks.sendmail.post(
-            destinations=[str(user_id)],
+            destinations=destinations,
             fromaddr=self.from_address,
             reply_to=self.reply_to_address,
             subject=self.subject,
@@ -313,6 +345,45 @@ def send_direct(self, user_id):
             sender=self._sender(),
             text=(self.text or '') + self.footer())
 
+    @classmethod
+    def readable_by(cls, user, notifications):
+        '''Filter out ``notifications`` about artifacts ``user`` can't read.
+
+        The artifact references and artifacts of all the notifications are
+        loaded together, and read access is checked once per artifact.
+        Notifications whose artifact can't be found are kept.
+        '''
+        ref_ids = set(n.ref_id for n in notifications if n.ref_id)
+        if not ref_ids:
+            return notifications
+        refs = ArtifactReference.query.find(dict(_id={'$in': list(ref_ids)})).all()
+        ArtifactReference.load_artifacts(refs)
+        readable = {}
+        for ref in refs:
+            artifact = ref.artifact
+            readable[ref._id] = (artifact is None or
+                                 security.has_access(artifact, 'read', user)())
+            if not readable[ref._id]:
+                log.debug("Skipping notifications - User %s doesn't have read "
+                          "access to artifact %s", user._id, ref._id)
+        return [n for n in notifications if readable.get(n.ref_id, True)]
+
+    @classmethod
+    def digest_lines(cls, subject, notifications, truncate=None):
+        '''Generate the lines of a digest email of ``notifications``,
+        optionally truncating their text to ``truncate`` characters'''
+        yield 'Digest of %s' % subject
+        for n in notifications:
+            text = n.text or '-no text-'
+            if truncate:
+                text = h.text.truncate(text, truncate)
+            yield 'From: %s' % n.from_address
+            yield 'Subject: %s' % (n.subject or '(no subject)')
+            yield 'Message-ID: %s' % n._id
+            yield ''
+            yield text
+        yield n.footer()
+
     @classmethod
     def send_digest(self, user_id, from_address, subject, notifications,
                     reply_to_address=None):
@@ -325,26 +396,15 @@ def send_digest(self, user_id, from_address, subject, notifications,
             return
         # Filter out notifications for which the user doesn't have read
         # permissions to the artifact.
-        artifact = self.ref.artifact
-
-        def perm_check(notification):
-            return not (user and artifact) or \
-                security.has_access(artifact, 'read', user)()
-        notifications = filter(perm_check, notifications)
+        notifications = self.readable_by(user, notifications)
+        if not notifications:
+            return
 
         log.debug('Sending digest of notifications [%s] to user %s', ', '.join(
             [n._id for n in notifications]), user_id)
         if reply_to_address is None:
             reply_to_address = from_address
-        text = ['Digest of %s' % subject]
-        for n in notifications:
-            text.append('From: %s' % n.from_address)
-            text.append('Subject: %s' % (n.subject or '(no subject)'))
-            text.append('Message-ID: %s' % n._id)
-            text.append('')
-            text.append(n.text or '-no text-')
-        text.append(n.footer())
-        text = '\n'.join(text)
+        text = '\n'.join(self.digest_lines(subject, notifications))
         allura.tasks.mail_tasks.sendmail.post(
             destinations=[str(user_id)],
             fromaddr=from_address,
@@ -359,15 +419,7 @@ def send_summary(self, user_id, from_address, subject, notifications):
             return
         log.debug('Sending summary of notifications [%s] to user %s', ', '.join(
             [n._id for n in notifications]), user_id)
-        text = ['Digest of %s' % subject]
-        for n in notifications:
-            text.append('From: %s' % n.from_address)
-            text.append('Subject: %s' % (n.subject or '(no subject)'))
-            text.append('Message-ID: %s' % n._id)
-            text.append('')
-            text.append(h.text.truncate(n.text or '-no text-', 128))
-        text.append(n.footer())
-        text = '\n'.join(text)
+        text = '\n'.join(self.digest_lines(subject, notifications, truncate=128))
         allura.tasks.mail_tasks.sendmail.post(
             destinations=[str(user_id)],
             fromaddr=from_address,
@@ -395,8 +447,9 @@ class __mongometa__:
         indexes = [
             ('project_id', 'artifact_index_id'),
             ('is_flash', 'user_id'),
-            ('type', 'next_scheduled'),  # for q_digest
-            ('type', 'queue_empty'),  # for q_direct
+            ('type', 'next_scheduled', 'user_shard'),  # for q_digest
+            ('type', 'queue_empty', 'user_shard'),  # for q_direct
+            'fire_claim',
             # for deliver()
             ('project_id', 'app_config_id', 'artifact_index_id', 'topic'),
         ]
@@ -425,6 +478,12 @@ class __mongometa__:
     queue = FieldProperty([str])
     queue_empty = FieldProperty(bool)
 
+    # which fire_ready shard handles the mailbox, see shard_of()
+    user_shard = FieldProperty(int, if_missing=None)
+    # set while a fire_ready run is sending the queued notifications
+    fire_claim = FieldProperty(str, if_missing=None)
+    fire_claimed = FieldProperty(datetime, if_missing=None)
+
     project = RelationProperty('Project')
     app_config = RelationProperty('AppConfig')
 
@@ -470,6 +529,7 @@ def subscribe(
                 type=type, frequency=dict(n=n, unit=unit),
                 artifact_title=artifact_title,
                 artifact_url=artifact_url,
+                user_shard=cls.shard_of(user_id),
                 **d)
             sess.flush(mbox)
         except pymongo.errors.DuplicateKeyError:
@@ -477,6 +537,7 @@ def subscribe(
             mbox = cls.query.get(**d)
             mbox.artifact_title = artifact_title
             mbox.artifact_url = artifact_url
+            mbox.user_shard = cls.shard_of(user_id)
             mbox.type = type
             mbox.frequency.n = n
             mbox.frequency.unit = unit
@@ -540,16 +601,34 @@ def deliver(cls, nid, artifact_index_id, topic):
             'artifact_index_id': {'$in': [None, artifact_index_id]},
             'topic': {'$in': [None, topic]}
         }
+        log.debug('Delivering notification %s to mailboxes matching %s', nid, d)
+        try:
+            cls.query.update(d, cls._deliver_update(nid), multi=True)
+        except:
+            # a multi-document update can stop part way, but $push isn't
+            # idempotent, so only retry the mailboxes that didn't get it
+            log.exception(
+                'Error adding notification: %s for artifact %s on project %s to mailboxes, '
+                'adding it to each one by one', nid, artifact_index_id, c.project._id)
+            cls._deliver_each(nid, dict(d, queue={'$nin': [nid]}))
+
+    @classmethod
+    def _deliver_update(cls, nid):
+        return {'$push': dict(queue=nid),
+                '$set': dict(last_modified=datetime.utcnow(),
+                             queue_empty=False),
+                }
+
+    @classmethod
+    def _deliver_each(cls, nid, d):
+        '''Deliver notification ``nid`` to the mailboxes matching ``d`` one at a
+        time, so that an error with one doesn't keep it from the others'''
         mboxes = cls.query.find(d).all()
         log.debug('Delivering notification %s to mailboxes [%s]', nid, ', '.join(
             [str(m._id) for m in mboxes]))
         for mbox in mboxes:
             try:
-                mbox.query.update(
-                    {'$push': dict(queue=nid),
-                     '$set': dict(last_modified=datetime.utcnow(),
-                                  queue_empty=False),
-                     })
+                mbox.query.update(cls._deliver_update(nid))
                 # Make sure the mbox doesn't stick around to be flush()ed
                 session(mbox).expunge(mbox)
             except:
@@ -557,69 +636,191 @@ def deliver(cls, nid, artifact_index_id, topic):
                 # mboxes for this notification get skipped and lost forever
                 log.exception(
                     'Error adding notification: %s for artifact %s on project %s to user %s',
-                    nid, artifact_index_id, c.project._id, mbox.user_id)
+                    nid, mbox.artifact_index_id, c.project._id, mbox.user_id)
+
+    @classmethod
+    def shard_of(cls, user_id):
+        '''The :attr:`user_shard` of the mailboxes of the given user'''
+        return (zlib.crc32(str(user_id)) & 0xffffffff) % MAILBOX_SHARD_SPACE
 
     @classmethod
-    def fire_ready(cls):
+    def shard_query(cls, shard=0, shards=1):
+        '''Query for the mailboxes that fire_ready shard number ``shard`` (of
+        ``shards``) handles; the first one also gets those without a
+        :attr:`user_shard`'''
+        if shards <= 1:
+            return {}
+        q = {'user_shard': {
+            '$gte': MAILBOX_SHARD_SPACE * shard // shards,
+            '$lt': MAILBOX_SHARD_SPACE * (shard + 1) // shards}}
+        if shard == 0:
+            q = {'$or': [q, {'user_shard': None}]}
+        return q
+
+    @classmethod
+    def fire_ready(cls, shard=0, shards=1):
         '''Fires all direct subscriptions with notifications as well as
         all summary & digest subscriptions with notifications that are ready.
         Clears the mailbox queue.
+
+        The mailboxes can be split among several concurrent runs, each firing
+        only those of one shard (see :meth:`shard_query`).  Mailboxes are
+        claimed notification.fire_batch_size (default 100) at a time, and the
+        notifications queued in a batch are loaded together.
         '''
         now = datetime.utcnow()
+        batch_size = asint(config.get('notification.fire_batch_size', 100))
+        claim_timeout = asint(config.get('notification.fire_claim_timeout', 600))
+        shard_q = cls.shard_query(shard, shards)
         # Queries to find all matching subscription objects
         q_direct = dict(
+            shard_q,
             type='direct',
             queue_empty=False,
         )
         if MAILBOX_QUIESCENT:
             q_direct['last_modified'] = {'$lt': now - MAILBOX_QUIESCENT}
         q_digest = dict(
+            shard_q,
             type={'$in': ['digest', 'summary']},
             next_scheduled={'$lt': now})
 
-        def find_and_modify_direct_mbox():
-            return cls.query.find_and_modify(
-                query=q_direct,
-                update={'$set': dict(
-                    queue=[],
-                    queue_empty=True,
-                )},
-                new=False)
+        # release the mailboxes of runs that died before they were done
+        cls.query.update(
+            dict(shard_q, fire_claim={'$ne': None},
+                 fire_claimed={'$lt': now - timedelta(seconds=claim_timeout)}),
+            {'$set': dict(fire_claim=None)},
+            multi=True)
+
+        stats = dict(mailboxes=0, notifications=0, max_wait=timedelta(0))
+        start = datetime.utcnow()
+        error = None
+        for q in (q_direct, q_digest):
+            while error is None:
+                mboxes = cls._claim_batch(q, batch_size, now)
+                if not mboxes:
+                    break
+                error = cls._fire_batch(mboxes, now, stats)
+        # direct mailboxes still waiting: not quiescent yet, or left behind
+        # by an error or another run's claim
+        backlog, backlog_age = cls.backlog(shard, shards)
+        log.log(logging.INFO if stats['mailboxes'] else logging.DEBUG,
+                'fire_ready shard %s/%s: fired %s mailboxes (%s notifications) in %.3fs, '
+                'longest wait %.1fs; backlog %s mailboxes, oldest %.1fs',
+                shard, shards, stats['mailboxes'], stats['notifications'],
+                (datetime.utcnow() - start).total_seconds(),
+                stats['max_wait'].total_seconds(), backlog,
+                backlog_age.total_seconds() if backlog_age else 0)
+        if error is not None:
+            # re-raise so we don't keep (destructively) trying to process
+            # mboxes
+            raise error
+
+    @classmethod
+    def _claim_batch(cls, q, batch_size, now):
+        '''Claim up to ``batch_size`` mailboxes matching ``q`` for this run
+        of fire_ready, scheduling the next time digests fire'''
+        q = dict(q, fire_claim=None)
+        mboxes = cls.query.find(q).limit(batch_size).all()
+        for mbox in mboxes:
+            # we only want their _id and frequency, stale values of anything
+            # else mustn't be flushed
+            session(mbox).expunge(mbox)
+        claim = '%s-%s-%s' % (os.uname()[1], os.getpid(), ObjectId())
+        by_next_scheduled = defaultdict(list)
+        for mbox in mboxes:
+            by_next_scheduled[cls._next_scheduled(mbox, now)].append(mbox._id)
+        for next_scheduled, ids in by_next_scheduled.iteritems():
+            update = dict(fire_claim=claim, fire_claimed=now)
+            if next_scheduled is not None:
+                update['next_scheduled'] = next_scheduled
+            # re-check the query so mailboxes claimed by another run in the
+            # meantime are skipped
+            cls.query.update(dict(q, _id={'$in': ids}), {'$set': update}, multi=True)
+        return cls.query.find(dict(fire_claim=claim), refresh=True).all()
+
+    @classmethod
+    def _next_scheduled(cls, mbox, now):
+        if mbox.type == 'direct':
+            return None
+        next_scheduled = now
+        if mbox.frequency.unit == 'day':
+            next_scheduled += timedelta(days=mbox.frequency.n)
+        elif mbox.frequency.unit == 'week':
+            next_scheduled += timedelta(days=7 * mbox.frequency.n)
+        elif mbox.frequency.unit == 'month':
+            next_scheduled += timedelta(days=30 * mbox.frequency.n)
+        return next_scheduled
 
-        for mbox in take_while_true(find_and_modify_direct_mbox):
+    @classmethod
+    def _fire_batch(cls, mboxes, now, stats):
+        '''Clear the queues of claimed ``mboxes`` and fire them.  Returns the
+        first error firing one, if any (the others are still fired).'''
+        by_queue = defaultdict(list)
+        nids = set()
+        for mbox in mboxes:
+            by_queue[tuple(mbox.queue)].append(mbox._id)
+            nids.update(mbox.queue)
+        # remove just the notifications we're firing, others may have been
+        # delivered since
+        for queue, ids in by_queue.iteritems():
+            cls.query.update(
+                {'_id': {'$in': ids}},
+                {'$pullAll': dict(queue=list(queue)), '$set': dict(fire_claim=None)},
+                multi=True)
+        cls.query.update(
+            {'_id': {'$in': [m._id for m in mboxes]}, 'queue': []},
+            {'$set': dict(queue_empty=True)},
+            multi=True)
+        notifications = Notification.query.find(dict(_id={'$in': list(nids)})).all()
+        notifications = dict((n._id, n) for n in notifications)
+        # direct notifications going to several of these mailboxes are sent
+        # in one sendmail task
+        recipients = OrderedDict()
+        error = None
+        for mbox in mboxes:
             try:
-                mbox.fire(now)
-            except:
+                mbox.fire(now, notifications, recipients)
+            except Exception as e:
                 log.exception(
                     'Error firing mbox: %s with queue: [%s]', str(mbox._id), ', '.join(mbox.queue))
-                # re-raise so we don't keep (destructively) trying to process
-                # mboxes
-                raise
-
-        for mbox in cls.query.find(q_digest):
-            next_scheduled = now
-            if mbox.frequency.unit == 'day':
-                next_scheduled += timedelta(days=mbox.frequency.n)
-            elif mbox.frequency.unit == 'week':
-                next_scheduled += timedelta(days=7 * mbox.frequency.n)
-            elif mbox.frequency.unit == 'month':
-                next_scheduled += timedelta(days=30 * mbox.frequency.n)
-            mbox = cls.query.find_and_modify(
-                query=dict(_id=mbox._id),
-                update={'$set': dict(
-                        next_scheduled=next_scheduled,
-                        queue=[],
-                        queue_empty=True,
-                        )},
-                new=False)
-            mbox.fire(now)
-
-    def fire(self, now):
+                error = error or e
+            stats['mailboxes'] += 1
+            stats['notifications'] += len(mbox.queue)
+            if mbox.queue:
+                stats['max_wait'] = max(stats['max_wait'], now - mbox.last_modified)
+        Notification.send_direct_batch(recipients, notifications)
+        return error
+
+    @classmethod
+    def backlog(cls, shard=0, shards=1):
+        '''Return the number of direct mailboxes with notifications waiting to
+        be fired, and how long ago the oldest of them last got one (a
+        timedelta, None if there are none)'''
+        q = dict(cls.shard_query(shard, shards), type='direct', queue_empty=False)
+        count = cls.query.find(q).count()
+        oldest = cls.query.find(q).sort('last_modified', pymongo.ASCENDING).first()
+        if oldest is None:
+            return count, None
+        session(oldest).expunge(oldest)
+        return count, datetime.utcnow() - oldest.last_modified
+
+    def fire(self, now, notifications=None, recipients=None):
         '''
         Send all notifications that this mailbox has enqueued.
+
+        :param notifications: the queued notifications by _id, if already
+            loaded
+        :param recipients: if given, single direct notifications aren't sent
+            right away but collected here; see
+            :meth:`Notification.send_direct_batch`
         '''
-        notifications = Notification.query.find(dict(_id={'$in': self.queue}))
-        notifications = notifications.all()
+        if notifications is None:
+            notifications = Notification.query.find(dict(_id={'$in': self.queue}))
+            notifications = notifications.all()
+        else:
+            queue = sorted(set(self.queue), key=self.queue.index)
+            notifications = [notifications[nid] for nid in queue if nid in notifications]
         if len(notifications) != len(self.queue):
             log.error('Mailbox queue error: Mailbox %s queued [%s], found [%s]', str(
                 self._id), ', '.join(self.queue), ', '.join([n._id for n in notifications]))
@@ -631,7 +832,7 @@ def fire(self, now):
             for n in notifications:
                 try:
                     if n.topic == 'message':
-                        n.send_direct(self.user_id)
+                        n.send_direct(self.user_id, recipients)
                         # Messages must be sent individually so they can be replied
                         # to individually
                     else:
@@ -649,7 +850,7 @@ def fire(self, now):
             for (subject, from_address, reply_to_address, author_id), ns in ngroups.iteritems():
                 try:
                     if len(ns) == 1:
-                        ns[0].send_direct(self.user_id)
+                        ns[0].send_direct(self.user_id, recipients)
                     else:
                         Notification.send_digest(
                             self.user_id, from_address, subject, ns, reply_to_address)
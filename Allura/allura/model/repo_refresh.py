@@ -16,6 +16,8 @@
 #       under the License.
 
 import logging
+import threading
+import time
 from itertools import chain
 from cPickle import dumps
 from collections import OrderedDict
@@ -25,6 +27,7 @@
 import tg
 import jinja2
 from pylons import tmpl_context as c, app_globals as g
+from paste.deploy.converters import asint
 
 from ming.base import Object
 from ming.orm import mapper, session, ThreadLocalORMSession
@@ -35,6 +38,7 @@
 from allura.model.repository import CommitRunDoc
 from allura.model.repository import Commit, Tree, LastCommit, ModelCache
 from allura.model.index import ArtifactReferenceDoc, ShortlinkDoc
+from allura.model.session import RefreshBatch
 from allura.model.auth import User
 from allura.model.timeline import TransientActor
 
@@ -48,7 +52,9 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False):
     if not commit_ids:
         # the repo is empty, no need to continue
         return
-    new_commit_ids = unknown_commit_ids(commit_ids)
+    if all_commits or new_clone:
+        known_commit_ids.clear(repo._id)
+    new_commit_ids = unknown_commit_ids(commit_ids, repo)
     stats_log = h.log_action(log, 'commit')
     for ci in new_commit_ids:
         stats_log.info(
@@ -63,20 +69,32 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False):
 
     # Refresh commits
     seen = set()
+    batch = RefreshBatch()
+    start = time.time()
     for i, oid in enumerate(commit_ids):
-        repo.refresh_commit_info(oid, seen, not all_commits)
+        repo.refresh_commit_info(oid, seen, not all_commits, batch)
         if (i + 1) % 100 == 0:
-            log.info('Refresh commit info %d: %s', (i + 1), oid)
+            log.info('Refresh commit info %d/%d: %s (%.1f commits/s)',
+                     (i + 1), len(commit_ids), oid, _rate(i + 1, start))
+    batch.flush()
+    known_commit_ids.add(repo._id, commit_ids)
+    log.info('Refreshed commit info for %d commits in %.1fs (%d docs in %d bulk writes)',
+             len(commit_ids), time.time() - start, batch.written, batch.flushes)
 
-    refresh_commit_repos(all_commit_ids, repo)
+    refresh_commit_repos(all_commit_ids, repo, RefreshBatch())
 
     # Refresh child references
-    for i, oid in enumerate(commit_ids):
-        ci = CommitDoc.m.find(dict(_id=oid), validate=False).next()
-        refresh_children(ci)
-        if (i + 1) % 100 == 0:
-            log.info('Refresh child info %d for parents of %s',
-                     (i + 1), ci._id)
+    batch = RefreshBatch()
+    start = time.time()
+    i = 0
+    for oids in utils.chunked_iter(commit_ids, QSIZE):
+        for ci in CommitDoc.m.find(dict(_id={'$in': list(oids)}), validate=False):
+            refresh_children(ci, batch)
+            i += 1
+            if i % 100 == 0:
+                log.info('Refresh child info %d/%d for parents of %s (%.1f commits/s)',
+                         i, len(commit_ids), ci._id, _rate(i, start))
+    batch.flush()
 
     if repo._refresh_precompute:
         # Refresh commit runs
@@ -102,11 +120,15 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False):
     # so we skip it here, then do it on-demand later.
     if repo._refresh_precompute:
         cache = {}
+        batch = RefreshBatch()
+        start = time.time()
         for i, oid in enumerate(commit_ids):
             ci = CommitDoc.m.find(dict(_id=oid), validate=False).next()
-            cache = refresh_commit_trees(ci, cache)
+            cache = refresh_commit_trees(ci, cache, batch)
             if (i + 1) % 100 == 0:
-                log.info('Refresh commit trees %d: %s', (i + 1), ci._id)
+                log.info('Refresh commit trees %d/%d: %s (%.1f commits/s)',
+                         (i + 1), len(commit_ids), ci._id, _rate(i + 1, start))
+        batch.flush()
 
     # Compute diffs
     cache = {}
@@ -123,6 +145,11 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False):
             ThreadLocalORMSession.flush_all()
             if (i + 1) % 100 == 0:
                 log.info('Compute last commit info %d: %s', (i + 1), ci._id)
+        if commit_ids == all_commit_ids and not repo.lcd_index_complete:
+            # every commit has been through compute_lcds, so browsing can
+            # look LCDs up by tree id from now on
+            repo.lcd_index_complete = True
+            session(repo).flush(repo)
 
     # Clear any existing caches for branches/tags
     if repo.cached_branches:
@@ -171,21 +198,30 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False):
         send_notifications(repo, commit_ids)
 
 
-def refresh_commit_trees(ci, cache):
+def _rate(count, start):
+    elapsed = time.time() - start
+    return count / elapsed if elapsed else 0.0
+
+
+def refresh_commit_trees(ci, cache, batch=None):
     '''Refresh the list of trees included withn a commit'''
     if ci.tree_id is None:
         return cache
     trees_doc = TreesDoc(dict(
         _id=ci._id,
         tree_ids=list(trees(ci.tree_id, cache))))
-    trees_doc.m.save(safe=False)
+    if batch is None:
+        trees_doc.m.save(safe=False)
+    else:
+        batch.upsert(TreesDoc, trees_doc._id,
+                     dict(tree_ids=trees_doc.tree_ids), overwrite=True)
     new_cache = dict(
         (oid, cache[oid])
         for oid in trees_doc.tree_ids)
     return new_cache
 
 
-def refresh_commit_repos(all_commit_ids, repo):
+def refresh_commit_repos(all_commit_ids, repo, batch=None):
     '''Refresh the list of repositories within which a set of commits are
     contained'''
     for oids in utils.chunked_iter(all_commit_ids, QSIZE):
@@ -218,18 +254,35 @@ def refresh_commit_repos(all_commit_ids, repo):
                 app_config_id=repo.app.config._id,
                 link=oid,
                 url=repo.url_for_commit(oid)))
-            ci.m.save(safe=False, validate=False)
-            ref.m.save(safe=False, validate=False)
-            link0.m.save(safe=False, validate=False)
-            link1.m.save(safe=False, validate=False)
-
-
-def refresh_children(ci):
+            if batch is None:
+                ci.m.save(safe=False, validate=False)
+                ref.m.save(safe=False, validate=False)
+                link0.m.save(safe=False, validate=False)
+                link1.m.save(safe=False, validate=False)
+                continue
+            # links and refs before the commit's repo_ids, so an interrupted
+            # refresh redoes them
+            batch.upsert(ArtifactReferenceDoc, ref._id,
+                         dict(artifact_reference=ref.artifact_reference,
+                              references=ref.references),
+                         overwrite=True)
+            for link in (link0, link1):
+                batch.upsert(ShortlinkDoc, link._id, dict(
+                    (k, v) for k, v in link.iteritems() if k != '_id'))
+            batch.update(CommitDoc, dict(_id=oid),
+                         {'$addToSet': dict(repo_ids=repo._id)})
+    if batch is not None:
+        batch.flush()
+
+
+def refresh_children(ci, batch=None):
     '''Refresh the list of children of the given commit'''
-    CommitDoc.m.update_partial(
-        dict(_id={'$in': ci.parent_ids}),
-        {'$addToSet': dict(child_ids=ci._id)},
-        multi=True)
+    spec = dict(_id={'$in': ci.parent_ids})
+    updates = {'$addToSet': dict(child_ids=ci._id)}
+    if batch is None:
+        CommitDoc.m.update_partial(spec, updates, multi=True)
+    else:
+        batch.update(CommitDoc, spec, updates)
 
 
 class CommitRunBuilder(object):
@@ -361,14 +414,80 @@ def trees(id, cache):
             yield x
 
 
-def unknown_commit_ids(all_commit_ids):
-    '''filter out all commit ids that have already been cached'''
+class KnownCommitIds(object):
+
+    '''
+    Process-wide memo, per repo, of commit ids known to have a CommitDoc, so
+    refreshing a repo this process has seen before (e.g. in taskd) only asks
+    Mongo about the commits pushed since.  Holds up to
+    scm.refresh.known_commit_ids ids in all and is cleared when full.
+
+    Off by default (0): CommitDocs removed by another process (e.g.
+    refreshrepo --clean) can't be noticed, and their commits would be
+    skipped by refreshes here until a refresh from scratch.  Code that
+    removes CommitDocs must discard them here.
+    '''
+
+    def __init__(self):
+        self._ids = {}  # by repo _id
+        self._lock = threading.Lock()
+
+    @property
+    def max_size(self):
+        return asint(tg.config.get('scm.refresh.known_commit_ids', 0))
+
+    def known(self, repo_id, oid):
+        return oid in self._ids.get(repo_id, ())
+
+    def __len__(self):
+        return sum(len(ids) for ids in self._ids.values())
+
+    def add(self, repo_id, oids):
+        max_size = self.max_size
+        if max_size <= 0:
+            return
+        oids = list(oids)[:max_size]
+        with self._lock:
+            if len(self) + len(oids) > max_size:
+                self._ids.clear()
+            self._ids.setdefault(repo_id, set()).update(oids)
+
+    def discard(self, oids):
+        with self._lock:
+            for ids in self._ids.values():
+                ids.difference_update(oids)
+
+    def clear(self, repo_id=None):
+        '''Forget the ids of one repo, or all of them'''
+        with self._lock:
+            if repo_id is None:
+                self._ids.clear()
+            else:
+                self._ids.pop(repo_id, None)
+
+known_commit_ids = KnownCommitIds()
+
+
+def unknown_commit_ids(all_commit_ids, repo=None):
+    '''filter out all commit ids that have already been cached
+
+    :param repo: if given, the repo being refreshed, whose commit ids are
+        remembered in :data:`known_commit_ids`
+    '''
     result = []
-    for chunk in utils.chunked_iter(all_commit_ids, QSIZE):
+    if repo is not None:
+        candidates = [oid for oid in all_commit_ids
+                      if not known_commit_ids.known(repo._id, oid)]
+    else:
+        candidates = all_commit_ids
+    for chunk in utils.chunked_iter(candidates, QSIZE):
         chunk = list(chunk)
-        q = CommitDoc.m.find(dict(_id={'$in': chunk}))
-        known_commit_ids = set(ci._id for ci in q)
-        result += [oid for oid in chunk if oid not in known_commit_ids]
+        q = CommitDoc.m.find(dict(_id={'$in': chunk}), {'_id': 1}, validate=False)
+        found = [ci._id for ci in q]
+        if repo is not None:
+            known_commit_ids.add(repo._id, found)
+        found = set(found)
+        result += [oid for oid in chunk if oid not in found]
     return result
 
 
@@ -550,8 +669,12 @@ def _compute_lcds(tree, cache):
     path = tree.path().strip('/')
     if path not in tree.commit.changed_paths:
         return
-    if not cache.get(LastCommit, dict(commit_id=tree.commit._id, path=path)):
+    lcd = cache.get(LastCommit, dict(commit_id=tree.commit._id, path=path))
+    if not lcd:
         lcd = LastCommit._build(tree)
+    elif lcd.tree_id is None:
+        # computed before LCDs were indexed by tree
+        lcd.tree_id = tree._id
     for x in tree.tree_ids:
         sub_tree = _pull_tree(cache, x.id, tree, x.name)
         _compute_lcds(sub_tree, cache)
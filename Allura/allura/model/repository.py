@@ -43,7 +43,7 @@
 from ming import schema as S
 from ming import Field, collection, Index
 from ming.utils import LazyProperty
-from ming.orm import FieldProperty, session, Mapper, mapper
+from ming.orm import FieldProperty, session, state, Mapper, mapper
 from ming.base import Object
 
 from allura.lib import helpers as h
@@ -127,8 +127,9 @@ def commit_parents(self, commit):  # pragma no cover
         commit'''
         raise NotImplementedError('commit_parents')
 
-    def refresh_commit_info(self, oid, lazy=True):  # pragma no cover
-        '''Refresh the data in the commit with id oid'''
+    def refresh_commit_info(self, oid, lazy=True, batch=None):  # pragma no cover
+        '''Refresh the data in the commit with id oid.  If batch (a
+        session.RefreshBatch) is given, write the docs through it.'''
         raise NotImplementedError('refresh_commit_info')
 
     def _setup_hooks(self, source_path=None):  # pragma no cover
@@ -364,6 +365,8 @@ class __mongometa__:
     default_branch_name = FieldProperty(str)
     cached_branches = FieldProperty([dict(name=str, object_id=str)])
     cached_tags = FieldProperty([dict(name=str, object_id=str)])
+    # True once LCDs (with tree_id) exist for every commit, see LastCommit.get
+    lcd_index_complete = FieldProperty(bool, if_missing=False)
 
     def __init__(self, **kw):
         if 'name' in kw and 'tool' in kw:
@@ -442,8 +445,8 @@ def commit(self, rev):
     def all_commit_ids(self):
         return self._impl.all_commit_ids()
 
-    def refresh_commit_info(self, oid, seen, lazy=True):
-        return self._impl.refresh_commit_info(oid, seen, lazy)
+    def refresh_commit_info(self, oid, seen, lazy=True, batch=None):
+        return self._impl.refresh_commit_info(oid, seen, lazy, batch)
 
     def open_blob(self, blob):
         return self._impl.open_blob(blob)
@@ -654,7 +657,7 @@ def guess_type(self, name):
 
     def unknown_commit_ids(self):
         from allura.model.repo_refresh import unknown_commit_ids as unknown_commit_ids_repo
-        return unknown_commit_ids_repo(self.all_commit_ids())
+        return unknown_commit_ids_repo(self.all_commit_ids(), self)
 
     def refresh(self, all_commits=False, notify=True, new_clone=False):
         '''Find any new commits in the repository and update'''
@@ -943,7 +946,11 @@ def can_merge_task_status(self):
     Field('_id', S.ObjectId()),
     Field('commit_id', str),
     Field('path', str),
+    # id of the tree at this path in commit_id; lets browsing find the LCD
+    # without asking the SCM which commit last changed the path
+    Field('tree_id', str, if_missing=None),
     Index('commit_id', 'path'),
+    Index('tree_id', 'path'),
     Field('entries', [dict(
         name=str,
         commit_id=str)]))
@@ -1519,6 +1526,11 @@ def diff(cls, v0, v1):
         return differ.get_opcodes()
 
 
+# most LCDs with the same tree id and path that LastCommit._from_index looks
+# through for one of the current repo's
+LCD_INDEX_CANDIDATES = 20
+
+
 class LastCommit(RepoObject):
 
     def __repr__(self):
@@ -1549,11 +1561,44 @@ def _prev_commit_id(cls, commit, path):
         except StopIteration:
             return None
 
+    @classmethod
+    def _from_index(cls, tree, path):
+        '''
+        Look up the LCD for this tree by its tree id, without asking the SCM
+        which commit last changed the path.
+
+        Only done for repos whose LCDs have all been computed during refresh
+        (or backfilled by refresh_last_commits), so that an LCD for this
+        tree's contents at this path is known to exist.  If more than one
+        commit produced the same tree at this path (e.g. a revert), we can't
+        tell which one applies and return None.  The same tree may also be in
+        other repos (forks, vendored or copied directories), so only LCDs of
+        this repo's commits count.
+        '''
+        repo = getattr(tree, 'repo', None)
+        if getattr(repo, 'lcd_index_complete', False) is not True:
+            return None
+        lcds = cls.query.find(dict(tree_id=tree._id, path=path)).limit(
+            LCD_INDEX_CANDIDATES).all()
+        if not lcds or len(lcds) == LCD_INDEX_CANDIDATES:
+            return None
+        ours = CommitDoc.m.find(
+            dict(_id={'$in': [lcd.commit_id for lcd in lcds]}, repo_ids=repo._id),
+            {'_id': 1}, validate=False)
+        ours = set(ci._id for ci in ours)
+        lcds = [lcd for lcd in lcds if lcd.commit_id in ours]
+        if len(lcds) == 1:
+            return lcds[0]
+        return None
+
     @classmethod
     def get(cls, tree):
         '''Find or build the LastCommitDoc for the given tree.'''
         cache = getattr(c, 'model_cache', '') or ModelCache()
         path = tree.path().strip('/')
+        lcd = cls._from_index(tree, path)
+        if lcd is not None:
+            return lcd
         last_commit_id = cls._last_commit_id(tree.commit, path)
         lcd = cache.get(cls, {'path': path, 'commit_id': last_commit_id})
         if lcd is None:
@@ -1605,6 +1650,7 @@ def _build(cls, tree):
         lcd = cls(
             commit_id=tree.commit._id,
             path=path,
+            tree_id=tree._id,
             entries=entries,
         )
         model_cache.set(cls, {'path': path, 'commit_id': tree.commit._id}, lcd)
@@ -1627,7 +1673,7 @@ class ModelCache(object):
     for a series of several new commits.
     '''
 
-    def __init__(self, max_instances=None, max_queries=None):
+    def __init__(self, max_instances=None, max_queries=None, shared=None):
         '''
         By default, each model type can have 2000 instances and
         8000 queries.  You can override these for specific model
@@ -1638,6 +1684,10 @@ def __init__(self, max_instances=None, max_queries=None):
 
         If you pass in a number instead of a dict, that value will
         be used as the max for all classes.
+
+        Cache misses are looked up in the process-wide
+        SharedModelCache (if enabled) before going to mongo.  Pass
+        shared=False to skip it, or a SharedModelCache to use that one.
         '''
         max_instances_default = 2000
         max_queries_default = 8000
@@ -1657,6 +1707,9 @@ def __init__(self, max_instances=None, max_queries=None):
         self._instance_cache = defaultdict(OrderedDict)  # keyed by _id
         self._synthetic_ids = defaultdict(set)
         self._synthetic_id_queries = defaultdict(set)
+        if shared is None:
+            shared = SharedModelCache.instance()
+        self._shared = shared or None
 
     def _normalize_query(self, query):
         _query = query
@@ -1677,18 +1730,43 @@ def get(self, cls, query):
         _query = self._normalize_query(query)
         self._touch(cls, _query)
         if _query not in self._query_cache[cls]:
-            val = self._model_query(cls).get(**query)
+            val = self._load(cls, query, _query)
             self.set(cls, _query, val)
             return val
         _id = self._query_cache[cls][_query]
         if _id is None:
             return None
         if _id not in self._instance_cache[cls]:
-            val = self._model_query(cls).get(**query)
+            val = self._load(cls, query, _query)
             self.set(cls, _query, val)
             return val
         return self._instance_cache[cls][_id]
 
+    def _load(self, cls, query, _query):
+        shared = self._shared if cls in SharedModelCache.classes else None
+        if shared is not None:
+            doc = shared.get(cls, _query)
+            if doc is not None:
+                return self._from_doc(cls, doc)
+        val = self._model_query(cls).get(**query)
+        if shared is not None and val is not None:
+            st = state(val)
+            # only share what's in mongo, not new or modified objects
+            if st.status == st.clean and st.original_document is not None:
+                shared.set(cls, _query, st.original_document)
+        return val
+
+    def _from_doc(self, cls, doc):
+        '''Same as loading doc through a query on cls's session'''
+        sess = session(cls)
+        obj = sess.imap.get(cls, doc['_id'])
+        if obj is None:
+            obj = mapper(cls).create(doc, {})
+            st = state(obj)
+            st.status = st.clean
+            sess.save(obj)
+        return obj
+
     def set(self, cls, query, val):
         _query = self._normalize_query(query)
         if val is not None:
@@ -1799,6 +1877,42 @@ def batch_load(self, cls, query, attrs=None):
             self.set(cls, keys, result)
 
 
+class SharedModelCache(utils.LRUCache):
+
+    '''
+    Process-wide second tier under ModelCache, shared by all threads.
+
+    Only used for Tree: a tree document is keyed by the hash of its contents
+    and never updated, so a cached one can't go stale (refreshrepo --clean
+    deletes trees, but a refresh writes them back identical).  Commits and
+    last commit data are left out, since they are updated after they're
+    written (repo_ids, child_ids and tree_id are added to during a refresh)
+    and deleted by refresh_last_commits --clean, in other processes this
+    cache couldn't hear about.  Holds the BSON of each document, and
+    evicts least recently used entries to keep the total under
+    model_cache.shared.max_bytes (0, the default, disables it).
+    '''
+
+    classes = ()  # set at the bottom of the module
+    config_key = 'model_cache.shared.max_bytes'
+    timer_name = 'model_cache.shared'
+
+    def get(self, cls, query):
+        return utils.LRUCache.get(self, (cls, query))
+
+    def set(self, cls, query, doc):
+        utils.LRUCache.set(self, (cls, query), doc)
+
+    def dump(self, doc):
+        return bson.BSON.encode(doc)
+
+    def load(self, data):
+        return bson.BSON(data).decode()
+
+    def sizeof(self, data):
+        return len(data)
+
+
 class GitLikeTree(object):
 
     '''
@@ -1945,3 +2059,4 @@ def zipdir(source, zipfile, exclude=None):
 mapper(Tree, TreeDoc, repository_orm_session)
 mapper(LastCommit, LastCommitDoc, repository_orm_session)
 Mapper.compile_all()
+SharedModelCache.classes = (Tree,)
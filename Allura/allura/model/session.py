@@ -17,9 +17,12 @@
 
 import logging
 import pymongo
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
-from ming import Session
+import tg
+from paste.deploy.converters import asint
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+from ming import Session, mim
 from ming.orm.base import state
 from ming.orm.ormsession import ThreadLocalORMSession, SessionExtension
 from contextlib import contextmanager
@@ -110,25 +113,62 @@ def after_flush(self, obj=None):
         super(IndexerSessionExtension, self).after_flush(obj)
 
 
+class ProjectRoleSessionExtension(SessionExtension):
+
+    """
+    Bumps the role version of projects whose
+    :class:`~allura.model.auth.ProjectRole` docs are written, so that their
+    roles are no longer served from the
+    :class:`~allura.lib.security.RoleGraphCache`.
+    """
+
+    def __init__(self, session):
+        SessionExtension.__init__(self, session)
+        self.removed_from = []
+
+    def _is_role(self, cls):
+        return '%s.%s' % (cls.__module__, cls.__name__) == 'allura.model.auth.ProjectRole'
+
+    def _changed(self, obj):
+        if self._is_role(type(obj)):
+            from allura.lib.security import bump_role_versions
+            bump_role_versions([obj.project_id])
+
+    def after_insert(self, obj, st):
+        self._changed(obj)
+
+    def after_update(self, obj, st):
+        self._changed(obj)
+
+    def after_delete(self, obj, st):
+        self._changed(obj)
+
+    def before_remove(self, cls, *args, **kwargs):
+        if self._is_role(cls):
+            spec = args[0] if args else {}
+            roles = self.session.impl.db[cls.__mongometa__.name]
+            self.removed_from = roles.find(spec).distinct('project_id')
+
+    def after_remove(self, cls, *args, **kwargs):
+        if self.removed_from:
+            from allura.lib.security import bump_role_versions
+            bump_role_versions(self.removed_from)
+            self.removed_from = []
+
+
 class ArtifactSessionExtension(ManagedSessionExtension):
 
     def after_flush(self, obj=None):
         "Update artifact references, and add/update this artifact to solr"
         if not getattr(self.session, 'disable_index', False):
-            from pylons import app_globals as g
             from .index import ArtifactReference, Shortlink
-            from .session import main_orm_session
             # Ensure artifact references & shortlinks exist for new objects
             arefs = []
             try:
-                arefs = [
-                    ArtifactReference.from_artifact(o)
-                    for o in self.objects_added + self.objects_modified
-                    if _needs_update(o)]
-                for obj in self.objects_added + self.objects_modified:
-                    Shortlink.from_artifact(obj)
-                # Flush shortlinks
-                main_orm_session.flush()
+                arefs = ArtifactReference.from_artifacts([
+                    o for o in self.objects_added + self.objects_modified
+                    if _needs_update(o)])
+                Shortlink.from_artifacts(self.objects_added + self.objects_modified)
             except Exception:
                 log.exception(
                     "Failed to update artifact references. Is this a borked project migration?")
@@ -141,7 +181,9 @@ def update_index(self, objects_deleted, arefs):
             index_tasks.del_artifacts.post(
                 [obj.index_id() for obj in objects_deleted])
         if arefs:
-            index_tasks.add_artifacts.post([aref._id for aref in arefs])
+            # fold into a pending add_artifacts task for this project/app, if any
+            index_tasks.add_artifacts.post([aref._id for aref in arefs],
+                                           dedupe_key='artifacts', dedupe='union')
 
 
 class BatchIndexer(ArtifactSessionExtension):
@@ -220,6 +262,92 @@ def _post(cls, task_func, chunk):
                 raise
 
 
+class RefreshBatch(object):
+
+    '''
+    Buffers writes (of refreshed commits, artifact references, etc.) and
+    sends them to Mongo as unordered bulk operations, batch_size
+    (scm.refresh.batch_size) operations at a time.
+
+    Each flush writes the document classes in the order the batch first saw
+    them, so adding a commit's trees before the commit itself means an
+    interrupted refresh never leaves a commit without its trees, and the
+    commit is simply refreshed again on the next run.  Use a separate batch
+    when that order differs.
+
+    As with single writes, an upsert racing with another refresh (forks share
+    commits, trees and LCDs) may fail with a duplicate key error.  Those are
+    ignored, since the other refresh wrote the same document.
+    '''
+
+    def __init__(self, batch_size=None):
+        if batch_size is None:
+            batch_size = asint(tg.config.get('scm.refresh.batch_size', 500))
+        self.batch_size = max(batch_size, 1)
+        self._ops = OrderedDict()
+        self.pending = 0
+        self.written = 0
+        self.flushes = 0
+
+    def upsert(self, cls, _id, fields, overwrite=False):
+        '''Insert the document with the given _id.  If it already exists, set
+        the given fields when overwrite is true and leave it alone otherwise'''
+        op = '$set' if overwrite else '$setOnInsert'
+        self._add(cls, (dict(_id=_id), {op: fields}, True, False))
+
+    def update(self, cls, spec, updates):
+        '''Update all documents matching spec'''
+        self._add(cls, (spec, updates, False, True))
+
+    def _add(self, cls, op):
+        self._ops.setdefault(cls, []).append(op)
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        for cls, ops in self._ops.iteritems():
+            if ops:
+                self._write(cls.m.collection, ops)
+                self.written += len(ops)
+                del ops[:]
+        self.pending = 0
+        self.flushes += 1
+
+    def _write(self, coll, ops):
+        if isinstance(coll, mim.Collection):
+            # no bulk API or $setOnInsert, write them one at a time
+            for spec, updates, upsert, multi in ops:
+                if '$setOnInsert' in updates:
+                    try:
+                        coll.insert(dict(updates['$setOnInsert'], **spec))
+                    except DuplicateKeyError:
+                        pass
+                else:
+                    coll.update(spec, updates, upsert=upsert, multi=multi)
+            return
+        bulk = coll.initialize_unordered_bulk_op()
+        for spec, updates, upsert, multi in ops:
+            op = bulk.find(spec)
+            if upsert:
+                op = op.upsert()
+            if multi:
+                op.update(updates)
+            else:
+                op.update_one(updates)
+        try:
+            bulk.execute()
+        except BulkWriteError as e:
+            details = e.details or {}
+            if details.get('writeConcernErrors') or any(
+                    err.get('code') != 11000 for err in details.get('writeErrors', [])):
+                raise
+            log.debug('Ignored %d duplicate key errors writing to %s',
+                      len(details.get('writeErrors', [])), coll.name)
+
+
 @contextmanager
 def substitute_extensions(session, extensions=None):
     """
@@ -249,7 +377,7 @@ def substitute_extensions(session, extensions=None):
 task_doc_session = Session.by_name('task')
 main_orm_session = ThreadLocalORMSession(
     doc_session=main_doc_session,
-    extensions=[IndexerSessionExtension]
+    extensions=[IndexerSessionExtension, ProjectRoleSessionExtension]
     )
 project_orm_session = ThreadLocalORMSession(
     doc_session=project_doc_session,
@@ -35,6 +35,11 @@ class __mongometa__:
     hook_url = FieldProperty(str)
     secret = FieldProperty(str)
     last_sent = FieldProperty(dt.datetime, if_missing=None)
+    # delivery attempts and their total time in seconds, see record_delivery()
+    delivered = FieldProperty(int, if_missing=0)
+    failed = FieldProperty(int, if_missing=0)
+    latency = FieldProperty(float, if_missing=0.0)
+    last_latency = FieldProperty(float, if_missing=None)
 
     def url(self):
         app = self.app_config.load()
@@ -56,6 +61,23 @@ def update_limit(self):
         self.last_sent = dt.datetime.utcnow()
         session(self).flush(self)
 
+    def record_delivery(self, ok, latency):
+        '''Count an attempt to send the webhook, which took ``latency``
+        seconds.  Updated atomically, since several tasks may be sending.'''
+        Webhook.query.update({'_id': self._id}, {
+            '$inc': {'delivered' if ok else 'failed': 1, 'latency': latency},
+            '$set': {'last_latency': latency},
+        })
+
+    def delivery_stats(self):
+        attempts = self.delivered + self.failed
+        return {
+            'delivered': self.delivered,
+            'failed': self.failed,
+            'avg_latency': self.latency / attempts if attempts else None,
+            'last_latency': self.last_latency,
+        }
+
     @classmethod
     def max_hooks(self, type, tool_name):
         type = type.replace('-', '_')
@@ -69,4 +91,5 @@ def __json__(self):
             'type': unicode(self.type),
             'hook_url': unicode(self.hook_url),
             'mod_date': self.mod_date,
+            'delivery': self.delivery_stats(),
         }
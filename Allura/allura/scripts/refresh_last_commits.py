@@ -47,7 +47,9 @@ def _repo_type_list(s):
             return repo_types
         parser = argparse.ArgumentParser(description='Using existing commit data, '
                                          'refresh the last commit metadata in MongoDB. Run for all repos (no args), '
-                                         'or restrict by neighborhood, project, or code tool mount point.')
+                                         'or restrict by neighborhood, project, or code tool mount point.  '
+                                         'Also backfills the tree index of existing last commit data, so that '
+                                         'browsing repos no longer needs to query the SCM.')
         parser.add_argument('--nbhd', action='store', default='', dest='nbhd',
                             help='Restrict update to a particular neighborhood, e.g. /p/.')
         parser.add_argument(
@@ -120,7 +122,11 @@ def execute(cls, options):
 
                         log.info('Refreshing all last commits in %r',
                                  c.app.repo)
-                        cls.refresh_repo_lcds(ci_ids, options)
+                        complete = cls.refresh_repo_lcds(ci_ids, options)
+                        if complete and not options.limit:
+                            log.info('Last commit index complete for %r', c.app.repo)
+                            c.app.repo.lcd_index_complete = True
+                            ThreadLocalORMSession.flush_all()
                         new_commit_ids = app.repo.unknown_commit_ids()
                         if len(new_commit_ids) > 0:
                             refresh.post()
@@ -134,6 +140,8 @@ def execute(cls, options):
 
     @classmethod
     def refresh_repo_lcds(cls, commit_ids, options):
+        '''Compute the LCDs of ``commit_ids``.  Returns False if any of them
+        had to be skipped.'''
         tree_cache = {}
         timings = []
         model_cache = M.repository.ModelCache(
@@ -142,11 +150,13 @@ def refresh_repo_lcds(cls, commit_ids, options):
         )
         lcid_cache = {}
         timings = []
+        complete = True
         print 'Processing last commits'
         for i, commit_id in enumerate(commit_ids):
             commit = M.repository.Commit.query.get(_id=commit_id)
             if commit is None:
                 print "Commit missing, skipping: %s" % commit_id
+                complete = False
                 continue
             commit.set_context(c.app.repo)
             with time(timings):
@@ -157,6 +167,7 @@ def refresh_repo_lcds(cls, commit_ids, options):
             if options.limit and i >= options.limit:
                 break
         ThreadLocalORMSession.flush_all()
+        return complete
 
     @classmethod
     def _clean(cls, commit_ids):
@@ -86,6 +86,7 @@ def execute(cls, options):
                                 log.info("Deleting %i CommitDoc docs...", i)
                                 M.repository.CommitDoc.m.remove(
                                     {"_id": {"$in": ci_ids_chunk}})
+                                M.repo_refresh.known_commit_ids.discard(ci_ids_chunk)
 
                         # delete these in chunks, otherwise the query doc can
                         # exceed the max BSON size limit (16MB at the moment)
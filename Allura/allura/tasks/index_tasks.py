@@ -77,28 +77,25 @@ def add_artifacts(ref_ids, update_solr=True, update_refs=True, solr_hosts=None):
     :type solr_hosts: [str]
     '''
     from allura import model as M
-    from allura.lib.search import find_shortlinks
 
     exceptions = []
     solr_updates = []
     with _indexing_disabled(M.session.artifact_orm_session._get()):
-        for ref in M.ArtifactReference.query.find(dict(_id={'$in': ref_ids})):
+        refs = M.ArtifactReference.query.find(dict(_id={'$in': ref_ids})).all()
+        for ref in M.ArtifactReference.load_artifacts(refs):
             try:
                 artifact = ref.artifact
                 if artifact is None:
                     continue
-                s = artifact.solarize()
+                # shortlinks come from the same markdown render as the solr text
+                find_links = update_refs and not isinstance(artifact, M.Snapshot)
+                shortlinks = [] if find_links else None
+                s = artifact.solarize(shortlinks=shortlinks)
                 if s is None:
                     continue
                 if update_solr:
                     solr_updates.append(s)
-                if update_refs:
-                    if isinstance(artifact, M.Snapshot):
-                        continue
-                    # Find shortlinks in the raw text, not the escaped html
-                    # created by the `solarize()`.
-                    link_text = artifact.index().get('text') or ''
-                    shortlinks = find_shortlinks(link_text)
+                if find_links:
                     ref.references = [link.ref_id for link in shortlinks]
             except Exception:
                 log.error('Error indexing artifact %s', ref._id)
@@ -15,6 +15,7 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import time
 import logging
 import HTMLParser
 
@@ -95,6 +96,7 @@ def sendmail(fromaddr, destinations, text, reply_to, subject,
 
     '''
     from allura import model as M
+    start = time.time()
     addrs_plain = []
     addrs_html = []
     addrs_multi = []
@@ -108,50 +110,75 @@ def sendmail(fromaddr, destinations, text, reply_to, subject,
             fromaddr = g.noreply
         else:
             fromaddr = user.email_address_header()
+    # Look up all the users at once
+    user_ids = []
+    for addr in destinations:
+        if mail_util.isvalid(addr):
+            continue
+        try:
+            user_ids.append(ObjectId(addr))
+        except:
+            log.exception('Error looking up user with ID: %r' % addr)
+    users = M.User.query.find(dict(
+        _id={'$in': user_ids}, disabled=False, pending=False))
+    users = dict((u._id, u) for u in users)
     # Divide addresses based on preferred email formats
     for addr in destinations:
         if mail_util.isvalid(addr):
             addrs_plain.append(addr)
+            continue
+        try:
+            user = users.get(ObjectId(addr))
+        except:
+            continue  # logged above
+        if not user:
+            log.warning('Cannot find user with ID: %s', addr)
+            continue
+        addr = user.email_address_header()
+        if not addr and user.email_addresses:
+            addr = user.email_addresses[0]
+            log.warning(
+                'User %s has not set primary email address, using %s',
+                user._id, addr)
+        if not addr:
+            log.error(
+                "User %s (%s) has not set any email address, can't deliver",
+                user._id, user.username)
+            continue
+        if user.get_pref('email_format') == 'plain':
+            addrs_plain.append(addr)
+        elif user.get_pref('email_format') == 'html':
+            addrs_html.append(addr)
         else:
-            try:
-                user = M.User.query.get(_id=ObjectId(addr), disabled=False, pending=False)
-                if not user:
-                    log.warning('Cannot find user with ID: %s', addr)
-                    continue
-            except:
-                log.exception('Error looking up user with ID: %r' % addr)
-                continue
-            addr = user.email_address_header()
-            if not addr and user.email_addresses:
-                addr = user.email_addresses[0]
-                log.warning(
-                    'User %s has not set primary email address, using %s',
-                    user._id, addr)
-            if not addr:
-                log.error(
-                    "User %s (%s) has not set any email address, can't deliver",
-                    user._id, user.username)
-                continue
-            if user.get_pref('email_format') == 'plain':
-                addrs_plain.append(addr)
-            elif user.get_pref('email_format') == 'html':
-                addrs_html.append(addr)
-            else:
-                addrs_multi.append(addr)
-    htmlparser = HTMLParser.HTMLParser()
-    plain_msg = mail_util.encode_email_part(htmlparser.unescape(text), 'plain')
-    html_text = g.forge_markdown(email=True).convert(text)
-    html_msg = mail_util.encode_email_part(html_text, 'html')
-    multi_msg = mail_util.make_multipart_message(plain_msg, html_msg)
-    smtp_client.sendmail(
-        addrs_multi, fromaddr, reply_to, subject, message_id,
-        in_reply_to, multi_msg, sender=sender, references=references)
-    smtp_client.sendmail(
-        addrs_plain, fromaddr, reply_to, subject, message_id,
-        in_reply_to, plain_msg, sender=sender, references=references)
-    smtp_client.sendmail(
-        addrs_html, fromaddr, reply_to, subject, message_id,
-        in_reply_to, html_msg, sender=sender, references=references)
+            addrs_multi.append(addr)
+    # Render each format once, and only if someone gets it
+    if addrs_plain or addrs_multi:
+        htmlparser = HTMLParser.HTMLParser()
+        plain_msg = mail_util.encode_email_part(htmlparser.unescape(text), 'plain')
+    if addrs_html or addrs_multi:
+        html_text = g.forge_markdown(email=True).convert(text)
+        html_msg = mail_util.encode_email_part(html_text, 'html')
+    sent = 0
+    if addrs_multi:
+        multi_msg = mail_util.make_multipart_message(plain_msg, html_msg)
+        smtp_client.sendmail(
+            addrs_multi, fromaddr, reply_to, subject, message_id,
+            in_reply_to, multi_msg, sender=sender, references=references)
+        sent += len(addrs_multi)
+    if addrs_plain:
+        smtp_client.sendmail(
+            addrs_plain, fromaddr, reply_to, subject, message_id,
+            in_reply_to, plain_msg, sender=sender, references=references)
+        sent += len(addrs_plain)
+    if addrs_html:
+        smtp_client.sendmail(
+            addrs_html, fromaddr, reply_to, subject, message_id,
+            in_reply_to, html_msg, sender=sender, references=references)
+        sent += len(addrs_html)
+    if sent:
+        elapsed = time.time() - start
+        log.info('Sent %s to %s of %s destinations in %.3fs (%.1f recipients/sec)',
+                 message_id, sent, len(destinations), elapsed, sent / max(elapsed, 0.001))
 
 
 @task
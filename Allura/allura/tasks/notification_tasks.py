@@ -15,6 +15,11 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+from pylons import tmpl_context as c
+from tg import config
+from paste.deploy.converters import asint
+
+from allura.lib import helpers as h
 from allura.lib.decorators import task
 
 
@@ -22,4 +27,18 @@
 def notify(n_id, ref_id, topic):
     from allura import model as M
     M.Mailbox.deliver(n_id, ref_id, topic)
-    M.Mailbox.fire_ready()
+    shards = asint(config.get('notification.fire_shards', 1))
+    if shards <= 1:
+        M.Mailbox.fire_ready()
+        return
+    # fire the shards in parallel on other workers; mailboxes of all
+    # projects are fired, so pending runs are shared by all projects
+    with h.push_config(c, project=None, app=None):
+        for shard in range(shards):
+            fire_ready.post(shard, shards, dedupe_key='%s/%s' % (shard, shards))
+
+
+@task
+def fire_ready(shard=0, shards=1):
+    from allura import model as M
+    M.Mailbox.fire_ready(shard, shards)
@@ -85,7 +85,7 @@ def refresh(**kwargs):
         # during refresh and re-queue task if so
         new_commit_ids = c.app.repo.unknown_commit_ids()
         if len(new_commit_ids) > 0:
-            refresh.post()
+            refresh.post(dedupe_key=str(c.app.config._id))
             log.info('New refresh task is queued due to new commit(s).')
     else:
         log.info('Refresh task for %s:%s skipped due to backlog',
@@ -98,6 +98,7 @@ def uninstall(**kwargs):
     repo = c.app.repo
     if repo is not None:
         shutil.rmtree(repo.full_fs_path, ignore_errors=True)
+        M.repo_refresh.known_commit_ids.clear(repo._id)
         repo.delete()
     M.MergeRequest.query.remove(dict(
         app_config_id=c.app.config._id))
@@ -142,6 +142,51 @@ def test_artifactlink():
     assert q_shortlink.count() == 0
 
 
+@with_setup(setUp, tearDown)
+def test_from_artifacts():
+    pages = [WM.Page(title='BulkPage%d' % i) for i in range(3)]
+    ThreadLocalORMSession.flush_all()
+    ref_ids = [pg.index_id() for pg in pages]
+    assert_equal(M.ArtifactReference.query.find(dict(_id={'$in': ref_ids})).count(), 3)
+    assert_equal(sorted(sl.link for sl in M.Shortlink.query.find(dict(ref_id={'$in': ref_ids}))),
+                 ['BulkPage0', 'BulkPage1', 'BulkPage2'])
+
+    # nothing changed, nothing written
+    with patch('allura.model.session.RefreshBatch._write') as write:
+        refs = M.ArtifactReference.from_artifacts(pages + pages[:1])
+        M.Shortlink.from_artifacts(pages)
+    assert not write.called
+    assert_equal([ref._id for ref in refs], ref_ids + ref_ids[:1])
+
+    pages[1].title = 'BulkPageRenamed'
+    ThreadLocalORMSession.flush_all()
+    links = dict((sl.ref_id, sl.link)
+                 for sl in M.Shortlink.query.find(dict(ref_id={'$in': ref_ids}), refresh=True))
+    assert_equal(len(links), 3)
+    assert_equal(links[ref_ids[1]], 'BulkPageRenamed')
+
+
+@with_setup(setUp, tearDown)
+def test_artifactreference_load_artifacts():
+    pages = [WM.Page(title='LoadPage%d' % i) for i in range(3)]
+    ThreadLocalORMSession.flush_all()
+    refs = [M.ArtifactReference.from_artifact(pg) for pg in pages]
+    missing = M.ArtifactReference(
+        _id='missing', artifact_reference=dict(refs[0].artifact_reference,
+                                               artifact_id=ObjectId()))
+    ref_ids = [ref._id for ref in refs] + [missing._id]
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    refs = M.ArtifactReference.query.find(dict(_id={'$in': ref_ids})).all()
+    with patch('allura.model.index.h.push_context', wraps=h.push_context) as push_context:
+        M.ArtifactReference.load_artifacts(refs)
+        assert_equal(push_context.call_count, 1)
+        assert_equal(sorted(ref.artifact.title for ref in refs if ref.artifact),
+                     ['LoadPage0', 'LoadPage1', 'LoadPage2'])
+        assert_equal([ref.artifact for ref in refs if ref._id == 'missing'], [None])
+        assert_equal(push_context.call_count, 1)
+
+
 @with_setup(setUp, tearDown)
 def test_gen_messageid():
     assert re.match(r'[0-9a-zA-Z]*.wiki@test.p.localhost',
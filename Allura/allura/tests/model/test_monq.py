@@ -16,11 +16,16 @@
 #       under the License.
 
 import pprint
-from nose.tools import with_setup
+from datetime import datetime, timedelta
+from nose.tools import with_setup, assert_equal
+import mock
+import pymongo
+from tg import config
 
 from ming.orm import ThreadLocalORMSession
 
 from alluratest.controller import setup_basic_test, setup_global_objects
+from allura.lib import helpers as h
 from allura import model as M
 
 
@@ -40,3 +45,290 @@ def test_basic_task():
     assert task
     task()
     assert task.result == 'I[5, 6]', task.result
+
+
+@with_setup(setUp)
+def test_notifier_unavailable_falls_back_to_sleep():
+    notifier = M.MonQNotifier()
+    notifier.available = False
+    assert not notifier.start()
+    with mock.patch('allura.model.monq_model.time.sleep') as sleep:
+        assert not notifier.wait(5)
+    sleep.assert_called_once_with(5)
+
+
+class FakeCappedCollection(object):
+
+    '''Just enough of a capped collection for MonQNotifier.  Its _ids
+    decrease, like ObjectIds from clients whose clocks are behind.'''
+
+    def __init__(self, max_docs=100):
+        self.docs = []
+        self.max_docs = max_docs
+
+    def insert(self, doc):
+        self.docs.append(dict(doc, _id=-len(self.docs)))
+        del self.docs[:-self.max_docs]
+
+    def find(self, sort=None, limit=None, **kw):
+        docs = list(self.docs)
+        if sort and sort[0] == ('$natural', pymongo.DESCENDING):
+            docs.reverse()
+        return FakeCursor(docs[:limit])
+
+
+class FakeCursor(object):
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.alive = True
+
+    def __iter__(self):
+        for doc in self.docs:
+            yield doc
+        self.alive = False
+
+
+@mock.patch('allura.model.monq_model.time.sleep')
+def test_notifier_wakes(sleep):
+    notifier = M.MonQNotifier()
+    notifier.available = True
+    notifier._collection = FakeCappedCollection()
+    notifier.collection.insert(dict(task_name=None))
+    notifier.collection.insert(dict(task_name='pprint.pformat'))
+    assert notifier.start()
+    # notifications from before start() don't wake it
+    assert not notifier.wait(0.01)
+    notifier.notify('pprint.pformat')
+    assert notifier.wait(0.01)
+    assert not notifier.wait(0.01)
+    # only for the tasks it's waiting for
+    notifier.notify('pprint.pprint')
+    assert not notifier.wait(0.01, only=['pprint.pformat'])
+    notifier.notify('pprint.pformat')
+    assert notifier.wait(0.01, only=['pprint.pformat'])
+
+
+@mock.patch('allura.model.monq_model.time.sleep')
+def test_notifier_wraps(sleep):
+    notifier = M.MonQNotifier()
+    notifier.available = True
+    notifier._collection = FakeCappedCollection(max_docs=2)
+    notifier.collection.insert(dict(task_name=None))
+    assert notifier.start()
+    # what it saw last is gone, so it can't tell what's new
+    notifier.notify('pprint.pprint')
+    notifier.notify('pprint.pprint')
+    assert notifier.wait(0.01, only=['pprint.pformat'])
+    assert not notifier.wait(0.01)
+
+
+@mock.patch('allura.model.monq_model.time')
+def test_notifier_tail_error_falls_back_to_sleep(time):
+    time.time.return_value = 100
+    notifier = M.MonQNotifier()
+    notifier.available = True
+    notifier._collection = FakeCappedCollection()
+    assert notifier.start()
+    with mock.patch.object(notifier, '_tail') as _tail:
+        _tail.side_effect = pymongo.errors.OperationFailure('cursor killed')
+        assert not notifier.wait(5)
+    time.sleep.assert_called_once_with(5)
+    # and tails again next time
+    notifier.notify('pprint.pformat')
+    time.time.side_effect = [100, 100, 100, 200]
+    assert notifier.wait(5)
+
+
+@with_setup(setUp)
+def test_post_notifies():
+    # test.ini turns notifications off
+    with h.push_config(config, **{'monq.notify': 'true'}):
+        notifier = M.MonQNotifier()
+    assert notifier.available
+    notifier._collection = FakeCappedCollection()
+    with mock.patch.object(M.MonQNotifier, '_instance', notifier):
+        M.MonQTask.post(pprint.pformat, ([5, 6],))
+        M.MonQTask.post(pprint.pformat, ([5, 6],), delay=60)
+    # delayed tasks aren't ready yet
+    assert_equal([doc['task_name'] for doc in notifier.collection.docs],
+                 ['pprint.pformat'])
+
+
+@with_setup(setUp)
+def test_get_batch():
+    M.MonQTask.post(pprint.pformat, ([1],))
+    M.MonQTask.post(pprint.pformat, ([2],))
+    M.MonQTask.post(pprint.pformat, ([3],))
+    M.MonQTask.post(pprint.pprint, ([4],))
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    tasks = M.MonQTask.get_batch(5, process='batch')
+    assert_equal([t.task_name for t in tasks], ['pprint.pformat'] * 3)
+    assert_equal([t.state for t in tasks], ['busy'] * 3)
+    for t in tasks:
+        t()
+    assert_equal([t.state for t in tasks], ['complete'] * 3)
+    assert_equal(M.MonQTask.query.find(dict(state='ready')).count(), 1)
+
+
+@with_setup(setUp)
+def test_get_batch_release():
+    M.MonQTask.post(pprint.pformat, ([1],))
+    M.MonQTask.post(pprint.pformat, ([2],))
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    tasks = M.MonQTask.get_batch(2, process='batch')
+    assert_equal(len(tasks), 2)
+    M.MonQTask.release(tasks[1:])
+    assert_equal(M.MonQTask.query.find(dict(state='ready')).count(), 1)
+
+
+@with_setup(setUp)
+def test_timeout_tasks():
+    for i in range(3):
+        M.MonQTask.post(pprint.pformat, ([i],))
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    started, claimed, ready = M.MonQTask.query.find().sort('_id').all()
+    now = datetime.utcnow()
+    M.MonQTask.query.update({'_id': started._id}, {'$set': dict(
+        state='busy', time_claimed=now - timedelta(hours=2),
+        time_start=now - timedelta(hours=1))})
+    # claimed by a worker that was killed before starting it
+    M.MonQTask.query.update({'_id': claimed._id}, {'$set': dict(
+        state='busy', time_claimed=now - timedelta(hours=1), time_start=None)})
+    M.MonQTask.timeout_tasks(now - timedelta(hours=2))
+    assert_equal(M.MonQTask.query.find(dict(state='ready')).count(), 1)
+    M.MonQTask.timeout_tasks(now - timedelta(minutes=30))
+    assert_equal(M.MonQTask.query.find(dict(state='ready')).count(), 3)
+
+
+@with_setup(setUp)
+def test_timeout_while_batched():
+    M.MonQTask.post(pprint.pformat, ([1],))
+    M.MonQTask.post(pprint.pformat, ([2],))
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    first, second = M.MonQTask.get_batch(2, process='w1')
+    assert first.mark_started()
+    # the second one times out while the first one runs, and is taken by
+    # another worker
+    now = datetime.utcnow()
+    M.MonQTask.query.update({'_id': second._id}, {'$set': dict(
+        time_claimed=now - timedelta(hours=1))})
+    M.MonQTask.timeout_tasks(now - timedelta(minutes=30))
+    ThreadLocalORMSession.close_all()
+    assert_equal(M.MonQTask.get(process='w2', only=['pprint.pformat'])._id, second._id)
+    assert not second.mark_started()
+    ThreadLocalORMSession.close_all()
+    other = M.MonQTask.query.get(_id=second._id)
+    assert_equal(other.process, 'w2')
+    assert other.mark_started()
+    assert not other.mark_started()
+
+
+@with_setup(setUp)
+def test_get_batch_claim_time():
+    M.MonQTask.post(pprint.pformat, ([1],))
+    M.MonQTask.post(pprint.pformat, ([2],))
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    tasks = M.MonQTask.get_batch(2, process='batch')
+    assert_equal(len(tasks), 2)
+    for t in tasks:
+        assert t.time_claimed is not None
+        assert_equal(t.time_start, None)
+    # the worker dies without starting them
+    M.MonQTask.timeout_tasks(datetime.utcnow() + timedelta(seconds=1))
+    assert_equal(M.MonQTask.query.find(dict(state='ready')).count(), 2)
+
+
+@with_setup(setUp)
+def test_post_dedupe_replace():
+    t1 = M.MonQTask.post(pprint.pformat, ([1],), dedupe_key='k')
+    t2 = M.MonQTask.post(pprint.pformat, ([2],), dedupe_key='k')
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    assert_equal(t1._id, t2._id)
+    assert_equal(M.MonQTask.query.get(_id=t1._id).args, [[2]])
+    assert_equal(M.MonQTask.query.find().count(), 1)
+    # different key, or a task that's no longer ready, isn't merged
+    M.MonQTask.post(pprint.pformat, ([3],), dedupe_key='other')
+    M.MonQTask.query.update({'_id': t1._id}, {'$set': dict(state='busy')})
+    M.MonQTask.post(pprint.pformat, ([4],), dedupe_key='k')
+    assert_equal(M.MonQTask.query.find().count(), 3)
+
+
+@with_setup(setUp)
+def test_post_dedupe_union():
+    t1 = M.MonQTask.post(pprint.pformat, ([1, 2],), dedupe_key='k', dedupe='union')
+    t2 = M.MonQTask.post(pprint.pformat, ([2, 3],), dedupe_key='k', dedupe='union')
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    assert_equal(t1._id, t2._id)
+    assert_equal(sorted(M.MonQTask.query.get(_id=t1._id).args[0]), [1, 2, 3])
+    assert_equal(M.MonQTask.query.find().count(), 1)
+
+
+@with_setup(setUp)
+def test_post_dedupe_union_kwargs():
+    # None is a value like any other
+    t1 = M.MonQTask.post(pprint.pformat, ([1],), dict(width=None), dedupe_key='k', dedupe='union')
+    t2 = M.MonQTask.post(pprint.pformat, ([2],), dict(width=None), dedupe_key='k', dedupe='union')
+    assert_equal(t1._id, t2._id)
+    # a list that would grow too big goes in a new task
+    with mock.patch.object(M.MonQTask, 'dedupe_union_max', 3):
+        t3 = M.MonQTask.post(pprint.pformat, ([3, 4],), dict(width=None),
+                             dedupe_key='k', dedupe='union')
+    assert t3._id != t1._id
+    ThreadLocalORMSession.close_all()
+    assert_equal(M.MonQTask.query.get(_id=t1._id).args, [[1, 2]])
+
+
+def test_union():
+    assert_equal(M.MonQTask._union([1, 2], [2, 3, 3]), [1, 2, 3])
+    assert_equal(M.MonQTask._union([dict(a=1)], [dict(a=1), dict(b=2)]), [dict(a=1), dict(b=2)])
+    assert_equal(M.MonQTask._union([1], 2), 2)
+    with mock.patch.object(M.MonQTask, 'dedupe_union_max', 2):
+        assert M.MonQTask._union([1, 2], [3]) is M.monq_model._too_big
+
+
+@mock.patch('allura.model.monq_model.mim', Database=type('Database', (object,), {}))
+@mock.patch.object(M.MonQTask, '_find_and_modify')
+def test_merge_ready_add_to_set(find_and_modify, mim):
+    context = dict(project_id=None, app_config_id=None, user_id=None,
+                   notifications_disabled=False)
+    with mock.patch.object(M.MonQTask, 'dedupe_union_max', 10):
+        M.MonQTask._merge_ready('pprint.pformat', 'k', 'union', context,
+                                ([1, 2], 'x'), dict(ids=[3]))
+        assert_equal(M.MonQTask._merge_ready('pprint.pformat', 'k', 'union', context,
+                                             (range(11),), {}), None)
+    query, update = find_and_modify.call_args_list[0][0]
+    assert_equal(query['args'], {'$size': 2})
+    assert_equal(query['args.0.8'], {'$exists': False})
+    assert_equal(query['kwargs.ids.9'], {'$exists': False})
+    assert_equal(update['$addToSet'], {'args.0': {'$each': [1, 2]},
+                                       'kwargs.ids': {'$each': [3]}})
+    assert_equal(update['$set']['args.1'], 'x')
+    assert_equal(find_and_modify.call_count, 1)
+
+
+def test_task_name_matches():
+    only = ['allura.tasks.repo_tasks.*', 'pprint.pformat']
+    assert M.MonQTask.task_name_matches('allura.tasks.repo_tasks.refresh', only)
+    assert M.MonQTask.task_name_matches('pprint.pformat', only)
+    assert not M.MonQTask.task_name_matches('pprint.pprint', only)
+    assert not M.MonQTask.task_name_matches(
+        'allura.tasks.repo_tasks.refresh', exclude=only)
+    assert M.MonQTask.task_name_matches('pprint.pprint', exclude=only)
+
+
+@with_setup(setUp)
+def test_get_only_exclude_patterns():
+    M.MonQTask.post(pprint.pformat, ([1],))
+    M.MonQTask.post(pprint.pprint, ([2],))
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    assert_equal(M.MonQTask.get(only=['pprint.pp*']).task_name, 'pprint.pprint')
+    assert_equal(M.MonQTask.get(exclude=['pprint.pp*']).task_name, 'pprint.pformat')
@@ -16,10 +16,12 @@
 #       under the License.
 
 import unittest
-from datetime import timedelta
+import logging
+from datetime import datetime, timedelta
 import collections
 
 from pylons import tmpl_context as c, app_globals as g
+from tg import config
 from nose.tools import assert_equal, assert_in
 from ming.orm import ThreadLocalORMSession
 import mock
@@ -213,6 +215,30 @@ def test_delivery(self):
         assert len(mbox.queue) == 1
         assert not mbox.queue_empty
 
+    def test_deliver(self):
+        self._subscribe()
+        self._subscribe(user=M.User.query.get(username='test-user-2'))
+        M.Mailbox.deliver('nid1', self.pg.index_id(), 'metadata')
+        # not subscribed to this artifact
+        M.Mailbox.deliver('nid2', 'other index id', 'metadata')
+        mboxes = M.Mailbox.query.find().all()
+        assert_equal([m.queue for m in mboxes], [['nid1'], ['nid1']])
+        assert_equal([m.queue_empty for m in mboxes], [False, False])
+
+    def test_deliver_fallback(self):
+        self._subscribe()
+        self._subscribe(user=M.User.query.get(username='test-user-2'))
+        # as if the multi-document update got one mailbox before it failed
+        deliver_update = M.Mailbox._deliver_update
+        M.Mailbox.query.update({}, deliver_update('nid'), multi=False)
+        with mock.patch.object(M.Mailbox, '_deliver_update') as update:
+            update.side_effect = [Exception('multi update failed'),
+                                  deliver_update('nid')]
+            M.Mailbox.deliver('nid', self.pg.index_id(), 'metadata')
+        mboxes = M.Mailbox.query.find().all()
+        assert_equal([m.queue for m in mboxes], [['nid'], ['nid']])
+        assert_equal([m.queue_empty for m in mboxes], [False, False])
+
     def test_email(self):
         self._subscribe()  # as current user: test-admin
         user2 = M.User.query.get(username='test-user-2')
@@ -235,20 +261,15 @@ def test_email(self):
         assert not mboxes[1].queue_empty
 
         email_tasks = M.MonQTask.query.find({'state': 'ready'}).all()
-        # make sure both subscribers will get an email
-        assert_equal(len(email_tasks), 2)
+        # make sure both subscribers will get an email, sent in one task
+        assert_equal(len(email_tasks), 1)
 
-        first_destinations = [e.kwargs['destinations'][0] for e in email_tasks]
-        assert_in(str(c.user._id), first_destinations)
-        assert_in(str(user2._id), first_destinations)
+        destinations = email_tasks[0].kwargs['destinations']
+        assert_equal(sorted(destinations), sorted([str(c.user._id), str(user2._id)]))
         assert_equal(email_tasks[0].kwargs['fromaddr'],
                      '"Test Admin" <test-admin@users.localhost>')
-        assert_equal(email_tasks[1].kwargs['fromaddr'],
-                     '"Test Admin" <test-admin@users.localhost>')
         assert_equal(email_tasks[0].kwargs['sender'],
                      'wiki@test.p.in.localhost')
-        assert_equal(email_tasks[1].kwargs['sender'],
-                     'wiki@test.p.in.localhost')
         assert email_tasks[0].kwargs['text'].startswith(
             'Home modified by Test Admin')
         assert 'you indicated interest in ' in email_tasks[0].kwargs['text']
@@ -368,6 +389,176 @@ def _test_message(self):
         u = M.User.by_username('test-admin')
         assert str(u._id) in msg.kwargs['fromaddr'], msg.kwargs['fromaddr']
 
+    def _subscribe_users(self, *usernames):
+        users = [M.User.by_username(u) for u in usernames]
+        for u in users:
+            self.pg.subscribe(user=u)
+        ThreadLocalORMSession.flush_all()
+        ThreadLocalORMSession.close_all()
+        return users
+
+    def _fired(self, fire):
+        return sorted(call[0][0].user_id for call in fire.call_args_list)
+
+    def test_shards(self):
+        users = self._subscribe_users('test-admin', 'test-user-2')
+        mboxes = M.Mailbox.query.find().all()
+        assert_equal(sorted(m.user_shard for m in mboxes),
+                     sorted(M.Mailbox.shard_of(u._id) for u in users))
+        assert_equal(M.Mailbox.shard_query(0, 1), {})
+        for shards in (2, 3, 16):
+            found = []
+            for shard in range(shards):
+                found += M.Mailbox.query.find(M.Mailbox.shard_query(shard, shards)).all()
+            # every mailbox is in exactly one shard
+            assert_equal(sorted(m._id for m in found), sorted(m._id for m in mboxes))
+        # mailboxes from before user_shard are fired by the first shard
+        M.Mailbox.query.update({}, {'$set': dict(user_shard=None)}, multi=True)
+        assert_equal(M.Mailbox.query.find(M.Mailbox.shard_query(0, 2)).count(), 2)
+        assert_equal(M.Mailbox.query.find(M.Mailbox.shard_query(1, 2)).count(), 0)
+
+    @mock.patch.object(M.Mailbox, 'fire', autospec=True)
+    @mock.patch('allura.model.notification.log')
+    def test_fire_ready_log(self, log, fire):
+        self._subscribe_users('test-admin')
+        M.Mailbox.deliver('nid', self.pg.index_id(), 'metadata')
+        M.notification.MAILBOX_QUIESCENT = timedelta(minutes=1)
+        M.Mailbox.fire_ready()
+        # nothing fired yet, but the mailbox is in the backlog
+        assert_equal(log.log.call_args[0][0], logging.DEBUG)
+        assert_equal(log.log.call_args[0][2:6], (0, 1, 0, 0))
+        assert_equal(log.log.call_args[0][8], 1)
+        M.notification.MAILBOX_QUIESCENT = None
+        M.Mailbox.fire_ready()
+        assert_equal(log.log.call_args[0][0], logging.INFO)
+        assert_equal(log.log.call_args[0][4], 1)
+        assert_equal(log.log.call_args[0][8:], (0, 0))
+
+    @mock.patch.object(M.Mailbox, 'fire', autospec=True)
+    def test_fire_ready_shard(self, fire):
+        users = self._subscribe_users('test-admin', 'test-user-2')
+        M.Mailbox.deliver('nid', self.pg.index_id(), 'metadata')
+        shards = M.notification.MAILBOX_SHARD_SPACE
+        M.Mailbox.fire_ready(M.Mailbox.shard_of(users[0]._id), shards)
+        assert_equal(self._fired(fire), [users[0]._id])
+        count, age = M.Mailbox.backlog()
+        assert_equal(count, 1)
+        assert age >= timedelta(0), age
+        M.Mailbox.fire_ready(M.Mailbox.shard_of(users[1]._id), shards)
+        assert_equal(self._fired(fire), sorted(u._id for u in users))
+        assert_equal(M.Mailbox.backlog(), (0, None))
+
+    @mock.patch.object(M.Mailbox, 'fire', autospec=True)
+    @mock.patch.object(M.Notification.query, 'find', wraps=M.Notification.query.find)
+    def test_fire_ready_batches(self, find, fire):
+        users = self._subscribe_users('test-admin', 'test-user-2', 'test-user')
+        M.Mailbox.deliver('nid1', self.pg.index_id(), 'metadata')
+        M.Mailbox.deliver('nid2', self.pg.index_id(), 'metadata')
+        assert_equal(M.Mailbox.backlog()[0], 3)
+        with h.push_config(config, **{'notification.fire_batch_size': '2'}):
+            M.Mailbox.fire_ready()
+        assert_equal(self._fired(fire), sorted(u._id for u in users))
+        # notifications are loaded once per batch
+        assert_equal(find.call_count, 2)
+        ThreadLocalORMSession.close_all()
+        for mbox in M.Mailbox.query.find():
+            assert_equal(mbox.queue, [])
+            assert mbox.queue_empty
+            assert_equal(mbox.fire_claim, None)
+        assert_equal(M.Mailbox.backlog(), (0, None))
+
+    @mock.patch.object(M.Mailbox, 'fire', autospec=True)
+    def test_fire_ready_claimed(self, fire):
+        self._subscribe_users('test-admin', 'test-user-2')
+        M.Mailbox.deliver('nid', self.pg.index_id(), 'metadata')
+        now = datetime.utcnow()
+        # one mailbox claimed by a run in progress, the other by one that died
+        mboxes = M.Mailbox.query.find().sort('_id').all()
+        M.Mailbox.query.update({'_id': mboxes[0]._id}, {'$set': dict(
+            fire_claim='other', fire_claimed=now)})
+        M.Mailbox.query.update({'_id': mboxes[1]._id}, {'$set': dict(
+            fire_claim='dead', fire_claimed=now - timedelta(hours=1))})
+        M.Mailbox.fire_ready()
+        assert_equal(self._fired(fire), [mboxes[1].user_id])
+
+    @mock.patch.object(M.Mailbox, 'fire', autospec=True)
+    def test_fire_ready_delivered_meanwhile(self, fire):
+        self._subscribe_users('test-admin')
+
+        def deliver(mbox, now, notifications, recipients):
+            if mbox.queue == ['nid1']:
+                M.Mailbox.deliver('nid2', self.pg.index_id(), 'metadata')
+        fire.side_effect = deliver
+        M.Mailbox.deliver('nid1', self.pg.index_id(), 'metadata')
+        M.Mailbox.fire_ready()
+        # notifications delivered while firing aren't lost, they're fired next
+        assert_equal([call[0][0].queue for call in fire.call_args_list],
+                     [['nid1'], ['nid2']])
+        ThreadLocalORMSession.close_all()
+        mbox = M.Mailbox.query.get()
+        assert_equal(mbox.queue, [])
+        assert mbox.queue_empty
+
+    def test_fire_ready_direct_batched(self):
+        users = self._subscribe_users('test-admin', 'test-user-2', 'test-user')
+        n = self._post_notification(text='A')
+        ThreadLocalORMSession.flush_all()
+        q = dict(task_name='allura.tasks.mail_tasks.sendmail')
+        before = M.MonQTask.query.find(q).count()
+        M.Mailbox.deliver(n._id, self.pg.index_id(), 'metadata')
+        with h.push_config(config, **{'notification.fire_batch_size': '2'}):
+            M.Mailbox.fire_ready()
+        tasks = M.MonQTask.query.find(q).sort('_id').all()[before:]
+        # one sendmail task per batch of mailboxes, not one per user
+        assert_equal(len(tasks), 2)
+        assert_equal(sorted(d for t in tasks for d in t.kwargs['destinations']),
+                     sorted(str(u._id) for u in users))
+        assert_equal(set(t.kwargs['message_id'] for t in tasks), set([n._id]))
+
+    def test_send_digest_permissions(self):
+        pg2 = WM.Page.upsert('Other')
+        pg2.commit()
+        ns = [self._post_notification(text='A'),
+              M.Notification.post(pg2, 'metadata', text='B'),
+              self._post_notification(text='C')]
+        ThreadLocalORMSession.flush_all()
+        user = M.User.by_username('test-admin')
+        has_access = mock.Mock(side_effect=lambda artifact, perm, user:
+                               lambda: artifact.title != 'Other')
+        with mock.patch('allura.model.notification.security.has_access', has_access):
+            M.Notification.send_digest(user._id, 'test@mail.com', 'subject', ns)
+        # checked once per artifact
+        assert_equal(sorted(call[0][0].title for call in has_access.call_args_list),
+                     ['Home', 'Other'])
+        msgs = M.MonQTask.query.find(dict(
+            task_name='allura.tasks.mail_tasks.sendmail', state='ready')).all()
+        texts = [m.kwargs['text'] for m in msgs
+                 if m.kwargs['text'].startswith('Digest of subject')]
+        assert_equal(len(texts), 1)
+        text = texts[0]
+        assert_in('Message-ID: %s\n\nA\n' % ns[0]._id, text)
+        assert_in('Message-ID: %s\n\nC\n' % ns[2]._id, text)
+        assert ns[1]._id not in text, text
+
+    def test_send_digest_no_access(self):
+        n = self._post_notification(text='A')
+        ThreadLocalORMSession.flush_all()
+        user = M.User.by_username('test-admin')
+        q = dict(task_name='allura.tasks.mail_tasks.sendmail')
+        count = M.MonQTask.query.find(q).count()
+        with mock.patch('allura.model.notification.security.has_access') as has_access:
+            has_access.return_value = lambda: False
+            M.Notification.send_digest(user._id, 'test@mail.com', 'subject', [n])
+        assert_equal(M.MonQTask.query.find(q).count(), count)
+
+    def test_digest_lines(self):
+        ns = [self._post_notification(text='x' * 200), self._post_notification()]
+        lines = list(M.Notification.digest_lines('subject', ns, truncate=128))
+        assert_equal(lines[0], 'Digest of subject')
+        assert_equal(lines[5], h.text.truncate('x' * 200, 128))
+        assert_equal(lines[10], '-no text-')
+        assert_equal(lines[-1], ns[-1].footer())
+
     def _clear_subscriptions(self):
         M.Mailbox.query.remove({})
         ThreadLocalORMSession.flush_all()
@@ -420,15 +611,15 @@ def __getitem__(self, key):
             {'_id': {'$in': ['n0', 'n1', 'n2', 'n3', 'n4']}})
         # first notification should be sent direct, as its key values are
         # unique
-        notifications[0].send_direct.assert_called_once_with(u0)
+        notifications[0].send_direct.assert_called_once_with(u0, None)
         # next two notifications should be sent as a digest as they have
         # matching key values
         mocked_notification.send_digest.assert_called_once_with(
             u0, 'f2', 's2', [notifications[1], notifications[2]], 'rt2')
         # final two should be sent direct even though they matching keys, as
         # they are messages
-        notifications[3].send_direct.assert_called_once_with(u0)
-        notifications[4].send_direct.assert_called_once_with(u0)
+        notifications[3].send_direct.assert_called_once_with(u0, None)
+        notifications[4].send_direct.assert_called_once_with(u0, None)
 
     def test_send_direct_disabled_user(self):
         user = M.User.by_username('test-admin')
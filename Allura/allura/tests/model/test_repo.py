@@ -20,10 +20,12 @@
 
 import unittest
 import mock
-from nose.tools import assert_equal
+from nose.tools import assert_equal, assert_raises
 from pylons import tmpl_context as c
+import bson
 from bson import ObjectId
-from ming.orm import session
+from ming.orm import session, ThreadLocalORMSession
+from pymongo.errors import BulkWriteError
 from tg import config
 
 from alluratest.controller import setup_basic_test, setup_global_objects
@@ -127,6 +129,135 @@ def test_refresh_url(self, url):
                 self.assertEqual(result, repo.refresh_url())
 
 
+class TestRefreshBatch(unittest.TestCase):
+
+    def setUp(self):
+        setup_basic_test()
+
+    def test_upsert(self):
+        M.repository.CommitDoc(dict(_id='a', message=u'old', child_ids=['x'])).m.insert()
+        batch = M.repo_refresh.RefreshBatch(batch_size=2)
+        batch.upsert(M.repository.CommitDoc, 'a', dict(message=u'new'))
+        assert_equal(batch.written, 0)
+        batch.upsert(M.repository.CommitDoc, 'b', dict(message=u'new'))
+        assert_equal(batch.written, 2)
+        batch.update(M.repository.CommitDoc, dict(_id={'$in': ['a', 'b']}),
+                     {'$addToSet': dict(child_ids='c')})
+        batch.flush()
+        assert_equal((batch.written, batch.flushes), (3, 2))
+        a = M.repository.CommitDoc.m.get(_id='a')
+        b = M.repository.CommitDoc.m.get(_id='b')
+        assert_equal((a.message, a.child_ids), (u'old', ['x', 'c']))
+        assert_equal((b.message, b.child_ids), (u'new', ['c']))
+        batch.upsert(M.repository.CommitDoc, 'a', dict(message=u'new'), overwrite=True)
+        batch.flush()
+        assert_equal(M.repository.CommitDoc.m.get(_id='a').message, u'new')
+
+    def test_flush_order(self):
+        coll = mock.Mock()
+        cls1, cls2 = mock.Mock(), mock.Mock()
+        cls1.m.collection = cls2.m.collection = coll
+        batch = M.repo_refresh.RefreshBatch(batch_size=10)
+        batch.upsert(cls1, 'tree', {})
+        batch.upsert(cls2, 'commit', {})
+        batch.flush()
+        batch.upsert(cls2, 'commit2', {})
+        batch.upsert(cls1, 'tree2', {})
+        batch.flush()
+        bulk = coll.initialize_unordered_bulk_op.return_value
+        assert_equal([args[0]['_id'] for args, kw in bulk.find.call_args_list],
+                     ['tree', 'commit', 'tree2', 'commit2'])
+        assert_equal(bulk.execute.call_count, 4)
+
+    def test_bulk_write(self):
+        coll = mock.Mock()
+        cls = mock.Mock()
+        cls.m.collection = coll
+        bulk = coll.initialize_unordered_bulk_op.return_value
+        batch = M.repo_refresh.RefreshBatch(batch_size=10)
+        batch.upsert(cls, 'tree', dict(tree_ids=[]))
+        batch.upsert(cls, 'commit', dict(message=u'new'), overwrite=True)
+        batch.update(cls, dict(_id={'$in': ['commit']}), {'$addToSet': dict(child_ids='c')})
+        batch.flush()
+        assert_equal(bulk.find.call_args_list, [
+            mock.call(dict(_id='tree')),
+            mock.call(dict(_id='commit')),
+            mock.call(dict(_id={'$in': ['commit']}))])
+        upsert = bulk.find.return_value.upsert.return_value
+        assert_equal(upsert.update_one.call_args_list, [
+            mock.call({'$setOnInsert': dict(tree_ids=[])}),
+            mock.call({'$set': dict(message=u'new')})])
+        bulk.find.return_value.update.assert_called_once_with(
+            {'$addToSet': dict(child_ids='c')})
+        assert_equal(bulk.execute.call_count, 1)
+
+    def test_bulk_write_errors(self):
+        coll = mock.Mock()
+        cls = mock.Mock()
+        cls.m.collection = coll
+        bulk = coll.initialize_unordered_bulk_op.return_value
+        batch = M.repo_refresh.RefreshBatch(batch_size=10)
+        # another refresh inserted the same doc
+        bulk.execute.side_effect = BulkWriteError(dict(
+            writeErrors=[dict(index=0, code=11000, errmsg='E11000 duplicate key')],
+            writeConcernErrors=[]))
+        batch.upsert(cls, 'tree', {})
+        batch.flush()
+        bulk.execute.side_effect = BulkWriteError(dict(
+            writeErrors=[dict(index=0, code=11000, errmsg='E11000 duplicate key'),
+                         dict(index=1, code=2, errmsg='bad value')],
+            writeConcernErrors=[]))
+        batch.upsert(cls, 'tree', {})
+        batch.upsert(cls, 'tree2', {})
+        with assert_raises(BulkWriteError):
+            batch.flush()
+
+    def test_unknown_commit_ids(self):
+        M.repository.CommitDoc(dict(_id='a')).m.insert()
+        known = M.repo_refresh.known_commit_ids
+        repo = mock.Mock(_id='repo')
+        other = mock.Mock(_id='other')
+        unknown = M.repo_refresh.unknown_commit_ids
+        # off by default
+        assert_equal(unknown(['a', 'b'], repo), ['b'])
+        assert not known.known('repo', 'a')
+        with h.push_config(config, **{'scm.refresh.known_commit_ids': 10}):
+            try:
+                assert_equal(unknown(['a', 'b'], repo), ['b'])
+                assert known.known('repo', 'a')
+                M.repository.CommitDoc.m.remove(dict(_id='a'))
+                assert_equal(unknown(['a', 'b'], repo), ['b'])
+                # remembered per repo
+                assert_equal(unknown(['a', 'b'], other), ['a', 'b'])
+                assert_equal(unknown(['a', 'b']), ['a', 'b'])
+                known.discard(['a'])
+                assert_equal(unknown(['a', 'b'], repo), ['a', 'b'])
+            finally:
+                known.clear()
+
+    def test_known_commit_ids_cleared(self):
+        known = M.repo_refresh.known_commit_ids
+        with h.push_config(config, **{'scm.refresh.known_commit_ids': 10}):
+            try:
+                known.add('repo', ['a'])
+                known.add('other', ['b'])
+                repo = mock.Mock(_id='repo')
+                repo.all_commit_ids.return_value = []
+                # an empty repo isn't refreshed
+                M.repo_refresh.refresh_repo(repo, new_clone=True)
+                assert known.known('repo', 'a')
+                repo.all_commit_ids.return_value = ['a']
+                with mock.patch.object(M.repo_refresh, 'unknown_commit_ids') as unknown:
+                    unknown.side_effect = Exception('stop here')
+                    assert_raises(Exception, M.repo_refresh.refresh_repo, repo, new_clone=True)
+                assert not known.known('repo', 'a')
+                assert known.known('other', 'b')
+                known.clear()
+                assert_equal(len(known), 0)
+            finally:
+                known.clear()
+
+
 class TestLastCommit(unittest.TestCase):
     def setUp(self):
         setup_basic_test()
@@ -174,6 +305,7 @@ def n(p):
             else:
                 blob_nodes.append(n(p))
         tree = mock.Mock(
+            _id=str(ObjectId()),
             commit=commit,
             path=mock.Mock(return_value=path),
             tree_ids=tree_nodes,
@@ -358,6 +490,32 @@ def test_existing_lcd_partial(self):
         self.assertEqual(lcd.by_name['file3'], commit3._id)
         self.assertEqual(lcd.by_name['file4'], commit4._id)
 
+    def test_lcd_from_tree_index(self):
+        self.repo.lcd_index_complete = True
+        self.repo._id = ObjectId()
+        commit1 = self._add_commit('Commit 1', ['file1', 'dir1/file1'])
+        M.repository.CommitDoc(dict(_id=commit1._id, repo_ids=[self.repo._id])).m.insert()
+        tree1 = self._build_tree(commit1, '/dir1', ['file1'])
+        lcd1 = M.repository.LastCommit.get(tree1)
+        session(lcd1).flush(lcd1)
+        # built from commit1.get_path('dir1'), which is a new mock tree each time
+        self.assertIsNotNone(lcd1.tree_id)
+        # the same tree in another repo
+        M.repository.LastCommitDoc(dict(
+            _id=ObjectId(), commit_id='other-repo-commit', path='dir1',
+            tree_id=lcd1.tree_id, entries=[])).m.insert()
+        M.repository.CommitDoc(dict(_id='other-repo-commit', repo_ids=[ObjectId()])).m.insert()
+        commit2 = self._add_commit('Commit 2', ['file1', 'dir1/file1', 'file2'], ['file2'], [commit1])
+        tree2 = self._build_tree(commit2, '/dir1', ['file1'])
+        tree2._id = lcd1.tree_id
+        with mock.patch.object(self.repo, 'log',
+                               side_effect=AssertionError('SCM should not be queried')):
+            lcd = M.repository.LastCommit.get(tree2)
+        self.assertEqual(lcd._id, lcd1._id)
+        # not if it's only another repo's
+        M.repository.LastCommitDoc.m.remove(dict(_id=lcd1._id))
+        self.assertIsNone(M.repository.LastCommit._from_index(tree2, 'dir1'))
+
     def test_missing_add_record(self):
         self._add_commit('Commit 1', ['file1'])
         commit2 = self._add_commit('Commit 2', ['file2'])
@@ -398,6 +556,53 @@ def test_loop(self):
         self.assertEqual(lcd.by_name['file2'], commit3._id)
 
 
+class TestSharedModelCache(unittest.TestCase):
+
+    def setUp(self):
+        setup_basic_test()
+        self.shared = M.repository.SharedModelCache(1000)
+
+    def test_get(self):
+        M.repository.TreeDoc(dict(
+            _id='t1', tree_ids=[], blob_ids=[dict(name='a', id='b')], other_ids=[])).m.insert()
+        cache = M.repository.ModelCache(shared=self.shared)
+        cache.get(M.repository.Tree, dict(_id='t1'))
+        assert_equal(self.shared.stats, dict(hits=0, misses=1, evictions=0))
+        ThreadLocalORMSession.close_all()
+        M.repository.TreeDoc.m.remove(dict(_id='t1'))
+
+        cache = M.repository.ModelCache(shared=self.shared)
+        tree = cache.get(M.repository.Tree, dict(_id='t1'))
+        assert_equal(self.shared.stats, dict(hits=1, misses=1, evictions=0))
+        assert_equal(tree.blob_ids[0].name, 'a')
+        assert_equal(session(M.repository.Tree).imap.get(M.repository.Tree, 't1'), tree)
+        # missing docs aren't shared
+        assert_equal(cache.get(M.repository.Tree, dict(_id='t2')), None)
+        assert_equal(cache.get(M.repository.Tree, dict(_id='t2')), None)
+        assert_equal(self.shared.stats['misses'], 2)
+
+    def test_only_trees(self):
+        M.repository.CommitDoc(dict(_id='c1', repo_ids=[])).m.insert()
+        cache = M.repository.ModelCache(shared=self.shared)
+        cache.get(M.repository.Commit, dict(_id='c1'))
+        # commits get updated after they're written, so they aren't shared
+        assert_equal(self.shared.stats, dict(hits=0, misses=0, evictions=0))
+        assert_equal(self.shared.size, 0)
+
+    def test_max_bytes(self):
+        docs = [dict(_id=str(i) * 10) for i in range(3)]
+        size = len(bson.BSON.encode(docs[0]))
+        shared = M.repository.SharedModelCache(size * 2)
+        for doc in docs:
+            shared.set(M.repository.Tree, (('_id', doc['_id']),), doc)
+        assert_equal(shared.size, size * 2)
+        assert_equal(shared.stats['evictions'], 1)
+        assert_equal(shared.get(M.repository.Tree, (('_id', docs[0]['_id']),)), None)
+        assert_equal(shared.get(M.repository.Tree, (('_id', docs[2]['_id']),)), docs[2])
+        shared.set(M.repository.Tree, (('_id', 'big'),), dict(_id='x' * size * 2))
+        assert_equal(shared.get(M.repository.Tree, (('_id', 'big'),)), None)
+
+
 class TestModelCache(unittest.TestCase):
     def setUp(self):
         self.cache = M.repository.ModelCache()
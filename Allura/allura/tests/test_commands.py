@@ -15,6 +15,10 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import pprint
+import signal
+from datetime import datetime, timedelta
+
 from nose.tools import assert_raises, assert_in
 from datadiff.tools import assert_equal
 from ming.orm import ThreadLocalORMSession
@@ -24,7 +28,7 @@
 
 from alluratest.controller import setup_basic_test, setup_global_objects
 from allura.command import base, script, set_neighborhood_features, \
-    create_neighborhood, show_models, taskd_cleanup
+    create_neighborhood, show_models, taskd_cleanup, taskd
 from allura import model as M
 from allura.lib.exceptions import InvalidNBFeatureValueError
 from allura.tests import decorators as td
@@ -357,6 +361,147 @@ def test_status_log_retries():
     assert cmd._taskd_status.mock_calls == expected_calls
 
 
+def test_taskd_worker_pool_from_spec():
+    pool = taskd.WorkerPool.from_spec('repo:2:allura.tasks.repo_tasks.*,foo.bar')
+    assert_equal(pool.name, 'repo')
+    assert_equal(pool.size, 2)
+    assert_equal(pool.only, ['allura.tasks.repo_tasks.*', 'foo.bar'])
+    pool = taskd.WorkerPool.from_spec('default:16')
+    assert_equal(pool.size, 16)
+    assert_equal(pool.only, None)
+    assert_raises(ValueError, taskd.WorkerPool.from_spec, 'default')
+    assert_raises(ValueError, taskd.WorkerPool.from_spec, 'default:x')
+
+
+@patch('allura.command.taskd.sys')
+def test_taskd_supervisor_worker_args(sys):
+    sys.argv = ['/bin/paster', 'taskd', 'production.ini', '--pool', 'repo:2:allura.tasks.repo_tasks.*']
+    cmd = taskd.TaskdCommand('taskd')
+    cmd.args = ['production.ini']
+    cmd.options = Mock(batch_size=1, nocapture=False)
+    pool = taskd.WorkerPool('default', 16, exclude=['allura.tasks.repo_tasks.*'])
+    assert_equal(cmd.worker_args(pool), [
+        '/bin/paster', 'taskd', 'production.ini', '--exclude', 'allura.tasks.repo_tasks.*'])
+
+
+class FakeWorker(object):
+
+    '''Stands in for a worker subprocess.Popen'''
+    pids = iter(xrange(1000, 2000))
+
+    def __init__(self, args):
+        self.args = args
+        self.pid = next(self.pids)
+        self.returncode = None
+        self.signals = []
+
+    def poll(self):
+        return self.returncode
+
+    def send_signal(self, signum):
+        if self.returncode is not None:
+            raise OSError('No such process')
+        self.signals.append(signum)
+
+    def wait(self):
+        self.returncode = 0
+        return self.returncode
+
+
+@patch('allura.command.taskd.time')
+@patch('allura.command.taskd.subprocess.Popen', FakeWorker)
+def test_taskd_worker_pool_respawn(time):
+    pool = taskd.WorkerPool('default', 2)
+    time.time.return_value = 0
+    pool.fill(['taskd'])
+    workers = [proc for proc, started in pool.procs.values()]
+    assert_equal(len(workers), 2)
+    assert_equal(pool.pids_seen, set(w.pid for w in workers))
+    # replaced right away after running for a while
+    time.time.return_value = 100
+    workers[0].returncode = 1
+    pool.reap()
+    assert_equal(pool.procs.keys(), [workers[1].pid])
+    pool.fill(['taskd'])
+    assert_equal(len(pool.procs), 2)
+    # but not if it exits right after starting
+    time.time.return_value = 101
+    for proc, started in pool.procs.values():
+        if started == 100:
+            proc.returncode = 1
+    pool.reap()
+    pool.fill(['taskd'])
+    assert_equal(len(pool.procs), 1)
+    time.time.return_value = 101 + pool.respawn_delay
+    pool.fill(['taskd'])
+    assert_equal(len(pool.procs), 2)
+    assert_equal(len(pool.pids_seen), 4)
+
+
+@patch('allura.command.taskd.sys')
+@patch('allura.command.taskd.WorkerPool.log_stats')
+@patch('allura.command.taskd.time')
+@patch('allura.command.taskd.subprocess.Popen', FakeWorker)
+def test_taskd_supervisor_restart_and_stop(time, log_stats, sys):
+    sys.argv = ['/bin/paster', 'taskd', 'production.ini', '--pool', 'default:2']
+    cmd = taskd.TaskdCommand('taskd')
+    cmd.args = ['production.ini']
+    cmd.options = Mock(pools=['repo:1:allura.tasks.repo_tasks.*', 'default:2'],
+                       batch_size=1, nocapture=False, stats_interval=0)
+    cmd.keep_running = True
+    time.time.return_value = 0
+    pools = []
+    from_spec = taskd.WorkerPool.from_spec
+
+    def record_pool(spec):
+        pool = from_spec(spec)
+        pools.append(pool)
+        return pool
+    workers = []
+
+    def sleep(seconds):
+        workers[:] = [proc for pool in pools for proc, started in pool.procs.values()]
+        if time.sleep.call_count == 1:
+            cmd.restart_pools(signal.SIGHUP, None)
+        else:
+            cmd.graceful_stop(signal.SIGTERM, None)
+    time.sleep.side_effect = sleep
+    with patch('allura.command.taskd.WorkerPool.from_spec', side_effect=record_pool):
+        cmd.supervisor()
+    assert_equal(time.sleep.call_count, 2)
+    assert_equal(pools[1].exclude, ['allura.tasks.repo_tasks.*'])
+    assert_equal(sorted(' '.join(w.args[3:]) for w in workers), [
+        '--exclude allura.tasks.repo_tasks.*',
+        '--exclude allura.tasks.repo_tasks.*',
+        '--only allura.tasks.repo_tasks.*'])
+    # SIGHUP is passed on so they restart gracefully, then SIGTERM stops them
+    for w in workers:
+        assert_equal(w.signals, [signal.SIGHUP, signal.SIGTERM])
+        assert_equal(w.returncode, 0)
+    assert_equal([p.procs for p in pools], [{}, {}])
+    assert_equal(log_stats.call_count, 4)
+
+
+def test_taskd_worker_pool_log_stats():
+    M.MonQTask.query.remove({})
+    pool = taskd.WorkerPool('repo', 2, only=['pprint.pformat'])
+    M.MonQTask.post(pprint.pformat, ([5, 6],))
+    M.MonQTask.post(pprint.pprint, ([5, 6],))
+    since = datetime.utcnow()
+    done = M.MonQTask.post(pprint.pformat, ([7],))
+    done.state = 'complete'
+    done.time_stop = since + timedelta(seconds=1)
+    done.process = pool.process_name(1234)
+    ThreadLocalORMSession.flush_all()
+    pool.pids_seen = set([1234])
+    with patch('allura.command.taskd.status_log') as status_log:
+        pool.log_stats(since, since + timedelta(seconds=10))
+    status_log.info.assert_called_once_with(
+        'taskd pool repo: 0/2 workers, 1 tasks ready, 1 done in 10s (0.10/s)')
+    # the next report only counts workers still running
+    assert_equal(pool.pids_seen, set())
+
+
 class TestBackgroundCommand(object):
 
     cmd = 'allura.command.show_models.ReindexCommand'
@@ -42,7 +42,7 @@
 
 from allura import model as M
 from allura.lib import helpers as h
-from allura.lib.app_globals import ForgeMarkdown, NeighborhoodCache
+from allura.lib.app_globals import ForgeMarkdown, NeighborhoodCache, RenderedMarkdownCache
 from allura.tests import decorators as td
 
 from forgewiki import model as WM
@@ -378,6 +378,19 @@ def test_wiki_artifact_links():
         assert '<a class="alink" href="/p/test/wiki/Home/">[test:wiki:Home]</a>' in text, text
 
 
+@td.with_wiki
+def test_markdown_prefetches_shortlinks():
+    with h.push_context('test', 'wiki', neighborhood='Projects'):
+        with patch.object(M.Shortlink, 'from_links', wraps=M.Shortlink.from_links) as from_links, \
+                patch.object(M.Shortlink, 'lookup') as lookup:
+            text = g.markdown.convert('See [test:wiki:Home], [Home] and [here](Home)')
+    assert_equal(from_links.call_count, 1)
+    assert not lookup.called
+    assert '<a class="alink" href="/p/test/wiki/Home/">[test:wiki:Home]</a>' in text, text
+    assert '<a class="alink" href="/p/test/wiki/Home/">[Home]</a>' in text, text
+    assert '<a class="" href="/p/test/wiki/Home/">here</a>' in text, text
+
+
 def test_markdown_links():
     with patch.dict(tg.config, {'nofollow_exempt_domains': 'foobar.net'}):
         text = g.markdown.convert('Read [here](http://foobar.net/) about our project')
@@ -751,6 +764,54 @@ def test_all_expected_keys_exist_in_cache(self):
         self.assertEqual(required_keys, keys)
 
 
+class TestRenderedMarkdownCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = RenderedMarkdownCache(60)
+        self.md = ForgeMarkdown(cache_flavor=('test',))
+
+    def test_convert_uses_cache(self):
+        with patch.object(RenderedMarkdownCache, 'instance', return_value=self.cache):
+            html = self.md.convert(u'**bold**')
+            self.assertEqual(html, u'<p><strong>bold</strong></p>')
+            with patch('markdown.Markdown.convert') as convert:
+                self.assertEqual(self.md.convert(u'**bold**'), html)
+                self.assertFalse(convert.called)
+                ForgeMarkdown(cache_flavor=('other',)).convert(u'**bold**')
+                self.assertTrue(convert.called)
+        self.assertEqual(self.cache.stats, dict(hits=1, misses=2, evictions=0))
+
+    def test_cache_key(self):
+        self.assertIsNone(ForgeMarkdown().cache_key(u'text'))
+        self.assertEqual(self.md.cache_key(u'text'),
+                         (('test',), hashlib.md5('text').hexdigest(), ForgeMarkdown.cache_bugfix_rev))
+        md = g.forge_markdown()
+        self.assertIsNotNone(md.cache_key(u'**bold**'))
+        self.assertIsNone(md.cache_key(u'see [some-page]'))
+        self.assertIsNone(md.cache_key(u'[[members]]'))
+        self.assertNotEqual(md.cache_key(u'text'), g.forge_markdown(wiki=True).cache_key(u'text'))
+
+    def test_evicts_least_recently_used(self):
+        self.cache.set('a', u'a' * 20)
+        self.cache.set('b', u'b' * 20)
+        self.assertEqual(self.cache.get('a'), u'a' * 20)
+        self.cache.set('c', u'\u00e5' * 10)
+        self.assertEqual(self.cache.size, 60)
+        self.cache.set('d', u'd' * 20)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), u'a' * 20)
+        self.assertEqual(self.cache.get('d'), u'd' * 20)
+        self.assertEqual(self.cache.size, 60)
+        self.assertEqual(self.cache.stats['evictions'], 1)
+        self.cache.set('e', u'e' * 61)
+        self.assertIsNone(self.cache.get('e'))
+
+    @patch.dict('allura.lib.app_globals.config', {})
+    def test_disabled_by_default(self):
+        with patch.object(RenderedMarkdownCache, '_instance', None):
+            self.assertIsNone(RenderedMarkdownCache.instance())
+
+
 class TestHandlePaging(unittest.TestCase):
 
     def setUp(self):
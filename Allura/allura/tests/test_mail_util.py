@@ -22,13 +22,16 @@
 from email.MIMEText import MIMEText
 
 import mock
+import tg
 from nose.tools import raises, assert_equal, assert_false, assert_true
 from ming.orm import ThreadLocalORMSession
 
 from alluratest.controller import setup_basic_test, setup_global_objects
 from allura.lib.utils import ConfigProxy
+from allura.lib import helpers as h
 from allura.app import Application
 from allura.lib.mail_util import (
+    SMTPClient,
     parse_address,
     parse_message,
     Header,
@@ -227,6 +230,63 @@ def test_no_match(self, EA, User):
                      [mock.call(email='arg', confirmed=True), mock.call(email='from')])
 
 
+class TestSMTPClient(unittest.TestCase):
+
+    def setUp(self):
+        setup_basic_test()
+
+    @mock.patch('allura.lib.mail_util.smtplib')
+    def test_persistent_connection(self, smtplib):
+        client = SMTPClient()
+        with h.push_config(tg.config, smtp_max_messages='2'):
+            for i in range(3):
+                client.send(['a@example.com'], 'message')
+        # reconnected after 2 messages
+        assert_equal(smtplib.SMTP.call_count, 2)
+        assert_equal(smtplib.SMTP.return_value.quit.call_count, 1)
+        assert_equal(smtplib.SMTP.return_value.sendmail.call_args_list,
+                     [mock.call(config.return_path, ['a@example.com'], 'message')] * 3)
+
+    @mock.patch('allura.lib.mail_util.time.sleep')
+    @mock.patch('allura.lib.mail_util.smtplib')
+    def test_retries(self, smtplib, sleep):
+        client = SMTPClient()
+        conn = smtplib.SMTP.return_value
+        conn.sendmail.side_effect = [Exception('closed'), Exception('down'), None]
+        with h.push_config(tg.config, smtp_retries='2', smtp_retry_delay='3'):
+            client.send(['a@example.com'], 'message')
+        assert_equal(conn.sendmail.call_count, 3)
+        assert_equal(smtplib.SMTP.call_count, 3)
+        # only waits before the second retry
+        sleep.assert_called_once_with(3.0)
+
+        conn.sendmail.side_effect = Exception('down')
+        with h.push_config(tg.config, smtp_retries='2'):
+            with self.assertRaises(Exception):
+                client.send(['a@example.com'], 'message')
+
+    @mock.patch('allura.lib.mail_util.smtplib')
+    def test_batches(self, smtplib):
+        client = SMTPClient()
+        rcpts = ['%s@example.com' % i for i in range(5)]
+        with h.push_config(tg.config, smtp_max_recipients='2'):
+            client.send(rcpts, 'message')
+        assert_equal(smtplib.SMTP.return_value.sendmail.call_args_list, [
+            mock.call(config.return_path, rcpts[0:2], 'message'),
+            mock.call(config.return_path, rcpts[2:4], 'message'),
+            mock.call(config.return_path, rcpts[4:], 'message')])
+
+        # sent concurrently over the pool's connections
+        smtplib.reset_mock()
+        with h.push_config(tg.config, smtp_max_recipients='2', smtp_pool_size='2'):
+            client.send(rcpts, 'message')
+            client.send(rcpts, 'message')
+        sent = smtplib.SMTP.return_value.sendmail.call_args_list
+        assert_equal(len(sent), 6)
+        assert_equal(sorted(r for call in sent for r in call[0][1]), sorted(rcpts * 2))
+        assert smtplib.SMTP.call_count <= 2, smtplib.SMTP.call_count
+
+
 def test_parse_message_id():
     assert_equal(_parse_message_id('<de31888f6be2d87dc377d9e713876bb514548625.patches@libjpeg-turbo.p.domain.net>, </p/libjpeg-turbo/patches/54/de31888f6be2d87dc377d9e713876bb514548625.patches@libjpeg-turbo.p.domain.net>'), [
         'de31888f6be2d87dc377d9e713876bb514548625.patches@libjpeg-turbo.p.domain.net',
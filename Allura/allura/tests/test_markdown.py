@@ -146,3 +146,19 @@ def test_convert(self, lookup, get_comment_slug):
             extensions=[mde.CommitMessageExtension(app), 'nl2br'],
             output_format='html4')
         self.assertEqual(md.convert(text), expected_html)
+
+    @mock.patch('allura.lib.markdown_extensions.M.Shortlink.lookup')
+    def test_convert_short_ref(self, lookup):
+        from allura.lib.app_globals import ForgeMarkdown
+
+        shortlink = mock.Mock(url='/p/project/tool/artifact/')
+        shortlink.ref.artifact.deleted = False
+        shortlink.ref.artifact.is_closed = False
+        lookup.return_value = shortlink
+        app = mock.Mock(url='/p/project/tool/')
+
+        md = ForgeMarkdown(
+            extensions=[mde.CommitMessageExtension(app), 'nl2br'],
+            output_format='html4')
+        self.assertIn('<a class=alink href=/p/project/tool/artifact/>[artifact]</a>',
+                      md.convert('See [artifact]'))
@@ -17,12 +17,16 @@
 
 from pylons import tmpl_context as c
 from nose.tools import assert_equal
+from mock import patch
 
 from ming.odm import ThreadLocalODMSession
 from allura.tests import decorators as td
 from allura.tests import TestController
 
-from allura.lib.security import Credentials, all_allowed, has_access
+from allura.lib import helpers as h
+from allura.lib import security
+from allura.lib.security import (Credentials, CompiledACL, RoleGraphCache, all_allowed, has_access,
+                                 filter_accessible, role_versions)
 from allura import model as M
 from forgewiki import model as WM
 
@@ -190,3 +194,76 @@ def test_deny_access_for_single_user(self):
             M.ACE.deny(M.ProjectRole.by_user(user, upsert=True)._id, 'read', 'Spammer'))
         Credentials.get().clear()
         assert not has_access(wiki, 'read', user)()
+
+    @td.with_wiki
+    def test_acl_checks_memoized(self):
+        wiki = c.project.app_instance('wiki')
+        page = WM.Page.query.get(app_config_id=wiki.config._id)
+        auth_role = M.ProjectRole.by_name('*authenticated')
+        test_user = M.User.by_username('test-user')
+        assert has_access(page, 'read', test_user)()
+        with patch.object(CompiledACL, 'check', autospec=True,
+                          side_effect=CompiledACL.check) as check:
+            assert has_access(page, 'read', test_user)()
+            assert not check.called
+            assert has_access(page, 'post', test_user)()
+            assert check.called
+        # changing an ACL mid-request is picked up without clearing anything
+        page.acl.insert(0, M.ACE.deny(auth_role._id, 'read'))
+        assert not has_access(page, 'read', test_user)()
+        page.acl.pop(0)
+        assert has_access(page, 'read', test_user)()
+
+    @td.with_wiki
+    def test_filter_accessible(self):
+        wiki = c.project.app_instance('wiki')
+        auth_role = M.ProjectRole.by_name('*authenticated')
+        test_user = M.User.by_username('test-user')
+        with h.push_config(c, app=wiki):
+            pages = [WM.Page.upsert('page%d' % i) for i in range(4)]
+        _deny(pages[1], auth_role, 'read')
+        with patch.object(security, 'has_access', side_effect=has_access) as check:
+            assert_equal(filter_accessible(pages, 'read', test_user),
+                         [pages[0], pages[2], pages[3]])
+        # once for the pages with the default ACL, once for pages[1]
+        checked = [args[0] for args, kw in check.call_args_list
+                   if isinstance(args[0], WM.Page)]
+        assert_equal(checked, [pages[0], pages[1]])
+        # the DENY is for *authenticated only
+        assert_equal(filter_accessible(pages, 'read', M.User.anonymous()), pages)
+        assert_equal(filter_accessible([c.project, wiki.config], 'read', test_user),
+                     [c.project, wiki.config])
+
+    @td.with_wiki
+    def test_role_versions_bumped(self):
+        pid = c.project.root_project._id
+        version = role_versions([pid])[pid]
+        role = M.ProjectRole.upsert(project_id=pid, name='Testers')
+        assert_equal(role_versions([pid])[pid], version + 1)
+        role.roles.append(M.ProjectRole.by_name('Member')._id)
+        ThreadLocalODMSession.flush_all()
+        assert_equal(role_versions([pid])[pid], version + 2)
+        M.ProjectRole.query.remove(dict(_id=role._id))
+        assert_equal(role_versions([pid])[pid], version + 3)
+
+    @td.with_wiki
+    def test_shared_role_cache(self):
+        project_id = c.project.root_project._id
+        user = M.User.by_username('test-user')
+        developer = M.ProjectRole.by_name('Developer')
+        cache = RoleGraphCache(100)
+
+        def reaching_ids():
+            # a new request
+            cred = Credentials()
+            return set(cred.user_roles(user_id=user._id, project_id=project_id).reaching_ids)
+
+        with patch.object(RoleGraphCache, 'instance', return_value=cache):
+            before = reaching_ids()
+            assert_equal(cache.stats, dict(hits=0, misses=2, evictions=0))
+            assert_equal(reaching_ids(), before)
+            assert_equal(cache.stats, dict(hits=2, misses=2, evictions=0))
+            assert developer._id not in before
+            _add_to_group(user, developer)
+            assert developer._id in reaching_ids()
+            assert_equal(cache.stats, dict(hits=2, misses=4, evictions=0))
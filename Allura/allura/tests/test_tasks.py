@@ -22,6 +22,7 @@
 import sys
 import unittest
 from base64 import b64encode
+from bson import ObjectId
 import logging
 
 import tg
@@ -143,9 +144,10 @@ def test_del_projects(self):
 
     @td.with_wiki
     def test_add_artifacts(self):
-        from allura.lib.search import find_shortlinks
-        with mock.patch('allura.lib.search.find_shortlinks') as find_slinks:
-            find_slinks.side_effect = lambda s: find_shortlinks(s)
+        from allura.lib.app_globals import ForgeMarkdown
+        convert = ForgeMarkdown.convert
+        with mock.patch('allura.lib.search.find_shortlinks') as find_slinks, \
+                mock.patch.object(ForgeMarkdown, 'convert', autospec=True, side_effect=convert) as md_convert:
 
             old_shortlinks = M.Shortlink.query.find().count()
             old_solr_size = len(g.solr.db)
@@ -167,8 +169,10 @@ def test_add_artifacts(self):
             M.main_orm_session.clear()
             t3 = _TestArtifact.query.get(_shorthand_id='t3')
             assert len(t3.backrefs) == 5, t3.backrefs
-            assert_equal(find_slinks.call_args_list,
-                         [mock.call(a.index().get('text')) for a in artifacts])
+            # solr text and shortlinks come from a single render
+            assert not find_slinks.called
+            assert_equal([call[0][1] for call in md_convert.call_args_list],
+                         [a.index().get('text') for a in artifacts])
 
     @td.with_wiki
     @mock.patch('allura.tasks.index_tasks.g.solr')
@@ -297,6 +301,31 @@ def test_send_email_with_disabled_destination_user(self):
                 message_id=h.gen_message_id())
             assert_equal(_client.sendmail.call_count, 0)
 
+    def test_send_email_formats(self):
+        admin = M.User.by_username('test-admin')
+        user = M.User.by_username('test-user')
+        user.set_pref('email_address', 'test-user@example.com')
+        user.set_pref('email_format', 'plain')
+        ThreadLocalORMSession.flush_all()
+        with mock.patch.object(mail_tasks.smtp_client, '_client') as _client, \
+                mock.patch.object(g, 'forge_markdown') as forge_markdown:
+            forge_markdown.return_value.convert.return_value = u'<p>html</p>'
+            mail_tasks.sendmail(
+                fromaddr=str(admin._id),
+                destinations=[str(admin._id), str(user._id), str(ObjectId()),
+                              'test@mail.com'],
+                text=u'This is a test',
+                reply_to=g.noreply,
+                subject=u'Test subject',
+                message_id=h.gen_message_id())
+            # rendered once for everyone
+            assert_equal(forge_markdown.return_value.convert.call_count, 1)
+            # multipart for admin, then plain for the others
+            assert_equal(_client.sendmail.call_count, 2)
+            rcpts = [call[0][1] for call in _client.sendmail.call_args_list]
+            assert_equal(rcpts, [[admin.get_pref('email_address')],
+                                 ['test-user@example.com', 'test@mail.com']])
+
     def test_sendsimplemail_with_disabled_user(self):
         c.user = M.User.by_username('test-admin')
         with mock.patch.object(mail_tasks.smtp_client, '_client') as _client:
@@ -485,6 +514,24 @@ def test_delivers_messages(self):
                 assert deliver.called_with('42', '52', 'none')
                 assert fire_ready.called_with()
 
+    def test_notify_shards(self):
+        with mock.patch.object(M.Mailbox, 'deliver') as deliver, \
+                mock.patch.object(M.Mailbox, 'fire_ready') as fire_ready, \
+                mock.patch.dict(tg.config, {'notification.fire_shards': '3'}):
+            notification_tasks.notify('42', '52', 'none')
+            notification_tasks.notify('43', '52', 'none')
+            deliver.assert_called_with('43', '52', 'none')
+            assert not fire_ready.called
+            tasks = M.MonQTask.query.find(dict(
+                task_name='allura.tasks.notification_tasks.fire_ready')).all()
+            # pending runs of a shard are shared
+            assert_equal(sorted(t.args for t in tasks), [[0, 3], [1, 3], [2, 3]])
+            for t in tasks:
+                assert_equal(t.context['project_id'], None)
+            M.MonQTask.run_ready()
+            assert_equal(sorted(call[0] for call in fire_ready.call_args_list),
+                         [(0, 3), (1, 3), (2, 3)])
+
 
 @event_handler('my_event')
 def _my_event(event_type, testcase, *args, **kwargs):
@@ -195,6 +195,51 @@ def test_everything(self):
         assert d == utils.CaseInsensitiveDict(Foo=1, bar=2)
 
 
+class TestLRUCache(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = utils.LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert_equal(cache.get('a'), 1)
+        cache.set('c', 3)
+        assert_equal(cache.get('b'), None)
+        assert_equal(cache.get('a'), 1)
+        assert_equal(cache.get('c'), 3)
+        assert_equal(cache.size, 2)
+        assert_equal(cache.stats, dict(hits=3, misses=1, evictions=1))
+        cache.clear()
+        assert_equal(cache.size, 0)
+        assert_equal(cache.get('a'), None)
+
+    def test_sizeof(self):
+        class StrCache(utils.LRUCache):
+            def sizeof(self, data):
+                return len(data)
+        cache = StrCache(5)
+        cache.set('a', 'xxx')
+        cache.set('a', 'xx')
+        assert_equal(cache.size, 2)
+        cache.set('b', 'xxx')
+        assert_equal(cache.size, 5)
+        # too big to ever fit
+        cache.set('c', 'x' * 6)
+        assert_equal(cache.get('c'), None)
+        assert_equal(cache.size, 5)
+
+    def test_instance(self):
+        class Cache(utils.LRUCache):
+            config_key = 'test.lru_cache.max_entries'
+        with h.push_config(config, **{'test.lru_cache.max_entries': '0'}):
+            assert_equal(Cache.instance(), None)
+        Cache._instance = None
+        with h.push_config(config, **{'test.lru_cache.max_entries': '10'}):
+            cache = Cache.instance()
+        assert_equal(cache.max_size, 10)
+        assert Cache.instance() is cache
+        assert_equal(utils.LRUCache._instance, None)
+
+
 class TestLineAnchorCodeHtmlFormatter(unittest.TestCase):
 
     def test_render(self):
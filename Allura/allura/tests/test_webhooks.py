@@ -19,7 +19,11 @@
 import hmac
 import hashlib
 import datetime as dt
+import threading
+import time
 
+import requests
+from bson import ObjectId
 from mock import Mock, MagicMock, patch, call
 from nose.tools import (
     assert_raises,
@@ -39,8 +43,11 @@
     WebhookValidator,
     WebhookController,
     send_webhook,
+    send_webhooks,
+    webhook_session,
     RepoPushWebhookSender,
     SendWebhookHelper,
+    WebhookDispatcher,
 )
 from allura.tests import decorators as td
 from alluratest.controller import (
@@ -449,16 +456,24 @@ def test_send_webhook_task(self, swh):
         send_webhook(self.wh._id, self.payload)
         swh.assert_called_once_with(self.wh, self.payload)
 
-    @patch('allura.webhooks.requests', autospec=True)
+    @patch('allura.webhooks.SendWebhookHelper', autospec=True)
+    def test_send_webhook_task_removed(self, swh):
+        # a retry can run after the webhook was deleted
+        send_webhook(ObjectId(), self.payload, 1)
+        assert_equal(swh.call_count, 0)
+
+    @patch('allura.webhooks.webhook_session', autospec=True)
     @patch('allura.webhooks.log', autospec=True)
-    def test_send(self, log, requests):
-        requests.post.return_value = Mock(status_code=200)
+    def test_send(self, log, webhook_session):
+        post = webhook_session.return_value.post
+        post.return_value = Mock(status_code=200)
         self.h.sign = Mock(return_value='sha1=abc')
         self.h.send()
         headers = {'content-type': 'application/json',
                    'User-Agent': 'Allura Webhook (https://allura.apache.org/)',
                    'X-Allura-Signature': 'sha1=abc'}
-        requests.post.assert_called_once_with(
+        webhook_session.assert_called_once_with(self.wh.hook_url)
+        post.assert_called_once_with(
             self.wh.hook_url,
             data=json.dumps(self.payload),
             headers=headers,
@@ -466,48 +481,137 @@ def test_send(self, log, requests):
         log.info.assert_called_once_with(
             'Webhook successfully sent: %s %s %s' % (
                 self.wh.type, self.wh.hook_url, self.wh.app_config.url()))
+        session(self.wh).expunge(self.wh)
+        wh = M.Webhook.query.get(_id=self.wh._id)
+        assert_equal((wh.delivered, wh.failed), (1, 0))
 
-    @patch('allura.webhooks.time', autospec=True)
-    @patch('allura.webhooks.requests', autospec=True)
+    @patch('allura.webhooks.send_webhook', autospec=True)
+    @patch('allura.webhooks.webhook_session', autospec=True)
     @patch('allura.webhooks.log', autospec=True)
-    def test_send_error_response_status(self, log, requests, time):
-        requests.post.return_value = Mock(status_code=500)
+    def test_send_error_response_status(self, log, webhook_session, send_webhook):
+        post = webhook_session.return_value.post
+        post.return_value = Mock(status_code=500)
         self.h.send()
-        assert_equal(requests.post.call_count, 4)  # initial call + 3 retries
-        assert_equal(time.sleep.call_args_list,
-                     [call(60), call(120), call(240)])
-        assert_equal(log.info.call_args_list, [
-            call('Retrying webhook in: %s', [60, 120, 240]),
-            call('Retrying webhook in %s seconds', 60),
-            call('Retrying webhook in %s seconds', 120),
-            call('Retrying webhook in %s seconds', 240)])
-        assert_equal(log.error.call_count, 4)
-        log.error.assert_called_with(
+        assert_equal(post.call_count, 1)
+        # retried later by another task, instead of sleeping in this one
+        send_webhook.post.assert_called_once_with(
+            self.wh._id, self.payload, 1, delay=60)
+        log.info.assert_called_once_with('Retrying webhook in %s seconds', 60)
+        log.error.assert_called_once_with(
             'Webhook send error: %s %s %s %s %s %s' % (
                 self.wh.type, self.wh.hook_url,
                 self.wh.app_config.url(),
-                requests.post.return_value.status_code,
-                requests.post.return_value.text,
-                requests.post.return_value.headers))
+                post.return_value.status_code,
+                post.return_value.text,
+                post.return_value.headers))
+
+        send_webhook.reset_mock()
+        self.h.send(attempt=2)
+        send_webhook.post.assert_called_once_with(
+            self.wh._id, self.payload, 3, delay=240)
+        send_webhook.reset_mock()
+        self.h.send(attempt=3)
+        assert_equal(send_webhook.post.call_count, 0)
+        log.info.assert_called_with('Giving up on webhook after %s retries', 3)
+        session(self.wh).expunge(self.wh)
+        wh = M.Webhook.query.get(_id=self.wh._id)
+        assert_equal((wh.delivered, wh.failed), (0, 3))
 
-    @patch('allura.webhooks.time', autospec=True)
-    @patch('allura.webhooks.requests', autospec=True)
+    @patch('allura.webhooks.send_webhook', autospec=True)
+    @patch('allura.webhooks.webhook_session', autospec=True)
     @patch('allura.webhooks.log', autospec=True)
-    def test_send_error_no_retries(self, log, requests, time):
-        requests.post.return_value = Mock(status_code=500)
+    def test_send_error_no_retries(self, log, webhook_session, send_webhook):
+        post = webhook_session.return_value.post
+        post.return_value = Mock(status_code=500)
         with h.push_config(config, **{'webhook.retry': ''}):
             self.h.send()
-            assert_equal(requests.post.call_count, 1)
-            assert_equal(time.call_count, 0)
-            log.info.assert_called_once_with('Retrying webhook in: %s', [])
+            assert_equal(post.call_count, 1)
+            assert_equal(send_webhook.post.call_count, 0)
+            log.info.assert_called_once_with(
+                'Giving up on webhook after %s retries', 0)
             assert_equal(log.error.call_count, 1)
-            log.error.assert_called_with(
-                'Webhook send error: %s %s %s %s %s %s' % (
-                    self.wh.type, self.wh.hook_url,
-                    self.wh.app_config.url(),
-                    requests.post.return_value.status_code,
-                    requests.post.return_value.text,
-                    requests.post.return_value.headers))
+
+    @patch('allura.webhooks.send_webhook', autospec=True)
+    @patch('allura.webhooks.webhook_session', autospec=True)
+    @patch('allura.webhooks.log', autospec=True)
+    def test_send_request_error(self, log, webhook_session, send_webhook):
+        post = webhook_session.return_value.post
+        post.side_effect = requests.exceptions.ConnectionError('refused')
+        self.h.send()
+        assert_equal(log.error.call_count, 1)
+        assert_equal(log.error.call_args[0],
+                     (self.h.log_msg('Webhook send error'),))
+        send_webhook.post.assert_called_once_with(
+            self.wh._id, self.payload, 1, delay=60)
+        session(self.wh).expunge(self.wh)
+        wh = M.Webhook.query.get(_id=self.wh._id)
+        assert_equal((wh.delivered, wh.failed), (0, 1))
+
+    def test_webhook_session(self):
+        with patch.dict('allura.webhooks._sessions', clear=True):
+            s = webhook_session('http://httpbin.org/post')
+            assert_equal(webhook_session('http://httpbin.org/other'), s)
+            assert s is not webhook_session('https://httpbin.org/post')
+            assert s is not webhook_session('http://example.com/post')
+
+
+class TestWebhookDispatcher(TestWebhookBase):
+    def setUp(self, *args, **kw):
+        super(TestWebhookDispatcher, self).setUp(*args, **kw)
+        self.wh2 = M.Webhook(
+            type='repo-push',
+            app_config_id=self.git.config._id,
+            hook_url='http://httpbin.org/post/2',
+            secret='secret')
+        session(self.wh2).flush(self.wh2)
+        self.helpers = [SendWebhookHelper(self.wh, 1),
+                        SendWebhookHelper(self.wh2, 2),
+                        SendWebhookHelper(self.wh, 3)]
+
+    @patch('allura.webhooks.send_webhook', autospec=True)
+    @patch('allura.webhooks.webhook_session', autospec=True)
+    def test_dispatch(self, webhook_session, send_webhook):
+        sent = []
+        active = []
+        lock = threading.Lock()
+
+        def post(url, data, **kw):
+            with lock:
+                active.append(url)
+                sent.append((url, json.loads(data), len(active)))
+            time.sleep(0.05)
+            with lock:
+                active.remove(url)
+            return Mock(status_code=500 if json.loads(data) == 2 else 200)
+        webhook_session.return_value.post.side_effect = post
+        dispatcher = WebhookDispatcher(threads=4, per_host=1)
+        assert_equal(dispatcher.dispatch(self.helpers), 2)
+        # all to one host, so one at a time
+        assert_equal(max(n for url, data, n in sent), 1)
+        # in order for each webhook
+        assert_equal([data for url, data, n in sent if url == self.wh.hook_url],
+                     [1, 3])
+        send_webhook.post.assert_called_once_with(self.wh2._id, 2, 1, delay=60)
+        for wh, counts in ((self.wh, (2, 0)), (self.wh2, (0, 1))):
+            session(wh).expunge(wh)
+            wh = M.Webhook.query.get(_id=wh._id)
+            assert_equal((wh.delivered, wh.failed), counts)
+
+    @patch('allura.webhooks.ThreadPool', autospec=True)
+    @patch('allura.webhooks.webhook_session', autospec=True)
+    def test_dispatch_joins_pool(self, webhook_session, ThreadPool):
+        pool = ThreadPool.return_value
+        pool.map.return_value = []
+        assert_equal(WebhookDispatcher().dispatch(self.helpers), 0)
+        pool.close.assert_called_once_with()
+        pool.join.assert_called_once_with()
+
+    @patch('allura.webhooks.WebhookDispatcher', autospec=True)
+    def test_send_webhooks_task(self, dispatcher):
+        send_webhooks([(self.wh._id, 1), (self.wh2._id, 2), (ObjectId(), 3)])
+        helpers = dispatcher.return_value.dispatch.call_args[0][0]
+        assert_equal([(hlp.webhook, hlp.payload) for hlp in helpers],
+                     [(self.wh, 1), (self.wh2, 2)])
 
 
 class TestRepoPushWebhookSender(TestWebhookBase):
@@ -521,6 +625,18 @@ def test_send(self, send_webhook):
             self.wh._id,
             sender.get_payload.return_value)
 
+    @patch('allura.webhooks.send_webhooks', autospec=True)
+    @patch('allura.webhooks.send_webhook', autospec=True)
+    def test_send_dispatch(self, send_webhook, send_webhooks):
+        sender = RepoPushWebhookSender()
+        sender.get_payload = Mock(side_effect=[1, 2])
+        with h.push_config(c, app=self.git), \
+                h.push_config(config, **{'webhook.dispatch_threads': '4'}):
+            sender.send([dict(arg1=1, arg2=2), dict(arg1=3, arg2=4)])
+        assert_equal(send_webhook.post.call_count, 0)
+        send_webhooks.post.assert_called_once_with(
+            [(self.wh._id, 1), (self.wh._id, 2)])
+
     @patch('allura.webhooks.send_webhook', autospec=True)
     def test_send_with_list(self, send_webhook):
         sender = RepoPushWebhookSender()
@@ -653,6 +769,8 @@ def test_json(self):
             'type': u'repo-push',
             'hook_url': u'http://httpbin.org/post',
             'mod_date': self.wh.mod_date,
+            'delivery': {'delivered': 0, 'failed': 0,
+                         'avg_latency': None, 'last_latency': None},
         }
         dd.assert_equal(self.wh.__json__(), expected)
 
@@ -706,6 +824,8 @@ def test_webhooks_list(self):
             'type': 'repo-push',
             'hook_url': 'http://httpbin.org/post/{}'.format(n),
             'mod_date': unicode(wh.mod_date),
+            'delivery': {'delivered': 0, 'failed': 0,
+                         'avg_latency': None, 'last_latency': None},
         } for n, wh in enumerate(self.webhooks)]
         expected = {
             'webhooks': webhooks,
@@ -727,6 +847,8 @@ def test_webhook_GET(self):
             'type': 'repo-push',
             'hook_url': 'http://httpbin.org/post/0',
             'mod_date': unicode(webhook.mod_date),
+            'delivery': {'delivered': 0, 'failed': 0,
+                         'avg_latency': None, 'last_latency': None},
         }
         dd.assert_equal(r.status_int, 200)
         dd.assert_equal(r.json, expected)
@@ -771,6 +893,8 @@ def test_create(self):
             'type': 'repo-push',
             'hook_url': data['url'],
             'mod_date': unicode(webhook.mod_date),
+            'delivery': {'delivered': 0, 'failed': 0,
+                         'avg_latency': None, 'last_latency': None},
         }
         dd.assert_equal(r.json, expected)
         assert_equal(M.Webhook.query.find().count(), len(self.webhooks) + 1)
@@ -831,6 +955,8 @@ def test_edit(self):
             'type': 'repo-push',
             'hook_url': data['url'],
             'mod_date': unicode(webhook.mod_date),
+            'delivery': {'delivered': 0, 'failed': 0,
+                         'avg_latency': None, 'last_latency': None},
         }
         dd.assert_equal(r.json, expected)
 
@@ -851,6 +977,8 @@ def test_edit(self):
             'type': 'repo-push',
             'hook_url': 'http://hook.slack.com/abcd',
             'mod_date': unicode(webhook.mod_date),
+            'delivery': {'delivered': 0, 'failed': 0,
+                         'avg_latency': None, 'last_latency': None},
         }
         dd.assert_equal(r.json, expected)
 
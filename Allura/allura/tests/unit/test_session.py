@@ -128,17 +128,18 @@ def setUp(self):
         self.ExtensionClass = ArtifactSessionExtension
         self.extension = self.ExtensionClass(session)
 
-    @mock.patch.object(allura.model.index.Shortlink, 'from_artifact')
-    @mock.patch.object(allura.model.index.ArtifactReference, 'from_artifact')
+    @mock.patch.object(allura.model.index.Shortlink, 'from_artifacts')
+    @mock.patch.object(allura.model.index.ArtifactReference, 'from_artifacts')
     @mock.patch('allura.model.session.index_tasks')
     def test_flush_skips_update(self, index_tasks, ref_fa, shortlink_fa):
         modified = [self._mock_indexable(_id=i) for i in range(5)]
         modified[1].should_update_index.return_value = False
         modified[4].should_update_index.return_value = False
-        ref_fa.side_effect = lambda obj: mock.Mock(_id=obj._id)
+        ref_fa.side_effect = lambda objs: [mock.Mock(_id=obj._id) for obj in objs]
         self.extension.objects_modified = modified
         self.extension.after_flush()
-        index_tasks.add_artifacts.post.assert_called_once_with([0, 2, 3])
+        index_tasks.add_artifacts.post.assert_called_once_with(
+            [0, 2, 3], dedupe_key='artifacts', dedupe='union')
 
     @mock.patch('allura.model.session.index_tasks')
     def test_flush_skips_task_if_all_objects_filtered_out(self, index_tasks):
@@ -15,16 +15,18 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import hashlib
 import unittest
 
 import mock
+import pysolr
 from nose.tools import assert_equal
 from markupsafe import Markup
 
 from allura.lib import helpers as h
 from allura.tests import decorators as td
 from alluratest.controller import setup_basic_test
-from allura.lib.solr import Solr, escape_solr_arg
+from allura.lib.solr import Solr, MockSOLR, escape_solr_arg, pop_push_times
 from allura.lib.search import search_app, SearchIndexable
 
 
@@ -45,6 +47,20 @@ def test_init(self, pysolr):
         pysolr.Solr.assert_has_calls(calls)
         assert_equal(len(solr.push_pool), 2)
 
+    @mock.patch('allura.lib.solr.ThreadPool')
+    @mock.patch('allura.lib.solr.os.getpid')
+    def test_get_pool(self, getpid, ThreadPool):
+        getpid.return_value = 1
+        ThreadPool.side_effect = lambda size: mock.Mock(size=size)
+        pool = Solr._get_pool(2)
+        assert_equal(pool.size, 2)
+        assert Solr._get_pool(2) is pool
+        assert_equal(Solr._get_pool(3).size, 3)
+        # a forked child gets new pools
+        getpid.return_value = 2
+        assert Solr._get_pool(2) is not pool
+        Solr._pools_pid = None
+
     @mock.patch('allura.lib.solr.pysolr')
     def test_add(self, pysolr):
         servers = ['server1', 'server2']
@@ -81,6 +97,46 @@ def test_commit(self, pysolr):
         calls = [mock.call('arg', kw='kw')] * 2
         pysolr.Solr().commit.assert_has_calls(calls)
 
+    @mock.patch('allura.lib.solr.pysolr')
+    def test_add_batches(self, pysolr):
+        solr = Solr(['server1'], commit=False, batch_size=2)
+        solr.add(['a', 'b', 'c', 'd', 'e'], commit=True)
+        assert_equal(pysolr.Solr().add.call_args_list, [
+            mock.call(['a', 'b'], commit=False),
+            mock.call(['c', 'd'], commit=False),
+            mock.call(['e'], commit=True),
+        ])
+
+    @mock.patch('allura.lib.solr.time.sleep')
+    @mock.patch('allura.lib.solr.pysolr.Solr')
+    def test_push_retries(self, pysolr_Solr, sleep):
+        solr = Solr(['server1'], retries=2, retry_delay=1)
+        pysolr_Solr().delete.side_effect = [pysolr.SolrError('down'), 'ok']
+        assert_equal(solr.delete('foo'), ['ok'])
+        assert_equal(pysolr_Solr().delete.call_count, 2)
+        sleep.assert_called_once_with(1)
+
+        sleep.reset_mock()
+        pysolr_Solr().commit.side_effect = pysolr.SolrError('down')
+        with self.assertRaises(pysolr.SolrError):
+            solr.commit()
+        assert_equal(pysolr_Solr().commit.call_count, 3)
+        assert_equal(sleep.call_args_list, [mock.call(1), mock.call(2)])
+
+    @mock.patch('allura.lib.solr.pysolr.Solr')
+    def test_push_concurrent(self, pysolr_Solr):
+        servers = [mock.Mock(url='server1'), mock.Mock(url='server2')]
+        servers[0].add.side_effect = pysolr.SolrError('down')
+        pysolr_Solr.side_effect = servers
+        solr = Solr(['server1', 'server2'], push_threads=2)
+        pop_push_times()
+        with self.assertRaises(pysolr.SolrError):
+            solr.add(['doc'])
+        # the other server still gets the update
+        servers[1].add.assert_called_once_with(['doc'], commit=True)
+        assert_equal(sorted(pop_push_times()), ['server1', 'server2'])
+        assert_equal(pop_push_times(), {})
+
     @mock.patch('allura.lib.solr.pysolr')
     def test_search(self, pysolr):
         servers = ['server1', 'server2']
@@ -91,6 +147,17 @@ def test_search(self, pysolr):
         solr.search('bar', kw='kw')
         solr.query_server.search.assert_called_once_with('bar', kw='kw')
 
+    def test_mock_search_facet_queries(self):
+        solr = MockSOLR()
+        solr.add([dict(id='1', text='', status_s='open', type_s='Ticket'),
+                  dict(id='2', text='', status_s='closed', type_s='Ticket'),
+                  dict(id='3', text='', status_s='open', type_s='Bin')])
+        r = solr.search('*:*', fq=['type_s:Ticket'], rows=0, facet='true',
+                        **{'facet.query': ['{!key=0}status_s:open',
+                                           '{!key=1}status_s:closed',
+                                           '{!key=2}status_s:new']})
+        assert_equal(r.facets['facet_queries'], {'0': 1, '1': 1, '2': 0})
+
     @mock.patch('allura.lib.search.search')
     def test_site_admin_search(self, search):
         from allura.lib.search import site_admin_search
@@ -140,6 +207,15 @@ def test_solarize_html_in_text(self):
         self.obj.index = lambda: dict(text='&lt;script&gt;a(1)&lt;/script&gt;')
         assert_equal(self.obj.solarize(), dict(text='<script>a(1)</script>'))
 
+    def test_solarize_uses_markdown_cache(self):
+        self.obj.text = 'source'
+        self.obj.text_cache = mock.Mock(
+            md5=hashlib.md5('source').hexdigest(), html='<p>cached</p>', fix7528=2)
+        self.obj.index = lambda: dict(text='source')
+        assert_equal(self.obj.solarize(), dict(text='cached'))
+        # links are only known from a fresh render
+        assert_equal(self.obj.solarize(shortlinks=[]), dict(text='source'))
+
 
 class TestSearch_app(unittest.TestCase):
 
@@ -19,9 +19,14 @@
 import json
 import hmac
 import hashlib
+import sys
 import time
 import socket
 import ssl
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from urlparse import urlparse
 
 import requests
 from bson import ObjectId
@@ -313,6 +318,27 @@ def _delete(self, webhook):
         return {'result': 'ok'}
 
 
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def webhook_session(url):
+    """Return the :class:`requests.Session` used to send webhooks to the host
+    of ``url``, shared within the process so connections are kept alive
+    across deliveries"""
+    parts = urlparse(url)
+    key = (parts.scheme, parts.netloc)
+    with _sessions_lock:
+        sess = _sessions.get(key)
+        if sess is None:
+            sess = requests.Session()
+            pool_size = max(asint(config.get('webhook.dispatch_per_host', 4)), 1)
+            sess.mount('%s://' % parts.scheme,
+                       requests.adapters.HTTPAdapter(pool_maxsize=pool_size))
+            _sessions[key] = sess
+        return sess
+
+
 class SendWebhookHelper(object):
     def __init__(self, webhook, payload):
         self.webhook = webhook
@@ -348,46 +374,141 @@ def log_msg(self, msg, response=None):
                 response.headers)
         return message
 
-    def send(self):
+    def prepare(self):
+        """Return the body and headers to post"""
         json_payload = json.dumps(self.payload, cls=DateJSONEncoder)
         signature = self.sign(json_payload)
         headers = {'content-type': 'application/json',
                    'User-Agent': 'Allura Webhook (https://allura.apache.org/)',
                    'X-Allura-Signature': signature}
-        ok = self._send(self.webhook.hook_url, json_payload, headers)
-        if not ok:
-            log.info('Retrying webhook in: %s', self.retries)
-            for t in self.retries:
-                log.info('Retrying webhook in %s seconds', t)
-                time.sleep(t)
-                ok = self._send(self.webhook.hook_url, json_payload, headers)
-                if ok:
-                    return
-
-    def _send(self, url, data, headers):
+        return json_payload, headers
+
+    def send(self, attempt=0):
+        """Send the payload.  If that fails, post a task to try again after
+        the next pause in :attr:`retries` (``attempt`` is the number of
+        tries so far)"""
+        json_payload, headers = self.prepare()
+        result = self.post(self.webhook.hook_url, json_payload, headers, self.timeout)
+        return self.finish(result, attempt)
+
+    def post(self, url, data, headers, timeout):
+        """Post to the webhook, returning the response (None if there was
+        none), the exc_info of the error if any, and the time taken.
+
+        Doesn't touch the database or config, so it can be run in another
+        thread once :func:`webhook_session` has been set up for the host.
+        """
+        start = time.time()
         try:
-            r = requests.post(
+            r = webhook_session(url).post(
                 url,
                 data=data,
                 headers=headers,
-                timeout=self.timeout)
+                timeout=timeout)
         except (requests.exceptions.RequestException,
                 socket.timeout,
                 ssl.SSLError):
-            log.exception(self.log_msg('Webhook send error'))
-            return False
-        if r.status_code >= 200 and r.status_code < 300:
+            return None, sys.exc_info(), time.time() - start
+        return r, None, time.time() - start
+
+    def finish(self, result, attempt=0):
+        """Log and count the result of :meth:`post`, and schedule a retry if
+        it failed.  Returns whether it succeeded."""
+        r, exc_info, elapsed = result
+        ok = r is not None and 200 <= r.status_code < 300
+        if ok:
             log.info(self.log_msg('Webhook successfully sent'))
-            return True
+        elif r is None:
+            log.error(self.log_msg('Webhook send error'), exc_info=exc_info)
         else:
             log.error(self.log_msg('Webhook send error', response=r))
-            return False
+        self.webhook.record_delivery(ok, elapsed)
+        if not ok:
+            self.retry(attempt)
+        return ok
+
+    def retry(self, attempt):
+        retries = self.retries
+        if attempt >= len(retries):
+            log.info('Giving up on webhook after %s retries', attempt)
+            return
+        log.info('Retrying webhook in %s seconds', retries[attempt])
+        send_webhook.post(self.webhook._id, self.payload, attempt + 1,
+                          delay=retries[attempt])
+
+
+class WebhookDispatcher(object):
+    """Sends many webhook payloads concurrently, over up to
+    webhook.dispatch_threads threads and at most webhook.dispatch_per_host
+    requests at a time to any one host.  Payloads for the same webhook are
+    sent in order, one after the other.
+    """
+
+    def __init__(self, threads=None, per_host=None):
+        if threads is None:
+            threads = asint(config.get('webhook.dispatch_threads', 0))
+        if per_host is None:
+            per_host = asint(config.get('webhook.dispatch_per_host', 4))
+        self.threads = max(threads, 1)
+        self.per_host = max(per_host, 1)
+
+    def dispatch(self, helpers):
+        """Send the payloads of ``helpers`` (:class:`SendWebhookHelper`
+        objects), returning how many were delivered"""
+        by_webhook = OrderedDict()
+        posts = []
+        limits = {}
+        for helper in helpers:
+            by_webhook.setdefault(helper.webhook._id, []).append(len(posts))
+            url = helper.webhook.hook_url
+            data, headers = helper.prepare()
+            posts.append((helper, url, data, headers, helper.timeout))
+            host = urlparse(url).netloc
+            if host not in limits:
+                limits[host] = threading.Semaphore(self.per_host)
+                webhook_session(url)
+
+        def post_all(indexes):
+            results = []
+            for i in indexes:
+                helper, url, data, headers, timeout = posts[i]
+                with limits[urlparse(url).netloc]:
+                    results.append((i, helper.post(url, data, headers, timeout)))
+            return results
+
+        pool = ThreadPool(min(self.threads, len(by_webhook) or 1))
+        try:
+            results = pool.map(post_all, by_webhook.values())
+        finally:
+            pool.close()
+            pool.join()
+        # back in this thread, since recording and retrying use the database
+        delivered = 0
+        for i, result in sorted(sum(results, [])):
+            delivered += posts[i][0].finish(result)
+        return delivered
 
 
 @task()
-def send_webhook(webhook_id, payload):
+def send_webhook(webhook_id, payload, attempt=0):
     webhook = M.Webhook.query.get(_id=webhook_id)
-    SendWebhookHelper(webhook, payload).send()
+    if webhook is None:
+        log.info('Webhook %s was removed, not sending it', webhook_id)
+        return
+    SendWebhookHelper(webhook, payload).send(attempt)
+
+
+@task()
+def send_webhooks(deliveries):
+    """Send a list of ``(webhook_id, payload)`` with a
+    :class:`WebhookDispatcher`"""
+    ids = list(set(webhook_id for webhook_id, payload in deliveries))
+    webhooks = dict((wh._id, wh) for wh in M.Webhook.query.find(dict(_id={'$in': ids})))
+    helpers = [SendWebhookHelper(webhooks[webhook_id], payload)
+               for webhook_id, payload in deliveries
+               if webhook_id in webhooks]
+    delivered = WebhookDispatcher().dispatch(helpers)
+    log.info('Delivered %s of %s webhook payloads', delivered, len(helpers))
 
 
 class WebhookSender(object):
@@ -423,13 +544,20 @@ def send(self, params_or_list):
         if webhooks:
             payloads = [self.get_payload(**params)
                         for params in params_or_list]
+            deliveries = []
             for webhook in webhooks:
                 if webhook.enforce_limit():
                     webhook.update_limit()
-                    for payload in payloads:
-                        send_webhook.post(webhook._id, payload)
+                    deliveries.extend((webhook._id, payload) for payload in payloads)
                 else:
                     log.warn('Webhook fires too often: %s. Skipping', webhook)
+            if asint(config.get('webhook.dispatch_threads', 0)) > 0:
+                # send them all from one task, concurrently
+                if deliveries:
+                    send_webhooks.post(deliveries)
+            else:
+                for webhook_id, payload in deliveries:
+                    send_webhook.post(webhook_id, payload)
 
     def enforce_limit(self, app):
         '''
@@ -114,6 +114,8 @@ def git_timers():
         Timer('git_lib.{method_name}', git.Repo,
               'rev_parse', 'iter_commits', 'commit'),
         Timer('git_lib.{method_name}', GM.git_repo.GitLibCmdWrapper, 'log'),
+        Timer('git_repo_pool.{method_name}', GM.git_repo.GitRepoPool,
+              'spawn', 'evict'),
     ]
 
 
@@ -20,6 +20,8 @@
 import string
 import logging
 import tempfile
+import threading
+from collections import OrderedDict
 from datetime import datetime
 from contextlib import contextmanager
 from time import time
@@ -29,7 +31,7 @@
 import gitdb
 from pylons import tmpl_context as c
 from pymongo.errors import DuplicateKeyError
-from paste.deploy.converters import asbool
+from paste.deploy.converters import asbool, asint
 
 from ming.base import Object
 from ming.orm import Mapper, session
@@ -57,6 +59,91 @@ def log(self, *args, **kwargs):
         return self.client.log(*args, **kwargs)
 
 
+class GitRepoPool(object):
+    '''
+    Per-thread LRU of open git.Repo objects, keyed by filesystem path.
+
+    GitCmdObjectDB reads objects through long-lived ``git cat-file --batch``
+    and ``--batch-check`` processes owned by the Repo, so keeping the Repo
+    around between requests (or tasks) saves spawning git for every blob and
+    tree read.  Those processes can't be shared between threads, so each
+    thread gets its own pool.
+
+    Configured by scm.git.repo_pool.size (0 disables pooling) and
+    scm.git.repo_pool.idle_timeout (seconds).
+    '''
+
+    def __init__(self, size=None, idle_timeout=None):
+        self._size = size
+        self._idle_timeout = idle_timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.stats = dict(hits=0, spawns=0, evictions=0)
+
+    @property
+    def size(self):
+        if self._size is not None:
+            return self._size
+        return asint(tg.config.get('scm.git.repo_pool.size', 10))
+
+    @property
+    def idle_timeout(self):
+        if self._idle_timeout is not None:
+            return self._idle_timeout
+        return asint(tg.config.get('scm.git.repo_pool.idle_timeout', 300))
+
+    @property
+    def _repos(self):
+        repos = getattr(self._local, 'repos', None)
+        if repos is None:
+            repos = self._local.repos = OrderedDict()
+        return repos
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def get(self, path):
+        if self.size <= 0:
+            return self.spawn(path)
+        self.evict_idle()
+        repos = self._repos
+        if path in repos:
+            repo, last_used = repos.pop(path)
+            self._count('hits')
+        else:
+            repo = self.spawn(path)
+        repos[path] = (repo, time())
+        while len(repos) > self.size:
+            self.evict(next(iter(repos)))
+        return repo
+
+    def spawn(self, path):
+        repo = git.Repo(path, odbt=git.GitCmdObjectDB)
+        repo.git = GitLibCmdWrapper(repo.git)
+        self._count('spawns')
+        return repo
+
+    def evict(self, path):
+        entry = self._repos.pop(path, None)
+        if entry is None:
+            return
+        # kills the persistent cat-file processes
+        entry[0].git.clear_cache()
+        self._count('evictions')
+
+    def evict_idle(self):
+        if not self.idle_timeout:
+            return
+        cutoff = time() - self.idle_timeout
+        for path, (repo, last_used) in self._repos.items():
+            if last_used < cutoff:
+                self.evict(path)
+
+
+repo_pool = GitRepoPool()
+
+
 class Repository(M.Repository):
     tool_name = 'Git'
     repo_id = 'git'
@@ -135,6 +222,7 @@ def merge(self, mr):
             h.absurl(mr.url()))
         tmp_repo.git.merge(mr.downstream.commit_id, '-m', msg)
         tmp_repo.git.push('origin', mr.target_branch)
+        repo_pool.evict(tmp_path)
         shutil.rmtree(tmp_path, ignore_errors=True)
 
     def rev_to_commit_id(self, rev):
@@ -159,9 +247,7 @@ def __init__(self, repo):
     @LazyProperty
     def _git(self):
         try:
-            _git = git.Repo(self._repo.full_fs_path, odbt=git.GitCmdObjectDB)
-            _git.git = GitLibCmdWrapper(_git.git)
-            return _git
+            return repo_pool.get(self._repo.full_fs_path)
         except (git.exc.NoSuchPathError, git.exc.InvalidGitRepositoryError), err:
             log.error('Problem looking up repo: %r', err)
             return None
@@ -169,6 +255,7 @@ def _git(self):
     def init(self):
         fullname = self._setup_paths()
         log.info('git init %s', fullname)
+        repo_pool.evict(self._repo.full_fs_path)
         if os.path.exists(fullname):
             shutil.rmtree(fullname)
         repo = git.Repo.init(
@@ -194,6 +281,7 @@ def clone_from(self, source_url):
                  self._repo, source_url)
         try:
             fullname = self._setup_paths(create_repo_dir=False)
+            repo_pool.evict(self._repo.full_fs_path)
             if os.path.exists(fullname):
                 shutil.rmtree(fullname)
             if self.can_hotcopy(source_url):
@@ -250,27 +338,38 @@ def all_commit_ids(self):
             yield ci.hexsha
 
     def new_commits(self, all_commits=False):
+        from allura.model.repo_refresh import unknown_commit_ids, QSIZE
         graph = {}
+        known, unknown = set(), set()
+
+        def is_known(obj):
+            if obj.hexsha not in known and obj.hexsha not in unknown:
+                # look up this commit along with the ancestors we're likely
+                # to visit next, in one query
+                oids = [ci.hexsha for ci in self._git.iter_commits(obj, max_count=QSIZE)]
+                new = set(unknown_commit_ids(oids, self._repo))
+                unknown.update(new)
+                known.update(oid for oid in oids if oid not in new)
+            return obj.hexsha in known
 
         to_visit = [self._git.commit(rev=hd.object_id) for hd in self.heads]
         while to_visit:
             obj = to_visit.pop()
             if obj.hexsha in graph:
                 continue
-            if not all_commits:
-                # Look up the object
-                if M.repository.Commit.query.find(dict(_id=obj.hexsha)).count():
-                    graph[obj.hexsha] = set()  # mark as parentless
-                    continue
+            if not all_commits and is_known(obj):
+                graph[obj.hexsha] = set()  # mark as parentless
+                continue
             graph[obj.hexsha] = set(p.hexsha for p in obj.parents)
             to_visit += obj.parents
         return list(topological_sort(graph))
 
-    def refresh_commit_info(self, oid, seen, lazy=True):
+    def refresh_commit_info(self, oid, seen, lazy=True, batch=None):
         from allura.model.repository import CommitDoc
-        ci_doc = CommitDoc.m.get(_id=oid)
-        if ci_doc and lazy:
-            return False
+        if batch is None:
+            ci_doc = CommitDoc.m.get(_id=oid)
+            if ci_doc and lazy:
+                return False
         ci = self._git.rev_parse(oid)
         args = dict(
             tree_id=ci.tree.hexsha,
@@ -285,6 +384,11 @@ def refresh_commit_info(self, oid, seen, lazy=True):
             message=h.really_unicode(ci.message or ''),
             child_ids=[],
             parent_ids=[p.hexsha for p in ci.parents])
+        if batch is not None:
+            # trees first, see RefreshBatch
+            self.refresh_tree_info(ci.tree, seen, lazy, batch)
+            batch.upsert(CommitDoc, ci.hexsha, args, overwrite=not lazy)
+            return True
         if ci_doc:
             ci_doc.update(**args)
             ci_doc.m.save()
@@ -298,7 +402,7 @@ def refresh_commit_info(self, oid, seen, lazy=True):
         self.refresh_tree_info(ci.tree, seen, lazy)
         return True
 
-    def refresh_tree_info(self, tree, seen, lazy=True):
+    def refresh_tree_info(self, tree, seen, lazy=True, batch=None):
         from allura.model.repository import TreeDoc
         if lazy and tree.binsha in seen:
             return
@@ -315,14 +419,20 @@ def refresh_tree_info(self, tree, seen, lazy=True):
                 name=h.really_unicode(o.name),
                 id=o.hexsha)
             if o.type == 'tree':
-                self.refresh_tree_info(o, seen, lazy)
+                self.refresh_tree_info(o, seen, lazy, batch)
                 doc.tree_ids.append(obj)
             elif o.type == 'blob':
                 doc.blob_ids.append(obj)
             else:
                 obj.type = o.type
                 doc.other_ids.append(obj)
-        doc.m.save(safe=False)
+        if batch is None:
+            doc.m.save(safe=False)
+        else:
+            batch.upsert(TreeDoc, doc._id, dict(
+                tree_ids=doc.tree_ids,
+                blob_ids=doc.blob_ids,
+                other_ids=doc.other_ids), overwrite=not lazy)
         return doc
 
     def log(self, revs=None, path=None, exclude=None, id_only=True, **kw):
@@ -470,7 +580,8 @@ def open_blob(self, blob):
             self._object(blob._id).data_stream)
 
     def blob_size(self, blob):
-        return self._object(blob._id).data_stream.size
+        # header only (cat-file --batch-check), doesn't read the blob
+        return self._git.odb.info(gitdb.util.hex_to_bin(blob._id)).size
 
     def _setup_hooks(self, source_path=None):
         'Set up the git post-commit hook'
@@ -612,6 +723,100 @@ def set_default_branch(self, name):
         self._repo.default_branch_name = name
         session(self._repo).flush(self._repo)
 
+    def last_commit_ids(self, commit, paths):
+        '''
+        Return a mapping {path: commit_id} of the _id of the last
+        commit to touch each path, starting from the given commit.
+
+        Unlike the generic implementation, which runs one ``git log``
+        per commit found for each chunk of paths (in a thread per chunk),
+        this streams a single ``git log --name-only`` and resolves every
+        path in one pass, stopping as soon as all of them are found, the
+        ``lcd_timeout`` passes, or ``lcd_max_commits`` (if non-zero)
+        commits have been read.
+        '''
+        if not paths:
+            return {}
+        timeout = float(tg.config.get('lcd_timeout', 60))
+        max_commits = asint(tg.config.get('lcd_max_commits', 0))
+        start_time = time()
+        # git takes and writes utf-8 bytes; map them back to the given paths
+        git_paths = [p.encode('utf-8') if isinstance(p, unicode) else p
+                     for p in paths]
+        remaining = dict(zip(git_paths, paths))
+        result = {}
+        try:
+            # the paths themselves, not their directory: git simplifies the
+            # history (which side of a merge it follows) by the pathspec.
+            # Merge commits have no --name-only output, so they're skipped
+            # just like in _get_last_commit.  A merge that kept one side's
+            # version of a path while another path changed on both sides can
+            # still let a discarded change to the first path through, which
+            # a log of just that path would have pruned.
+            # -z so that git doesn't quote and escape non-ascii paths
+            proc = self._git.git.log(commit._id, '--', *git_paths,
+                                     format='%x00%H', name_only=True, z=True,
+                                     as_process=True)
+        except Exception as e:
+            log.exception('Error in SCM log: %s', e)
+            return result
+        try:
+            commit_id = None
+            num_commits = 0
+            for prev, field in self._log_fields(proc.stdout):
+                if prev == '':
+                    # each commit's '\x00<id>' follows a \x00-terminated field
+                    commit_id = field
+                    num_commits += 1
+                    if max_commits and num_commits > max_commits:
+                        log.info('last_commit_ids stopped after %s commits for %s', max_commits, commit._id)
+                        break
+                    if time() - start_time >= timeout:
+                        log.error('last_commit_ids timeout for %s on %s',
+                                  commit._id, ', '.join(remaining.values()))
+                        break
+                    continue
+                if not field or not commit_id:
+                    continue
+                if prev == commit_id and field.startswith('\n'):
+                    # the first path is on the line after the commit id
+                    field = field[1:]
+                # the changed file or any of its parent dirs may be wanted
+                parts = field.split('/')
+                for i in range(len(parts)):
+                    path = '/'.join(parts[:i + 1])
+                    if path in remaining:
+                        result[remaining.pop(path)] = commit_id
+                if not remaining:
+                    break
+        finally:
+            # stop git if we didn't need the rest of the log (proc is a
+            # GitPython AutoInterrupt, whose wait() raises if git was killed)
+            if proc.poll() is None:
+                proc.kill()
+            proc.proc.wait()
+        return result
+
+    @staticmethod
+    def _log_fields(stream, bufsize=8192):
+        '''
+        Yield ``(previous, field)`` for each \\x00-terminated field of a
+        ``git log -z`` stream, as soon as git has written it.
+        '''
+        prev = None
+        buf = ''
+        while True:
+            chunk = os.read(stream.fileno(), bufsize)
+            if not chunk:
+                break
+            fields = (buf + chunk).split('\x00')
+            buf = fields.pop()
+            for field in fields:
+                yield prev, field
+                prev = field
+        if buf:
+            yield prev, buf
+
     def _get_last_commit(self, commit_id, paths):
         # git apparently considers merge commits to have "touched" a path
         # if the path is changed in either branch being merged, even though
@@ -775,6 +980,8 @@ def __iter__(self):
             buffer = buffer[eol + 1:]
 
     def close(self):
-        pass
+        # read what's left, so the persistent cat-file process stays in sync
+        while self._stream.read(self.CHUNK_SIZE):
+            pass
 
 Mapper.compile_all()
@@ -39,7 +39,8 @@
 from allura.tests import decorators as td
 from allura.tests.model.test_repo import RepoImplTestBase
 from allura import model as M
-from allura.model.repo_refresh import send_notifications
+from allura.model.repo_refresh import send_notifications, unknown_commit_ids
+from allura.scripts.refresh_last_commits import RefreshLastCommits
 from allura.webhooks import RepoPushWebhookSender
 from forgegit import model as GM
 from forgegit.tests import with_git
@@ -151,6 +152,20 @@ def merge_request(self):
             source_branch='zz',
             target_branch='master')
 
+    @mock.patch('allura.scripts.refresh_last_commits.refresh')
+    def test_refresh_last_commits_script(self, refresh):
+        # as if the repo were refreshed before the index existed
+        repo = GM.Repository.query.get(_id=self.repo._id)
+        repo.lcd_index_complete = False
+        ThreadLocalORMSession.flush_all()
+        options = RefreshLastCommits.parser().parse_args(
+            ['--project', 'test', '--mount-point', 'src-git'])
+        RefreshLastCommits.execute(options)
+        ThreadLocalORMSession.close_all()
+        repo = GM.Repository.query.get(_id=self.repo._id)
+        assert repo.lcd_index_complete
+        assert_equal(repo.status, 'ready')
+
     def test_init(self):
         repo = GM.Repository(
             name='testgit.git',
@@ -411,6 +426,16 @@ def test_all_commit_ids(self):
         # repo root comes last
         self.assertEqual(cids[-1], '9a7df788cf800241e3bb5a849c8870f2f8259d98')
 
+    def test_new_commits(self):
+        cids = list(self.repo.all_commit_ids())
+        # the known commits reached first are included too, without parents
+        new = self.repo._impl.new_commits()
+        assert_equal(unknown_commit_ids(new), [])
+        assert_equal(sorted(self.repo._impl.new_commits(all_commits=True)), sorted(cids))
+        M.repository.CommitDoc.m.remove(dict(_id={'$in': cids[:2]}))
+        new = self.repo._impl.new_commits()
+        assert_equal(sorted(unknown_commit_ids(new)), sorted(cids[:2]))
+
     def test_ls(self):
         c.lcid_cache = {}  # else it'll be a mock
         lcd_map = self.repo.commit('HEAD').tree.ls()
@@ -871,6 +896,62 @@ def test_last_commit_ids(self):
             'f2.txt': '259c77dd6ee0e6091d11e429b56c44ccbf1e64a3',
         })
 
+    def test_last_commit_ids_merge(self):
+        # same as logging each path by itself, through the merge
+        repo_dir = pkg_resources.resource_filename(
+            'forgegit', 'tests/data/testrename.git')
+        repo = mock.Mock(full_fs_path=repo_dir)
+        impl = GM.git_repo.GitImplementation(repo)
+        merge = '13951944969cf45a701bf90f83647b309815e6d5'
+        paths = ['f2.txt', 'f3.txt']
+        lcds = impl.last_commit_ids(mock.Mock(_id=merge), paths)
+        for path in paths:
+            self.assertEqual(lcds[path], impl._get_last_commit(merge, set([path]))[0])
+        # the log is limited to the paths, not their directory
+        with mock.patch.object(impl._git.git, 'log', wraps=impl._git.git.log) as log:
+            impl.last_commit_ids(mock.Mock(_id=merge), paths)
+        self.assertEqual(log.call_args[0], (merge, '--', 'f2.txt', 'f3.txt'))
+
+    def test_last_commit_ids_max_commits(self):
+        # the merge commit counts towards the limit
+        with h.push_config(tg.config, lcd_max_commits=2):
+            repo_dir = pkg_resources.resource_filename(
+                'forgegit', 'tests/data/testrename.git')
+            repo = mock.Mock(full_fs_path=repo_dir)
+            impl = GM.git_repo.GitImplementation(repo)
+            lcds = impl.last_commit_ids(
+                mock.Mock(_id='13951944969cf45a701bf90f83647b309815e6d5'), ['f2.txt', 'f3.txt'])
+            self.assertEqual(lcds, {
+                'f3.txt': '653667b582ef2950c1954a0c7e1e8797b19d778a',
+            })
+
+    def test_last_commit_ids_subdir(self):
+        repo_dir = pkg_resources.resource_filename(
+            'forgegit', 'tests/data/testgit.git')
+        repo = mock.Mock(full_fs_path=repo_dir)
+        impl = GM.git_repo.GitImplementation(repo)
+        commit_id = '1e146e67985dcd71c74de79613719bef7bddca4a'
+        lcds = impl.last_commit_ids(mock.Mock(_id=commit_id), ['a/b', 'a/b/c'])
+        self.assertEqual(lcds, {
+            'a/b': '6a45885ae7347f1cac5103b0050cc1be6a1496c8',
+            'a/b/c': '6a45885ae7347f1cac5103b0050cc1be6a1496c8',
+        })
+
+    def test_last_commit_ids_unicode(self):
+        # git quotes non-ascii paths unless told not to
+        repo_dir = pkg_resources.resource_filename(
+            'forgegit', 'tests/data/weird-chars.git')
+        repo = mock.Mock(full_fs_path=repo_dir)
+        impl = GM.git_repo.GitImplementation(repo)
+        commit_id = '346c52c1dddc729e2c2711f809336401f0ff925e'
+        path = u'copies/\u043f\u0440\u0438\u0432\u0456\u0442.txt'
+        lcds = impl.last_commit_ids(mock.Mock(_id=commit_id), [path, u'copies', u'README'])
+        self.assertEqual(lcds, {
+            path: '2d14b961ade8540113df9107be045e4ae4136ac5',
+            u'copies': '2d14b961ade8540113df9107be045e4ae4136ac5',
+            u'README': '346c52c1dddc729e2c2711f809336401f0ff925e',
+        })
+
     def test_last_commit_ids_threaded(self):
         with h.push_config(tg.config, lcd_thread_chunk_size=1):
             self.test_last_commit_ids()
@@ -888,6 +969,71 @@ def test_last_commit_ids_threaded_error(self, _git):
             self.assertEqual(lcds, {})
 
 
+class TestGitRepoPool(unittest.TestCase):
+
+    def setUp(self):
+        self.repo_dir = pkg_resources.resource_filename(
+            'forgegit', 'tests/data/testgit.git')
+        self.other_dir = pkg_resources.resource_filename(
+            'forgegit', 'tests/data/testrename.git')
+
+    def test_get(self):
+        pool = GM.git_repo.GitRepoPool(size=1, idle_timeout=0)
+        repo = pool.get(self.repo_dir)
+        assert_equal(pool.get(self.repo_dir), repo)
+        assert_equal(pool.stats, dict(hits=1, spawns=1, evictions=0))
+        other = pool.get(self.other_dir)
+        assert other is not repo
+        assert_equal(pool.stats, dict(hits=1, spawns=2, evictions=1))
+        assert pool.get(self.repo_dir) is not repo
+
+    def test_disabled(self):
+        pool = GM.git_repo.GitRepoPool(size=0)
+        assert pool.get(self.repo_dir) is not pool.get(self.repo_dir)
+        assert_equal(pool.stats, dict(hits=0, spawns=2, evictions=0))
+
+    def test_evict_idle(self):
+        pool = GM.git_repo.GitRepoPool(size=5, idle_timeout=60)
+        pool.get(self.repo_dir)
+        with mock.patch('forgegit.model.git_repo.time') as time:
+            time.return_value = 10 ** 10
+            pool.get(self.other_dir)
+        assert_equal(pool.stats, dict(hits=0, spawns=2, evictions=1))
+
+    def test_enabled_by_config(self):
+        # test.ini turns pooling off; these are the development.ini defaults
+        pool = GM.git_repo.GitRepoPool()
+        config = {'scm.git.repo_pool.size': 10,
+                  'scm.git.repo_pool.idle_timeout': 300}
+        with h.push_config(tg.config, **config), \
+                mock.patch('forgegit.model.git_repo.repo_pool', pool):
+            repo = mock.Mock(full_fs_path=self.repo_dir)
+            _git = GM.git_repo.GitImplementation(repo)._git
+            assert GM.git_repo.GitImplementation(repo)._git is _git
+            assert_equal(pool.stats, dict(hits=1, spawns=1, evictions=0))
+            pool.evict(self.repo_dir)
+            assert GM.git_repo.GitImplementation(repo)._git is not _git
+            assert_equal(pool.stats, dict(hits=1, spawns=2, evictions=1))
+            # least recently used goes first
+            with h.push_config(tg.config, **{'scm.git.repo_pool.size': 1}):
+                pool.get(self.other_dir)
+            assert_equal(pool.stats, dict(hits=1, spawns=3, evictions=2))
+            assert_equal(pool.get(self.other_dir), pool.get(self.other_dir))
+            assert_equal(pool.stats, dict(hits=3, spawns=3, evictions=2))
+
+    @mock.patch('forgegit.model.git_repo.repo_pool', GM.git_repo.GitRepoPool(size=1))
+    def test_blob_reads_share_cat_file(self):
+        repo = mock.Mock(full_fs_path=self.repo_dir)
+        impl = GM.git_repo.GitImplementation(repo)
+        blob = mock.Mock(_id='be00c63250248c284b842deee5d8fb0b8132acab')
+        assert_equal(impl.blob_size(blob), 28)
+        f = impl.open_blob(blob)
+        f.close()
+        impl = GM.git_repo.GitImplementation(repo)
+        assert_equal(len(impl.open_blob(blob).read()), 28)
+        assert_equal(GM.git_repo.repo_pool.stats['hits'], 1)
+
+
 class TestGitCommit(unittest.TestCase):
 
     def setUp(self):
@@ -362,11 +362,12 @@ def new_commits(self, all_commits=False):
             seen_oids.add(oid)
         return [o for o in oids if o not in seen_oids]
 
-    def refresh_commit_info(self, oid, seen_object_ids, lazy=True):
+    def refresh_commit_info(self, oid, seen_object_ids, lazy=True, batch=None):
         from allura.model.repository import CommitDoc
-        ci_doc = CommitDoc.m.get(_id=oid)
-        if ci_doc and lazy:
-            return False
+        if batch is None:
+            ci_doc = CommitDoc.m.get(_id=oid)
+            if ci_doc and lazy:
+                return False
         revno = self._revno(oid)
         rev = self._revision(oid)
         try:
@@ -395,6 +396,9 @@ def refresh_commit_info(self, oid, seen_object_ids, lazy=True):
             child_ids=[])
         if revno > 1:
             args['parent_ids'] = [self._oid(revno - 1)]
+        if batch is not None:
+            batch.upsert(CommitDoc, oid, args, overwrite=not lazy)
+            return True
         if ci_doc:
             ci_doc.update(**args)
             ci_doc.m.save()
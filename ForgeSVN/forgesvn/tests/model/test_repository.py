@@ -867,7 +867,7 @@ def test_refresh(self):
         self.repo.symbolics_for_commit = mock.Mock(
             return_value=[['master', 'branch'], []])
 
-        def refresh_commit_info(oid, seen, lazy=False):
+        def refresh_commit_info(oid, seen, lazy=False, batch=None):
             M.repository.CommitDoc(dict(
                 authored=dict(
                     name=committer_name,
@@ -16,6 +16,7 @@
 #       under the License.
 
 import logging
+import re
 import urllib
 import json
 import difflib
@@ -31,7 +32,7 @@
 
 from ming import schema
 from ming.utils import LazyProperty
-from ming.orm import Mapper, session
+from ming.orm import Mapper, session, state
 from ming.orm import FieldProperty, ForeignIdProperty, RelationProperty
 from ming.orm.declarative import MappedClass
 from ming.orm.ormsession import ThreadLocalORMSession
@@ -79,9 +80,29 @@
 SOLR_TYPE_DEFAULTS = dict(_b=False, _i=0)
 
 
+# clauses of search terms that name their field, e.g. status:open,
+# _milestone:"1.0", votes_up_i:[1 TO *], labels:(a OR b)
+TERM_FIELD_RE = re.compile(r'([\w.]+):(?:"[^"]*"|\[[^\]]*\]|\{[^}]*\}|\([^)]*\)|[^\s()]+)')
+TERM_OPERATOR_RE = re.compile(r'\bAND\b|\bOR\b|\bNOT\b|&&|\|\||[()!+\-]')
+SOLR_TYPE_SUFFIX_RE = re.compile(r'^(.+?)_(?:s|t|i|b|dt)$')
+
+
 def get_default_for_solr_type(solr_type):
     return SOLR_TYPE_DEFAULTS.get(solr_type, u'')
 
+
+def term_fields(terms):
+    """Return the names (without Solr type suffix) of the fields that search
+    ``terms`` refer to, and whether they also search the ``text`` field (by
+    naming it, or with terms that don't name a field).
+
+    """
+    names = set(SOLR_TYPE_SUFFIX_RE.sub(r'\1', m.group(1))
+                for m in TERM_FIELD_RE.finditer(terms))
+    rest = TERM_OPERATOR_RE.sub(' ', TERM_FIELD_RE.sub(' ', terms))
+    return names, bool(rest.strip()) or 'text' in names
+
+
 config = utils.ConfigProxy(
     common_suffix='forgemail.domain',
     new_solr='solr.use_new_types')
@@ -108,6 +129,7 @@ class __mongometa__:
     _bin_counts = FieldProperty(schema.Deprecated)  # {str:int})
     _bin_counts_data = FieldProperty([dict(summary=str, hits=int)])
     _bin_counts_expire = FieldProperty(datetime)
+    # no longer set; superseded by update_bin_counts task dedupe_key
     _bin_counts_invalidated = FieldProperty(datetime)
     # [dict(name=str,hits=int,closed=int)])
     _milestone_counts = FieldProperty(schema.Deprecated)
@@ -184,22 +206,60 @@ def get_custom_field_solr_type(self, field_name):
             return CUSTOM_FIELD_SOLR_TYPES.get(fld.type, '_s')
         return None
 
-    def update_bin_counts(self):
-        # Refresh bin counts
-        self._bin_counts_data = []
-        for b in Bin.query.find(dict(
-                app_config_id=self.app_config_id)):
-            if b.terms and '$USER' in b.terms:
-                # skip queries with $USER variable, hits will be inconsistent
-                # for them
-                continue
-            r = search_artifact(Ticket, b.terms, rows=0, short_timeout=False)
-            hits = r is not None and r.hits or 0
-            self._bin_counts_data.append(dict(summary=b.summary, hits=hits))
-        self._bin_counts_expire = \
-            datetime.utcnow() + timedelta(minutes=60)
+    def update_bin_counts(self, bins=None):
+        """Refresh the counts of the bins with the given summaries (and of
+        bins without a count yet), or of all bins if ``bins`` is None.
+
+        """
+        all_bins = [
+            b for b in Bin.query.find(dict(app_config_id=self.app_config_id))
+            # skip queries with $USER variable, hits will be inconsistent
+            # for them
+            if not (b.terms and '$USER' in b.terms)]
+        counts = dict((d['summary'], d['hits']) for d in self._bin_counts_data)
+        stale = [b for b in all_bins
+                 if bins is None or b.summary in bins or b.summary not in counts]
+        counts.update(self.count_bins(stale))
+        self._bin_counts_data = [dict(summary=b.summary, hits=counts[b.summary])
+                                 for b in all_bins]
+        if len(stale) == len(all_bins):
+            self._bin_counts_expire = \
+                datetime.utcnow() + timedelta(minutes=60)
         self._bin_counts_invalidated = None
 
+    def count_bins(self, bins):
+        """Return the hits of each of ``bins`` by summary, counted by a single
+        faceted Solr search.
+
+        If that search fails (e.g. one bin's terms are invalid), the bins are
+        counted one by one, so that only the bad ones get no hits.
+
+        """
+        queries = [b for b in bins if b.terms]
+        counts = dict((b.summary, 0) for b in bins)
+        if not queries:
+            return counts
+        try:
+            r = search_artifact(Ticket, '*:*', rows=0, short_timeout=False,
+                                facet_queries=[b.terms for b in queries])
+        except SearchError:
+            log.warn('Could not count bins of %s in one search, counting them one by one',
+                     self.app_config_id, exc_info=True)
+        else:
+            hits = r.facets.get('facet_queries', {}) if r is not None else {}
+            for i, b in enumerate(queries):
+                counts[b.summary] = hits.get(str(i), 0)
+            return counts
+        for b in queries:
+            try:
+                r = search_artifact(Ticket, b.terms, rows=0, short_timeout=False)
+            except SearchError:
+                log.warn('Could not count bin %r of %s', b.summary, self.app_config_id,
+                         exc_info=True)
+                continue
+            counts[b.summary] = r is not None and r.hits or 0
+        return counts
+
     def bin_count(self, name):
         # not sure why we expire bin counts after an hour even if unchanged
         # I guess a catch-all in case invalidate_bin_counts is missed
@@ -226,25 +286,34 @@ def milestone_count(self, name):
 
         secured_tickets = Ticket.query.find(dict(mongo_query, acl={"$ne": []}))
         if secured_tickets.count():
-            tickets = [t for t in secured_tickets if security.has_access(t, 'read')]
+            tickets = security.filter_accessible(secured_tickets, 'read')
             d['hits'] += len(tickets)
             d['closed'] += sum(1 for t in tickets if t.status in self.set_of_closed_status_names)
         return d
 
-    def invalidate_bin_counts(self):
-        '''Force expiry of bin counts and queue them to be updated.'''
-        # To prevent multiple calls to this method from piling on redundant
-        # tasks, we set _bin_counts_invalidated when we post the task, and
-        # the task clears it when it's done.  However, in the off chance
-        # that the task fails or is interrupted, we ignore the flag if it's
-        # older than 5 minutes.
-        invalidation_expiry = datetime.utcnow() - timedelta(minutes=5)
-        if self._bin_counts_invalidated is not None and \
-           self._bin_counts_invalidated > invalidation_expiry:
-            return
-        self._bin_counts_invalidated = datetime.utcnow()
+    def invalidate_bin_counts(self, fields=None, bins=None):
+        """Force expiry of bin counts and queue them to be updated.
+
+        :param fields: if given, the names of the ticket fields that changed
+            (see :meth:`Ticket.search_field_names`); only the bins whose
+            terms could match differently are updated.
+        :param bins: if given, the summaries of the bins to update.
+
+        """
+        # Repeated calls while an update is still pending are merged into
+        # that one task by its dedupe_key, and the bins to update unioned, so
+        # they don't pile on redundant tasks.  A call made after the update
+        # has started queues a new one, since the running update may have
+        # missed the change.
         from forgetracker import tasks  # prevent circular import
-        tasks.update_bin_counts.post(self.app_config_id, delay=5)
+        if bins is None:
+            all_bins = Bin.query.find(dict(app_config_id=self.app_config_id))
+            bins = [b.summary for b in all_bins
+                    if fields is None or b.affected_by(fields)]
+            if not bins and fields is not None:
+                return
+        tasks.update_bin_counts.post(self.app_config_id, list(bins), delay=5,
+                                     dedupe_key=str(self.app_config_id), dedupe='union')
 
     def sortable_custom_fields_shown_in_search(self):
         def solr_type(field_name):
@@ -486,7 +555,8 @@ def changes_iter(user):
                     destinations=[monitoring_email]))
                 mail_tasks.sendmail.post(**mail)
 
-        self.invalidate_bin_counts()
+        self.invalidate_bin_counts(
+            fields=Ticket.search_field_names(values.keys() + custom_values.keys()))
         ThreadLocalORMSession.flush_all()
         app = '%s/%s' % (c.project.shortname,
                          self.app_config.options.mount_point)
@@ -588,6 +658,14 @@ def url(self):
     def shorthand_id(self):
         return self.summary
 
+    def affected_by(self, fields):
+        """Whether changes to the given ticket fields (see
+        :meth:`Ticket.search_field_names`) could change this bin's hits.
+
+        """
+        names, text = term_fields(self.terms or '')
+        return text or bool(names.intersection(fields))
+
     def index(self):
         result = Artifact.index(self)
         result.update(
@@ -635,6 +713,17 @@ class __mongometa__:
 
     reported_by = RelationProperty(User, via='reported_by_id')
 
+    # search fields (besides the ones of the same name) that are indexed
+    # from each ticket field, see index()
+    derived_search_fields = {
+        'summary': ['snippet'],
+        'votes_up': ['votes_total'],
+        'votes_down': ['votes_total'],
+        'assigned_to_id': ['assigned_to'],
+        'reported_by_id': ['reported_by'],
+        'acl': ['private'],
+    }
+
     def link_text(self):
         text = super(Ticket, self).link_text()
         if self.is_closed:
@@ -734,6 +823,42 @@ def translate_query(cls, q, fields):
             q = q.replace(f + ':', actual + ':')
         return q
 
+    @classmethod
+    def search_field_names(cls, keys):
+        """Return the names of the search fields affected by changes to the
+        ticket fields (or custom field names) ``keys``.
+
+        """
+        names = set(['mod_date', 'version'])
+        for k in keys:
+            names.add(k)
+            names.update(cls.derived_search_fields.get(k, []))
+        return names
+
+    def changed_fields(self):
+        """Return the names of the search fields affected by this ticket's
+        last commit, or None if they're unknown (e.g. for a new ticket).
+
+        """
+        if self.version <= 1:
+            return None
+        hist = TicketHistory.query.get(
+            artifact_id=self._id, version=self.version - 1)
+        if hist is None:
+            return None
+        old = hist.data
+        new = state(self).document
+        keys = set()
+        for k in set(old.keys()) | set(new.keys()):
+            if k == 'custom_fields':
+                old_cf = old.get(k) or {}
+                new_cf = new.get(k) or {}
+                keys.update(f for f in set(old_cf.keys()) | set(new_cf.keys())
+                            if old_cf.get(f) != new_cf.get(f))
+            elif old.get(k) != new.get(k):
+                keys.add(k)
+        return self.search_field_names(keys)
+
     @property
     def _milestone(self):
         milestone = None
@@ -842,6 +967,10 @@ def _set_discussion_disabled(self, is_disabled):
 
         :param is_disabled: If True, an explicit deny will be created on the discussion thread ACL.
         """
+        if bool(is_disabled) != self.discussion_disabled:
+            # it's on the thread, so changed_fields() can't see it
+            self.globals.invalidate_bin_counts(
+                fields=self.search_field_names(['discussion_disabled']))
         if is_disabled:
             self.discussion_thread.acl = [ACE.deny(EVERYONE, 'post'),
                                           ACE.deny(EVERYONE, 'unmoderated_post')]
@@ -1156,13 +1285,11 @@ def paged_query(cls, app_config, user, query, limit=None, page=0, sort=None, del
             q = q.sort(field, direction)
         q = q.skip(start)
         q = q.limit(limit)
-        tickets = []
         count = q.count()
-        for t in q:
-            if security.has_access(t, 'read', user, app_config.project.root_project):
-                tickets.append(t)
-            else:
-                count = count - 1
+        found = q.all()
+        tickets = security.filter_accessible(
+            found, 'read', user, app_config.project.root_project)
+        count = count - (len(found) - len(tickets))
 
         return dict(
             tickets=tickets,
@@ -1226,16 +1353,18 @@ def paged_search(cls, app_config, user, q, limit=None, page=0, sort=None, show_d
             for t in query:
                 ticket_for_num[t.ticket_num] = t
             # and pull them out in the order given by ticket_numbers
+            found = [ticket_for_num[tn] for tn in ticket_numbers if tn in ticket_for_num]
+            project = app_config.project.root_project
+            readable = set(t._id for t in security.filter_accessible(found, 'read', user, project))
+            if show_deleted:
+                deletable = set(t._id for t in security.filter_accessible(found, 'delete', user, project))
             tickets = []
-            for tn in ticket_numbers:
-                if tn in ticket_for_num:
-                    show_deleted = show_deleted and security.has_access(
-                        ticket_for_num[tn], 'delete', user, app_config.project.root_project)
-                    if (security.has_access(ticket_for_num[tn], 'read', user, app_config.project.root_project) and
-                            (show_deleted or ticket_for_num[tn].deleted == False)):
-                        tickets.append(ticket_for_num[tn])
-                    else:
-                        count = count - 1
+            for t in found:
+                show_deleted = show_deleted and t._id in deletable
+                if t._id in readable and (show_deleted or t.deleted == False):
+                    tickets.append(t)
+                else:
+                    count = count - 1
         return dict(tickets=tickets,
                     count=count, q=q, limit=limit, page=page, sort=sort,
                     filter=filter,
@@ -28,11 +28,11 @@
 
 
 @task
-def update_bin_counts(app_config_id):
+def update_bin_counts(app_config_id, bins=None):
     app_config = M.AppConfig.query.get(_id=app_config_id)
     app = app_config.project.app_instance(app_config)
     with h.push_config(c, app=app):
-        app.globals.update_bin_counts()
+        app.globals.update_bin_counts(bins)
 
 
 @task
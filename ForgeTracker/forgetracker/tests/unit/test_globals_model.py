@@ -26,6 +26,8 @@
 from forgetracker.model import Globals
 from forgetracker.tests.unit import TrackerTestWithModel
 from allura.lib import helpers as h
+from allura.lib.search import SearchError
+from allura import model as M
 
 
 class TestGlobalsModel(TrackerTestWithModel):
@@ -74,29 +76,47 @@ def test_bin_count(self, mock_dt):
         assert gbl.invalidate_bin_counts.called
 
     @mock.patch('forgetracker.tasks.update_bin_counts')
-    @mock.patch('forgetracker.model.ticket.datetime')
-    def test_invalidate_bin_counts(self, mock_dt, mock_task):
-        now = datetime.utcnow().replace(microsecond=0)
-        mock_dt.utcnow.return_value = now
+    def test_invalidate_bin_counts(self, mock_task):
+        Bin = forgetracker.model.Bin
+        Bin.query.remove(dict(app_config_id=c.app.config._id))
+        Bin(summary='open', terms='status:open')
+        Bin(summary='mine', terms='assigned_to:$USER')
+        text_bin = Bin(summary='text', terms='foo')
+        ThreadLocalORMSession.flush_all()
         gbl = Globals()
 
-        # invalidated recently, don't dog-pile
-        gbl._bin_counts_invalidated = now - timedelta(minutes=1)
-        gbl.invalidate_bin_counts()
-        assert not mock_task.post.called
+        def assert_posted(bins):
+            args, kw = mock_task.post.call_args
+            assert_equal(args[0], gbl.app_config_id)
+            assert_equal(sorted(args[1]), bins)
+            assert_equal(kw, dict(delay=5, dedupe_key=str(gbl.app_config_id),
+                                  dedupe='union'))
+            mock_task.reset_mock()
 
-        # invalidated too long ago, call again
-        gbl._bin_counts_invalidated = now - timedelta(minutes=6)
         gbl.invalidate_bin_counts()
-        assert mock_task.post.called
-        assert_equal(gbl._bin_counts_invalidated, now)
+        assert_posted(['mine', 'open', 'text'])
+        # only the bins which could match differently
+        gbl.invalidate_bin_counts(fields=['status', 'mod_date'])
+        assert_posted(['open', 'text'])
+        gbl.invalidate_bin_counts(bins=['mine'])
+        assert_posted(['mine'])
+
+        # no bin is affected, nothing to update
+        text_bin.delete()
+        ThreadLocalORMSession.flush_all()
+        gbl.invalidate_bin_counts(fields=['votes_up', 'votes_total'])
+        assert not mock_task.post.called
 
-        # never invalidated
-        mock_task.reset_mock()
-        gbl._bin_counts_invalidated = None
-        gbl.invalidate_bin_counts()
-        assert mock_task.post.called
-        assert_equal(gbl._bin_counts_invalidated, now)
+    def test_invalidate_bin_counts_dedupe(self):
+        M.MonQTask.query.remove({})
+        gbl = Globals()
+        gbl.invalidate_bin_counts(bins=['open'])
+        gbl.invalidate_bin_counts(bins=['closed'])
+        ThreadLocalORMSession.flush_all()
+        tasks = M.MonQTask.query.find(dict(
+            task_name='forgetracker.tasks.update_bin_counts')).all()
+        assert_equal(len(tasks), 1)
+        assert_equal(sorted(tasks[0].args[1]), ['closed', 'open'])
 
     @mock.patch('forgetracker.model.ticket.Bin')
     @mock.patch('forgetracker.model.ticket.search_artifact')
@@ -107,18 +127,65 @@ def test_update_bin_counts(self, mock_dt, mock_search, mock_bin):
         gbl = Globals()
         gbl._bin_counts_invalidated = now - timedelta(minutes=1)
         mock_bin.query.find.return_value = [
-            mock.Mock(summary='foo', terms='bar')]
-        mock_search().hits = 5
+            mock.Mock(summary='foo', terms='bar'),
+            mock.Mock(summary='qux', terms='baz'),
+            mock.Mock(summary='mine', terms='assigned_to:$USER')]
+        mock_search.return_value.facets = {
+            'facet_queries': {'0': 5, '1': 3}}
 
         assert_equal(gbl._bin_counts_data, [])  # sanity pre-check
         gbl.update_bin_counts()
         assert mock_bin.query.find.called
-        mock_search.assert_called_with(
-            forgetracker.model.Ticket, 'bar', rows=0, short_timeout=False)
-        assert_equal(gbl._bin_counts_data, [{'summary': 'foo', 'hits': 5}])
+        mock_search.assert_called_once_with(
+            forgetracker.model.Ticket, '*:*', rows=0, short_timeout=False,
+            facet_queries=['bar', 'baz'])
+        assert_equal(gbl._bin_counts_data, [{'summary': 'foo', 'hits': 5},
+                                            {'summary': 'qux', 'hits': 3}])
         assert_equal(gbl._bin_counts_expire, now + timedelta(minutes=60))
         assert_equal(gbl._bin_counts_invalidated, None)
 
+    @mock.patch('forgetracker.model.ticket.Bin')
+    @mock.patch('forgetracker.model.ticket.search_artifact')
+    @mock.patch('forgetracker.model.ticket.datetime')
+    def test_update_some_bin_counts(self, mock_dt, mock_search, mock_bin):
+        now = datetime.utcnow().replace(microsecond=0)
+        mock_dt.utcnow.return_value = now
+        gbl = Globals()
+        gbl._bin_counts_expire = now + timedelta(minutes=10)
+        gbl._bin_counts_data = [{'summary': 'foo', 'hits': 1},
+                                {'summary': 'qux', 'hits': 2},
+                                {'summary': 'deleted', 'hits': 3}]
+        mock_bin.query.find.return_value = [
+            mock.Mock(summary='foo', terms='bar'),
+            mock.Mock(summary='qux', terms='baz'),
+            mock.Mock(summary='new', terms='status:new')]
+        mock_search.return_value.facets = {
+            'facet_queries': {'0': 5, '1': 7}}
+
+        gbl.update_bin_counts(['foo'])
+        # updated bins, and new ones which have no count yet
+        mock_search.assert_called_once_with(
+            forgetracker.model.Ticket, '*:*', rows=0, short_timeout=False,
+            facet_queries=['bar', 'status:new'])
+        assert_equal(gbl._bin_counts_data, [{'summary': 'foo', 'hits': 5},
+                                            {'summary': 'qux', 'hits': 2},
+                                            {'summary': 'new', 'hits': 7}])
+        # not all counts are fresh
+        assert_equal(gbl._bin_counts_expire, now + timedelta(minutes=10))
+
+    @mock.patch('forgetracker.model.ticket.search_artifact')
+    def test_count_bins_search_error(self, mock_search):
+        def search(cls, q, **kw):
+            if 'facet_queries' in kw or q == 'bad:[':
+                raise SearchError('Error running search query')
+            return mock.Mock(hits=len(q))
+        mock_search.side_effect = search
+        gbl = Globals()
+        bins = [mock.Mock(summary='good', terms='good'),
+                mock.Mock(summary='bad', terms='bad:['),
+                mock.Mock(summary='empty', terms='')]
+        assert_equal(gbl.count_bins(bins), {'good': 4, 'bad': 0, 'empty': 0})
+
     def test_append_new_labels(self):
         gbl = Globals()
         assert_equal(gbl.append_new_labels([], ['tag1']), ['tag1'])
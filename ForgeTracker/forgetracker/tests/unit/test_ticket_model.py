@@ -30,7 +30,8 @@
     assert_true,
     assert_false,
 )
-from forgetracker.model import Ticket, TicketAttachment
+from forgetracker.model import Ticket, TicketAttachment, Bin
+from forgetracker.model.ticket import term_fields
 from forgetracker.tests.unit import TrackerTestWithModel
 from forgetracker.import_support import ResettableStream
 from allura.model import Feed, Post, User
@@ -357,3 +358,73 @@ def test_paged_query_or_search(self, query, search, tsearch):
         search.assert_called_once_with(app_cfg, user, solr_query, filter=filter, sort=None, limit=None, page=0, **kw)
         assert_equal(query.call_count, 0)
         assert_equal(tsearch.query_filter_choices.call_count, 0)
+
+    def test_changed_fields(self):
+        ticket = Ticket.new()
+        ticket.summary = 'my ticket'
+        ticket.commit()
+        assert_equal(ticket.changed_fields(), None)
+        ticket.status = 'closed'
+        ticket.votes_up = 1
+        ticket.custom_fields['_milestone'] = '1.0'
+        ticket.commit()
+        assert_equal(ticket.changed_fields(), set([
+            'mod_date', 'version', 'status', 'votes_up', 'votes_total',
+            '_milestone']))
+
+    @mock.patch('forgetracker.tasks.update_bin_counts')
+    def test_private_invalidates_bin_counts(self, update_bin_counts):
+        Bin.query.remove(dict(app_config_id=c.app.config._id))
+        Bin(summary='private', terms='private:true')
+        Bin(summary='open', terms='status:open')
+        ticket = Ticket.new()
+        ticket.commit()
+        ThreadLocalORMSession.flush_all()
+        ticket.private = True
+        ticket.commit()
+        assert_in('private', ticket.changed_fields())
+        c.app.globals.invalidate_bin_counts(fields=ticket.changed_fields())
+        assert_equal(update_bin_counts.post.call_args[0][1], ['private'])
+
+    @mock.patch('forgetracker.tasks.update_bin_counts')
+    def test_discussion_disabled_invalidates_bin_counts(self, update_bin_counts):
+        Bin.query.remove(dict(app_config_id=c.app.config._id))
+        Bin(summary='closed', terms='discussion_disabled:true')
+        Bin(summary='open', terms='status:open')
+        ticket = Ticket.new()
+        ThreadLocalORMSession.flush_all()
+        ticket.discussion_disabled = True
+        assert_equal(update_bin_counts.post.call_args[0][1], ['closed'])
+        # unchanged, nothing to update
+        ThreadLocalORMSession.flush_all()
+        update_bin_counts.reset_mock()
+        ticket.discussion_disabled = True
+        assert not update_bin_counts.post.called
+
+    def test_search_field_names(self):
+        assert_equal(Ticket.search_field_names(['summary', '_iteration']), set([
+            'mod_date', 'version', 'summary', 'snippet', '_iteration']))
+
+
+class TestBin(TrackerTestWithModel):
+
+    def test_term_fields(self):
+        assert_equal(term_fields('status:open'), (set(['status']), False))
+        assert_equal(
+            term_fields('status:(open OR closed) && -_milestone:"1.0 beta"'),
+            (set(['status', '_milestone']), False))
+        assert_equal(term_fields('votes_total_i:[1 TO *] AND private_b:true'),
+                     (set(['votes_total', 'private']), False))
+        assert_equal(term_fields('status:open crash'), (set(['status']), True))
+        assert_equal(term_fields('text:crash'), (set(['text']), True))
+        assert_equal(term_fields(''), (set(), False))
+
+    def test_affected_by(self):
+        b = Bin(summary='bin', terms='status:open AND assigned_to:bob')
+        assert_true(b.affected_by(['status']))
+        assert_true(b.affected_by(['mod_date', 'assigned_to']))
+        assert_false(b.affected_by(['mod_date', 'summary', 'snippet']))
+        b.terms = 'crash'
+        assert_true(b.affected_by(['mod_date']))
+        b.terms = '*:*'
+        assert_true(b.affected_by(['mod_date']))
@@ -797,7 +797,8 @@ def update_milestones(self, field_name=None, milestones=None, **kw):
                         ))
                         update_counts = True
         if update_counts:
-            c.app.globals.invalidate_bin_counts()
+            c.app.globals.invalidate_bin_counts(
+                fields=TM.Ticket.search_field_names([field_name]))
         redirect('milestones')
 
     @with_trailing_slash
@@ -918,7 +919,7 @@ def save_ticket(self, ticket_form=None, **post_data):
             self.rate_limit(redir='.')
             ticket = TM.Ticket.new()
         ticket.update(ticket_form)
-        c.app.globals.invalidate_bin_counts()
+        c.app.globals.invalidate_bin_counts(fields=ticket.changed_fields())
         g.director.create_activity(c.user, 'created', ticket,
                                    related_nodes=[c.project], tags=['ticket'])
         redirect(str(ticket.ticket_num) + '/')
@@ -1178,7 +1179,7 @@ def save_bin(self, **bin_form):
             # Render edit page with error messages
             return dict(bins=self.app.bins, count=len(self.app.bins),
                         app=self.app, new_bin=new_bin, errors=True)
-        self.app.globals.invalidate_bin_counts()
+        self.app.globals.invalidate_bin_counts(bins=[bin.summary])
         redirect('.')
 
     @with_trailing_slash
@@ -1526,7 +1527,7 @@ def cf_val(cf):
             thread.post(text=comment, notify=False)
         g.director.create_activity(c.user, 'modified', self.ticket,
                                    related_nodes=[c.project], tags=['ticket'])
-        c.app.globals.invalidate_bin_counts()
+        c.app.globals.invalidate_bin_counts(fields=self.ticket.changed_fields())
         redirect('.')
 
     @expose('json:')
@@ -1875,7 +1876,7 @@ def save(self, ticket_form=None, **post_data):
         # if c.app.globals.milestone_names is None:
         #     c.app.globals.milestone_names = ''
         self.ticket.update(ticket_form)
-        c.app.globals.invalidate_bin_counts()
+        c.app.globals.invalidate_bin_counts(fields=self.ticket.changed_fields())
         redirect('.')
 
 
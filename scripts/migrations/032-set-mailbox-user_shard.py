@@ -0,0 +1,39 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+import logging
+
+from ming.orm import session
+
+from allura import model as M
+
+log = logging.getLogger(__name__)
+
+
+def main():
+    mailboxes = session(M.Mailbox).impl.db[M.Mailbox.__mongometa__.name]
+    user_ids = mailboxes.find({'user_shard': None}).distinct('user_id')
+    log.info('Setting user_shard on the mailboxes of %s users', len(user_ids))
+    for i, user_id in enumerate(user_ids):
+        M.Mailbox.query.update({'user_id': user_id, 'user_shard': None},
+                               {'$set': {'user_shard': M.Mailbox.shard_of(user_id)}},
+                               multi=True)
+        if i % 10000 == 9999:
+            log.info('%s users done', i + 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""
+Compare the Solr requests made to refresh a tracker's bin counts after a
+ticket update: one search per bin (the old way) vs. one faceted search for
+just the bins the update could affect.  Creates synthetic bins and tickets in
+the given tracker as needed; Solr is replaced by a mock that counts requests.
+
+Example usage:
+
+    paster script development.ini ../scripts/perf/bin_counts.py -- --project=test --bins=50
+"""
+
+import argparse
+import time
+
+import mock
+from pylons import tmpl_context as c
+from ming.orm import ThreadLocalORMSession
+
+from allura.lib import helpers as h
+from allura.lib import search
+from allura.lib.solr import MockSOLR
+from forgetracker import model as TM
+
+TERMS = [
+    'status:open',
+    'status:closed',
+    '_milestone:1.0',
+    'assigned_to:test-admin',
+    'status:open && _milestone:2.0',
+    'labels:bench',
+    'crash',
+]
+
+# ticket fields changed by the simulated updates
+UPDATES = [['status'], ['_milestone'], ['summary'], ['votes_up'], ['description']]
+
+
+class CountingSOLR(MockSOLR):
+
+    def __init__(self):
+        super(CountingSOLR, self).__init__()
+        self.searches = 0
+        self.nested = False
+
+    def search(self, q, fq=None, **kw):
+        # MockSOLR counts facet queries with searches of its own
+        if self.nested:
+            return super(CountingSOLR, self).search(q, fq=fq, **kw)
+        self.searches += 1
+        self.nested = True
+        try:
+            return super(CountingSOLR, self).search(q, fq=fq, **kw)
+        finally:
+            self.nested = False
+
+
+def make_bins(count):
+    bins = []
+    for i in range(count):
+        summary = 'bench-bin-%d' % i
+        b = TM.Bin.query.get(app_config_id=c.app.config._id, summary=summary)
+        if b is None:
+            b = TM.Bin(summary=summary, terms=TERMS[i % len(TERMS)])
+        bins.append(b)
+    ThreadLocalORMSession.flush_all()
+    return bins
+
+
+def make_tickets(solr, count):
+    tickets = TM.Ticket.query.find(dict(app_config_id=c.app.config._id)).limit(count).all()
+    for i in range(len(tickets), count):
+        t = TM.Ticket.new()
+        t.summary = 'bench ticket %d' % i
+        t.status = 'open' if i % 2 else 'closed'
+        tickets.append(t)
+    ThreadLocalORMSession.flush_all()
+    solr.add([ticket.solarize() for ticket in tickets])
+
+
+def time_updates(solr, func):
+    solr.searches = 0
+    start = time.time()
+    for fields in UPDATES:
+        func(TM.Ticket.search_field_names(fields))
+    return solr.searches, time.time() - start
+
+
+def main(opts):
+    h.set_context(opts.project, opts.mount_point, neighborhood=opts.nbhd)
+    bins = make_bins(opts.bins)
+    solr = CountingSOLR()
+    with mock.patch.object(search.g, 'solr', solr):
+        make_tickets(solr, opts.tickets)
+
+        def per_bin(fields):
+            for b in bins:
+                search.search_artifact(TM.Ticket, b.terms, rows=0)
+
+        def faceted(fields):
+            c.app.globals.count_bins([b for b in bins if b.affected_by(fields)])
+
+        results = [('per bin', time_updates(solr, per_bin)),
+                   ('faceted', time_updates(solr, faceted))]
+    print '%d bins, %d ticket updates' % (len(bins), len(UPDATES))
+    for label, (searches, elapsed) in results:
+        print '%-10s %6d searches  %6.1f searches/update  %8.3fs' % (
+            label, searches, float(searches) / len(UPDATES), elapsed)
+
+
+def parse_options():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nbhd', default='Projects')
+    parser.add_argument('--project', required=True)
+    parser.add_argument('--mount-point', dest='mount_point', default='bugs')
+    parser.add_argument('--bins', type=int, default=50,
+                        help='Number of synthetic bins')
+    parser.add_argument('--tickets', type=int, default=200,
+                        help='Number of tickets to index in the mock Solr')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_options())
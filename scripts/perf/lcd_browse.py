@@ -0,0 +1,100 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""
+Compare cold tree browse (Tree.ls) latency with and without the last commit
+tree index.  Run refresh_last_commits.py on the repo first so that the index
+is complete.
+
+Example usage:
+
+    paster script development.ini ../scripts/perf/lcd_browse.py -- --project=big --mount-point=code --depth=2
+"""
+
+import argparse
+import time
+
+from pylons import tmpl_context as c
+from ming.orm import ThreadLocalORMSession
+
+from allura import model as M
+from allura.lib import helpers as h
+
+
+def walk(tree, depth):
+    yield tree
+    if depth <= 0:
+        return
+    for x in tree.tree_ids:
+        for t in walk(tree[x.name], depth - 1):
+            yield t
+
+
+def time_ls(repo, commit_id, paths, indexed):
+    '''Browse each path cold (fresh sessions and caches), return timings'''
+    timings = []
+    for path in paths:
+        ThreadLocalORMSession.close_all()
+        repo = M.Repository.query.get(_id=repo._id)
+        repo.lcd_index_complete = indexed
+        commit = repo.commit(commit_id)
+        tree = commit.get_path(path) if path else commit.tree
+        with h.push_config(c, model_cache=M.repository.ModelCache(), lcid_cache={}):
+            start = time.time()
+            tree.ls()
+            timings.append(time.time() - start)
+        # don't save the forced flag, or any LCDs built without the index
+        ThreadLocalORMSession.close_all()
+    return timings
+
+
+def report(label, timings):
+    timings = sorted(timings)
+    print '%-12s paths: %d  total: %.3fs  avg: %.4fs  p50: %.4fs  max: %.4fs' % (
+        label, len(timings), sum(timings), sum(timings) / len(timings),
+        timings[len(timings) // 2], timings[-1])
+
+
+def main(opts):
+    h.set_context(opts.project, opts.mount_point, neighborhood=opts.nbhd)
+    repo = c.app.repo
+    commit = repo.commit(opts.commit)
+    print 'Repo %s, commit %s, %d commits total' % (
+        repo.full_fs_path, commit._id, len(list(repo.all_commit_ids())))
+    paths = [t.path().strip('/') for t in walk(commit.tree, opts.depth)][:opts.limit]
+    if not repo.lcd_index_complete:
+        print 'Warning: last commit index is not complete for this repo'
+    report('SCM', time_ls(repo, commit._id, paths, indexed=False))
+    report('tree index', time_ls(repo, commit._id, paths, indexed=True))
+
+
+def parse_options():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nbhd', default='Projects')
+    parser.add_argument('--project', required=True)
+    parser.add_argument('--mount-point', dest='mount_point', default='code')
+    parser.add_argument('--commit', default='HEAD',
+                        help='Commit (or branch) to browse')
+    parser.add_argument('--depth', type=int, default=1,
+                        help='How many directory levels to browse below the root')
+    parser.add_argument('--limit', type=int, default=100,
+                        help='Maximum number of directories to browse')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_options())
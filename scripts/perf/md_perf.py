@@ -43,6 +43,10 @@
 user    0m12.749s
 sys     0m1.112s
 
+Time rendering many shortlinks, looked up one at a time vs. all at once:
+
+    paster script development.ini ../scripts/perf/md_perf.py -- --shortlinks=300 --project=test
+
 """
 
 import argparse
@@ -106,6 +110,38 @@ def render(artifact, md, opts):
     return output
 
 
+def shortlinks(opts):
+    """Render a text with many cross-references, looking up its shortlinks
+    one at a time vs. all at once beforehand"""
+    import mock
+    import ming
+    from pylons import tmpl_context as c
+    from ming.orm import ThreadLocalORMSession
+    from allura import model as M
+    from allura.lib import helpers as h
+    from allura.lib.markdown_extensions import ForgeExtension
+
+    h.set_context(opts.project, neighborhood=opts.nbhd)
+    links = [sl.link for sl in M.Shortlink.query.find(
+        dict(project_id=c.project._id)).limit(opts.shortlinks)]
+    text = '\n\n'.join('See [%s]' % link for link in links)
+    print 'Rendering %d shortlinks in project %s' % (len(links), opts.project)
+    find = ming.Session.find
+    for label, prefetch in (('one by one', False), ('prefetched', True)):
+        ThreadLocalORMSession.close_all()
+        h.set_context(opts.project, neighborhood=opts.nbhd)
+        with mock.patch.object(ming.Session, 'find', autospec=True, side_effect=find) as finds:
+            if prefetch:
+                start = time.time()
+                g.markdown.convert(text)
+            else:
+                with mock.patch.object(ForgeExtension, 'prefetch_shortlinks'):
+                    start = time.time()
+                    g.markdown.convert(text)
+            elapsed = time.time() - start
+        print '%-12s %8.3fs %6d queries' % (label, elapsed, finds.call_count)
+
+
 def parse_options():
     parser = argparse.ArgumentParser()
     parser.add_argument('--converter', default='markdown')
@@ -119,11 +155,18 @@ def parse_options():
                         help='Run with re and re2, and compare results')
     parser.add_argument('-n', '--n', nargs='+', type=int,
                         help='Only convert nth post(s) in thread')
+    parser.add_argument('--shortlinks', type=int,
+                        help='Instead, time rendering this many shortlinks to artifacts in --project')
+    parser.add_argument('--project', default='test')
+    parser.add_argument('--nbhd', default='Projects')
     return parser.parse_args()
 
 
 if __name__ == '__main__':
     opts = parse_options()
+    if opts.shortlinks:
+        shortlinks(opts)
+        raise SystemExit
     out1 = main(opts)
     if opts.compare:
         opts.re2 = not opts.re2
@@ -0,0 +1,101 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""
+Time the notify task against the number of subscribers, delivering to each
+mailbox with its own update (the old way) vs. one multi-document update.
+Creates synthetic digest subscriptions to the tool (scheduled far in the
+future, so none of them fire) and removes them afterwards.
+
+Example usage:
+
+    paster script development.ini ../scripts/perf/notify_deliver.py -- --project=test --subscribers=10,100,1000,5000
+"""
+
+import argparse
+import time
+from datetime import datetime, timedelta
+
+import mock
+from bson import ObjectId
+from pylons import tmpl_context as c
+from ming.orm import ThreadLocalORMSession
+
+from allura import model as M
+from allura.lib import helpers as h
+from allura.tasks import notification_tasks
+
+TOPIC = 'notify-deliver-bench'
+
+
+def make_mailboxes(count):
+    M.Mailbox.query.remove(dict(topic=TOPIC))
+    for i in range(count):
+        M.Mailbox(user_id=ObjectId(), topic=TOPIC, type='digest',
+                  frequency=dict(n=1, unit='month'),
+                  next_scheduled=datetime.utcnow() + timedelta(days=365))
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+
+
+def deliver_each(cls, nid, artifact_index_id, topic):
+    cls._deliver_each(nid, {
+        'project_id': c.project._id,
+        'app_config_id': c.app.config._id,
+        'artifact_index_id': {'$in': [None, artifact_index_id]},
+        'topic': {'$in': [None, topic]}
+    })
+
+
+def time_notify(notifications):
+    start = time.time()
+    for i in range(notifications):
+        notification_tasks.notify('bench-%d' % i, None, TOPIC)
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    return (time.time() - start) / notifications
+
+
+def main(opts):
+    h.set_context(opts.project, opts.mount_point, neighborhood=opts.nbhd)
+    print '%12s %14s %14s' % ('subscribers', 'each (ms)', 'multi (ms)')
+    try:
+        for count in opts.subscribers:
+            make_mailboxes(count)
+            with mock.patch.object(M.Mailbox, 'deliver', classmethod(deliver_each)):
+                each = time_notify(opts.notifications)
+            multi = time_notify(opts.notifications)
+            print '%12d %14.1f %14.1f' % (count, each * 1000, multi * 1000)
+    finally:
+        M.Mailbox.query.remove(dict(topic=TOPIC))
+
+
+def parse_options():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nbhd', default='Projects')
+    parser.add_argument('--project', required=True)
+    parser.add_argument('--mount-point', dest='mount_point', default='wiki')
+    parser.add_argument('--subscribers', default='10,100,1000',
+                        type=lambda s: [int(n) for n in s.split(',')],
+                        help='Comma separated numbers of subscribers to try')
+    parser.add_argument('--notifications', type=int, default=10,
+                        help='Notify tasks to time for each number of subscribers')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_options())
@@ -0,0 +1,83 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""
+Time how long a refresh takes to work out which commits are new, for an
+increasing number of commits.  Uses an already refreshed repo, so every commit
+is known: "cold" is a fresh process, "warm" a process that has refreshed the
+repo before.
+
+Example usage:
+
+    paster script development.ini ../scripts/perf/refresh_detect.py -- --project=big --mount-point=code
+"""
+
+import argparse
+import time
+
+from pylons import tmpl_context as c
+
+from allura.lib import helpers as h
+from allura.model import repo_refresh
+
+
+def timed(func, *args, **kw):
+    start = time.time()
+    result = func(*args, **kw)
+    return time.time() - start, result
+
+
+def main(opts):
+    h.set_context(opts.project, opts.mount_point, neighborhood=opts.nbhd)
+    repo = c.app.repo
+    elapsed, all_commit_ids = timed(list, repo.all_commit_ids())
+    print 'Repo %s: %d commits, all_commit_ids took %.3fs' % (
+        repo.full_fs_path, len(all_commit_ids), elapsed)
+    print '%10s %10s %10s %10s' % ('commits', 'unknown', 'cold (s)', 'warm (s)')
+    count = opts.start
+    while True:
+        commit_ids = all_commit_ids[:count]
+        repo_refresh.known_commit_ids.clear()
+        cold, unknown = timed(repo_refresh.unknown_commit_ids, commit_ids)
+        warm, unknown = timed(repo_refresh.unknown_commit_ids, commit_ids)
+        print '%10d %10d %10.3f %10.3f' % (len(commit_ids), len(unknown), cold, warm)
+        if count >= len(all_commit_ids):
+            break
+        count *= opts.factor
+    repo_refresh.known_commit_ids.clear()
+    try:
+        cold, new = timed(repo._impl.new_commits)
+    except NotImplementedError:
+        return
+    warm, new = timed(repo._impl.new_commits)
+    print 'new_commits: %d new, cold %.3fs, warm %.3fs' % (len(new), cold, warm)
+
+
+def parse_options():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nbhd', default='Projects')
+    parser.add_argument('--project', required=True)
+    parser.add_argument('--mount-point', dest='mount_point', default='code')
+    parser.add_argument('--start', type=int, default=100,
+                        help='Number of commits to start with')
+    parser.add_argument('--factor', type=int, default=10,
+                        help='Multiply the number of commits by this each round')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_options())
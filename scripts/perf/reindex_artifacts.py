@@ -0,0 +1,99 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""
+Compare reindex throughput (artifacts/sec) of the add_artifacts task when
+artifacts are looked up one ref at a time vs. grouped by class and project.
+Creates synthetic wiki pages in the given project as needed; Solr is replaced
+by a mock so only the Mongo side is measured.
+
+Example usage:
+
+    paster script development.ini ../scripts/perf/reindex_artifacts.py -- --project=test --artifacts=5000
+"""
+
+import argparse
+import time
+
+import mock
+from ming.orm import ThreadLocalORMSession
+
+from allura import model as M
+from allura.lib import helpers as h
+from allura.lib.solr import MockSOLR
+from allura.tasks import index_tasks
+from forgewiki import model as WM
+
+
+def make_pages(count):
+    '''Make sure there are ``count`` synthetic pages, return their ref ids'''
+    session = M.artifact_orm_session._get()
+    session.disable_index = True
+    try:
+        pages = []
+        for i in range(count):
+            pages.append(WM.Page.upsert('reindex-bench-%d' % i))
+            if i % 1000 == 999:
+                ThreadLocalORMSession.flush_all()
+                print 'Created %d pages' % (i + 1)
+        ThreadLocalORMSession.flush_all()
+        ref_ids = [M.ArtifactReference.from_artifact(pg)._id for pg in pages]
+        ThreadLocalORMSession.flush_all()
+    finally:
+        session.disable_index = False
+    ThreadLocalORMSession.close_all()
+    return ref_ids
+
+
+def time_reindex(ref_ids, chunk_size):
+    start = time.time()
+    for i in range(0, len(ref_ids), chunk_size):
+        index_tasks.add_artifacts(ref_ids[i:i + chunk_size])
+        # don't keep the updated references
+        ThreadLocalORMSession.close_all()
+    return time.time() - start
+
+
+def main(opts):
+    h.set_context(opts.project, opts.mount_point, neighborhood=opts.nbhd)
+    ref_ids = make_pages(opts.artifacts)
+    print 'Reindexing %d artifacts in chunks of %d' % (len(ref_ids), opts.chunk_size)
+    per_ref = mock.patch.object(M.ArtifactReference, 'load_artifacts',
+                                staticmethod(lambda refs: refs))
+    with mock.patch.object(index_tasks.g, 'solr', MockSOLR()):
+        with per_ref:
+            before = time_reindex(ref_ids, opts.chunk_size)
+        after = time_reindex(ref_ids, opts.chunk_size)
+    for label, elapsed in (('per ref', before), ('grouped', after)):
+        print '%-10s %8.3fs  %10.1f artifacts/sec' % (
+            label, elapsed, len(ref_ids) / elapsed)
+
+
+def parse_options():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nbhd', default='Projects')
+    parser.add_argument('--project', required=True)
+    parser.add_argument('--mount-point', dest='mount_point', default='wiki')
+    parser.add_argument('--artifacts', type=int, default=5000,
+                        help='Number of synthetic wiki pages to reindex')
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=1000,
+                        help='Refs per add_artifacts call')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_options())
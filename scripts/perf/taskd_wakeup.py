@@ -0,0 +1,129 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""
+Benchmark taskd wakeup: post-to-start latency and MongoDB ops/sec while a
+pool of workers sits idle, with polling vs. capped collection notifications.
+
+Needs a real MongoDB (not mim).  Example usage:
+
+    paster script development.ini ../scripts/perf/taskd_wakeup.py -- --mode=poll --workers=50
+    paster script development.ini ../scripts/perf/taskd_wakeup.py -- --mode=notify --workers=50
+"""
+
+import argparse
+import threading
+import time
+from datetime import datetime
+
+from ming.orm import ThreadLocalORMSession
+
+from allura import model as M
+
+
+def noop():
+    pass
+
+TASK_NAME = '%s.%s' % (noop.__module__, noop.__name__)
+
+
+def opcounters():
+    db = M.session.task_doc_session.db
+    counters = db.command('serverStatus')['opcounters']
+    return sum(counters.values())
+
+
+def worker(opts, stop, latencies):
+    only = [TASK_NAME]
+    notifier = M.MonQNotifier()
+    if opts.mode == 'notify' and not notifier.start():
+        raise RuntimeError('MonQ notifications are not available')
+
+    def waitfunc():
+        if stop.is_set():
+            raise StopIteration
+        if opts.mode == 'notify':
+            notifier.wait(opts.poll_interval, only=only)
+        else:
+            time.sleep(opts.poll_interval)
+
+    while not stop.is_set():
+        task = M.MonQTask.get(process='bench', waitfunc=waitfunc, only=only)
+        if task is None:
+            continue
+        latencies.append(
+            (datetime.utcnow() - task.time_queue).total_seconds())
+        task.state = 'complete'
+        ThreadLocalORMSession.flush_all()
+        ThreadLocalORMSession.close_all()
+
+
+def main(opts):
+    M.MonQTask.query.remove(dict(task_name=TASK_NAME))
+    stop = threading.Event()
+    latencies = []
+    threads = [threading.Thread(target=worker, args=(opts, stop, latencies))
+               for i in range(opts.workers)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    print 'Measuring %d idle %s workers for %ss' % (
+        opts.workers, opts.mode, opts.idle_time)
+    time.sleep(opts.poll_interval)  # let workers settle
+    start_ops, start = opcounters(), time.time()
+    time.sleep(opts.idle_time)
+    idle_ops = (opcounters() - start_ops) / (time.time() - start)
+
+    print 'Posting %d tasks' % opts.tasks
+    for i in range(opts.tasks):
+        M.MonQTask.post(noop)
+        ThreadLocalORMSession.flush_all()
+        time.sleep(opts.post_interval)
+    deadline = time.time() + opts.poll_interval * 2
+    while len(latencies) < opts.tasks and time.time() < deadline:
+        time.sleep(0.1)
+    stop.set()
+
+    latencies.sort()
+    print 'Idle Mongo ops/sec:        %.1f' % idle_ops
+    print 'Tasks started:             %d/%d' % (len(latencies), opts.tasks)
+    if latencies:
+        print 'Post-to-start latency (s): avg %.3f, p50 %.3f, p95 %.3f, max %.3f' % (
+            sum(latencies) / len(latencies),
+            latencies[len(latencies) // 2],
+            latencies[int(len(latencies) * 0.95)],
+            latencies[-1])
+    M.MonQTask.query.remove(dict(task_name=TASK_NAME))
+
+
+def parse_options():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', choices=['poll', 'notify'], default='notify')
+    parser.add_argument('--workers', type=int, default=50)
+    parser.add_argument('--tasks', type=int, default=100)
+    parser.add_argument('--poll-interval', dest='poll_interval', type=float, default=10,
+                        help='Same as monq.poll_interval')
+    parser.add_argument('--idle-time', dest='idle_time', type=float, default=30,
+                        help='Seconds to measure Mongo ops with all workers idle')
+    parser.add_argument('--post-interval', dest='post_interval', type=float, default=0.05,
+                        help='Seconds between posting tasks')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_options())